@@ -51,6 +51,7 @@ if __package__ is None and not hasattr(sys, 'frozen'):
     # direct call of __main__.py
     path = os.path.realpath(os.path.abspath(__file__))
     sys.path.insert(0, os.path.dirname(os.path.dirname(path)))
+from isbg import imaputils  # noqa: E402
 from isbg import isbg  # noqa: E402
 
 
@@ -76,6 +77,15 @@ Command line Options::
   --usage                Show the usage information.
   --version              Show the version information.
 
+  --actionbatch num      Number of IMAP actions on the inbox mails
+                         queued before they are sent. Use 0 to send
+                         them at the end of the run [default: 100].
+  --checkfirst           With spamc or spamd, get only the score of the
+                         mails, and get the report of the spams only.
+  --concurrentpasses     Learn spam, learn ham and scan the inbox at
+                         the same time, with a IMAP connection each.
+  --daemon               Keep running, scanning the new mails as soon
+                         as they arrive (using IMAP IDLE).
   --dryrun               Do not actually make any changes.
   --delete               The spams will be marked for deletion from
                          your inbox.
@@ -84,14 +94,30 @@ Command line Options::
   --expunge              Cause marked for deletion messages to also be
                          deleted (only useful if --delete is
                          specified).
+  --fetchbatch num       Number of mails fetched with every IMAP
+                         command [default: 25].
+  --fetchbytes numbytes  Maximum sum of sizes of the mails fetched
+                         with every IMAP command. Use 0 to not limit
+                         it [default: 2000000].
   --flag                 The spams will be flagged in your inbox.
   --gmail                Delete by copying to '[Gmail]/Trash' folder.
   --ignorelockfile       Don't stop if lock file is present.
+  --imapbackend name     IMAP client used: imaplib or asyncio
+                         [default: imaplib].
   --imappasswd passwd    IMAP account password.
+  --imappool num         Number of IMAP connections fetching the inbox
+                         mails at the same time [default: 1].
   --imapport port        Use a custom port.
   --imapinbox mbox       Name of your inbox folder [Default: INBOX].
   --learnspambox mbox    Name of your learn spam folder.
   --learnhambox mbox     Name of your learn ham folder.
+  --learnbatch num       Number of mails learned with every run of
+                         sa-learn, instead of learning them one by
+                         one. sa-learn runs locally and updates the
+                         Bayes database of the isbg user, which is not
+                         the one of a spamd running in other host or
+                         as other user. Not used with --spamd. Use 0
+                         to disable it [default: 0].
   --learnthendestroy     Mark learnt messages for deletion.
   --learnthenflag        Flag learnt messages.
   --learnunflagged       Only learn if unflagged
@@ -111,14 +137,34 @@ Command line Options::
                          emails. Use 0 to run without partial run
                          [default: 50].
   --passwdfilename fn    Use a file to supply the password.
+  --runtimeout secs      Stop scanning and learning after 'secs'
+                         seconds, leaving the mails left for the next
+                         run. Use 0 to not limit it [default: 0].
   --savepw               Store the password to be used in future runs.
+  --queuedepth num       Number of fetched mails waiting to be scanned
+                         or learned [default: 50].
+  --scan-workers num     Number of mails scanned or learned at the same
+                         time [default: 1].
+  --scantimeout secs     Seconds given to scan or learn a mail; the
+                         mails timed out are retried in the next run.
+                         Use 0 to not limit it [default: 0].
+  --scantruncated        Scan the first --maxsize bytes of the bigger
+                         messages instead of ignoring them.
   --spamc                Use spamc instead of standalone SpamAssassin
                          binary.
+  --spamd address        Talk directly to spamd at host[:port] or at
+                         a unix socket path instead of running spamc.
+  --spamdcompress        Send the mails compressed to spamd.
   --spaminbox mbox       Name of your spam folder
                          [Default: INBOX.Spam].
+  --spoolsize numbytes   Mails larger than this are kept in a temporary
+                         file while they are scanned. Use 0 to keep
+                         them in memory [default: 1000000].
   --nossl                Don't use SSL to connect to the IMAP server.
   --teachonly            Don't search spam, just learn from folders.
   --trackfile file       Override the trackfile name.
+  --trustspamheaders     Don't scan the mails with a X-Spam-Status
+                         header from the SpamAssassin of the server.
   --verbose              Show IMAP stuff happening.
   --verbose-mails        Show mail bodies (extra-verbose).
 
@@ -184,6 +230,7 @@ def parse_args(sbg):
 
     sbg.nostats = opts.get('--nostats', False)
     sbg.dryrun = opts.get('--dryrun', False)
+    sbg.daemon = opts.get('--daemon', False)
     sbg.delete = opts.get('--delete', False)
     sbg.gmail = opts.get('--gmail', False)
 
@@ -197,6 +244,23 @@ def parse_args(sbg):
             raise isbg.ISBGError(isbg.__exitcodes__['flags'],
                                  "Size " + repr(sbg.maxsize) + " is too small")
 
+    for opt in ['--actionbatch', '--fetchbatch', '--fetchbytes',
+                '--scan-workers', '--queuedepth', '--imappool', '--spoolsize',
+                '--learnbatch', '--scantimeout', '--runtimeout']:
+        try:
+            value = int(opts[opt])
+        except (TypeError, ValueError):
+            raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                                 "{} \'{}\' must be a integer".format(
+                                     opt, opts[opt]))
+        if value < 0 or (opt not in ['--actionbatch', '--fetchbytes',
+                                     '--spoolsize',
+                                     '--learnbatch', '--scantimeout',
+                                     '--runtimeout'] and value == 0):
+            raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                                 "{} {} is too small".format(opt, value))
+        setattr(sbg, opt[2:].replace('-', ''), value or None)
+
     sbg.movehamto = opts.get('--movehamto')
 
     if opts["--noninteractive"] is True:
@@ -229,6 +293,10 @@ def parse_args(sbg):
     sbg.passwdfilename = opts.get('--passwdfilename', sbg.passwdfilename)
 
     sbg.imaplist = opts.get('--imaplist', sbg.imaplist)
+    sbg.imapbackend = opts.get('--imapbackend', sbg.imapbackend)
+    if sbg.imapbackend not in imaputils.__backends__:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "Unknown IMAP backend - " + sbg.imapbackend)
 
     sbg.learnunflagged = opts.get('--learnunflagged', sbg.learnunflagged)
     sbg.learnflagged = opts.get('--learnflagged', sbg.learnflagged)
@@ -238,6 +306,14 @@ def parse_args(sbg):
 
     sbg.teachonly = opts.get('--teachonly', sbg.teachonly)
     sbg.spamc = opts.get('--spamc', sbg.spamc)
+    sbg.spamd = opts.get('--spamd', sbg.spamd)
+    sbg.spamdcompress = opts.get('--spamdcompress', sbg.spamdcompress)
+    sbg.trustspamheaders = opts.get('--trustspamheaders',
+                                    sbg.trustspamheaders)
+    sbg.scantruncated = opts.get('--scantruncated', sbg.scantruncated)
+    sbg.checkfirst = opts.get('--checkfirst', sbg.checkfirst)
+    sbg.concurrentpasses = opts.get('--concurrentpasses',
+                                    sbg.concurrentpasses)
 
     sbg.exitcodes = opts.get('--exitcodes', sbg.exitcodes)
 
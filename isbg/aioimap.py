@@ -0,0 +1,683 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  aioimap.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Asyncio IMAP client for isbg - IMAP Spam Begone.
+
+:py:class:`AioImap` is a *IMAP4rev1* connection for :py:mod:`asyncio`. Its
+commands are pipelined: every command is sent as soon as it is issued, and
+its untagged responses are the ones of its type received until the server
+completes it.
+Many connections, and many commands of every connection, share a event
+loop.
+
+:py:class:`IsbgAioImap4` is a synchronous proxy over it with the interface of
+:py:class:`isbg.imaputils.IsbgImap4`. It is used when the ``asyncio`` backend
+is selected in :py:func:`isbg.imaputils.login_imap`.
+
+Examples:
+    >>> import asyncio
+    >>> from isbg import aioimap
+    >>> async def count(host, user, passwd):
+    ...     imap = await aioimap.AioImap.open(host, 993)
+    ...     await imap.command('LOGIN', user, aioimap.quote(passwd))
+    ...     res = await asyncio.gather(imap.command('STATUS', 'INBOX',
+    ...                                            '(MESSAGES)'),
+    ...                                imap.command('STATUS', 'INBOX.Spam',
+    ...                                             '(MESSAGES)'))
+    ...     await imap.command('LOGOUT')
+    ...     return [r.untagged['STATUS'] for r in res]
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import asyncio
+import collections
+import concurrent.futures
+import imaplib
+import re
+import socket
+import ssl
+import threading
+import time
+
+from isbg import imaputils
+from isbg import utils
+from .imaputils import assertok, bytes_to_ascii
+
+#: The tag prefix of the commands.
+__tagprefix__ = b'ISBG'
+
+_TAGGED = re.compile(br'(?P<tag>' + __tagprefix__ +
+                     br'\d+) (?P<type>[A-Z]+) ?(?P<data>.*)', re.ASCII)
+
+#: The types of the untagged responses of the commands (or of the ``UID``
+#: commands) which don't change the state of the connection. The other
+#: commands get all the untagged responses received while they are running.
+_UNTAGGED = {'APPEND': (), 'COPY': (), 'EXPUNGE': ('EXPUNGE',),
+             'FETCH': ('FETCH',), 'LIST': ('LIST', 'STATUS'),
+             'MOVE': ('EXPUNGE', 'COPYUID'), 'SEARCH': ('SEARCH', 'ESEARCH'),
+             'SORT': ('SORT',), 'STATUS': ('STATUS',), 'STORE': ('FETCH',),
+             'THREAD': ('THREAD',)}
+
+#: A completed command: its status (``OK``, ``NO``...), the data of its
+#: tagged response (as a list) and its untagged responses, indexed by type.
+Response = collections.namedtuple('Response', ['typ', 'data', 'untagged'])
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def event_loop():
+    """Get the event loop shared by the connections.
+
+    It's created the first time and it runs forever in a daemon thread.
+
+    Returns:
+        asyncio.AbstractEventLoop: The event loop.
+
+    """
+    global _loop  # pylint: disable=global-statement
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever,
+                                      name='isbg-aioimap')
+            thread.daemon = True
+            thread.start()
+    return _loop
+
+
+def run(coro, timeout=None):
+    """Run a coroutine in the shared event loop and wait for its result.
+
+    Args:
+        coro (coroutine): The coroutine.
+        timeout (float, optional): Maximum time to wait, in seconds. Defaults
+            to the socket timeout (see :py:func:`socket.getdefaulttimeout`),
+            as the :py:mod:`imaplib` connections. If it's ``None`` too, it
+            waits forever.
+    Returns:
+        The result of the coroutine.
+    Raises:
+        socket.timeout: If the time expires. The coroutine is cancelled.
+
+    """
+    if timeout is None:
+        timeout = socket.getdefaulttimeout()
+    future = asyncio.run_coroutine_threadsafe(coro, event_loop())
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise socket.timeout("timed out after {} seconds".format(timeout))
+
+
+def quote(arg):
+    """Quote a string argument, as :py:mod:`imaplib` does with passwords."""
+    return '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class AioImap(object):
+    """A IMAP connection for asyncio, with pipelined commands.
+
+    Use :py:meth:`open` to create it.
+
+    Attributes:
+        capabilities (tuple): The capabilities of the server. They are
+            updated with every ``CAPABILITY`` response.
+        unsolicited (dict): The untagged responses received when there was
+            not any command running waiting for them.
+
+    """
+
+    error = imaplib.IMAP4.error
+    abort = imaplib.IMAP4.abort
+
+    def __init__(self, reader, writer):
+        """Initialize a AioImap object with its streams."""
+        self.reader, self.writer = (reader, writer)
+        self.capabilities = ()
+        self.unsolicited = {}
+        self._tagnum = 0
+        # tag -> (future, dict, types of its untagged responses)
+        self._pending = collections.OrderedDict()
+        self._send_lock = asyncio.Lock()
+        self._continuation = None
+        self._idle_lines = None
+        self._reader_task = None
+
+    @classmethod
+    async def open(cls, host, port=143, ssl_context=None):
+        """Connect with a IMAP server.
+
+        Args:
+            host (str): The server.
+            port (int): The port.
+            ssl_context (ssl.SSLContext, optional): If not ``None``, the
+                connection uses SSL.
+        Returns:
+            AioImap: The new connection.
+        Raises:
+            OSError: If the connection fails.
+            imaplib.IMAP4.error: If the server refuses the connection.
+
+        """
+        reader, writer = await asyncio.open_connection(host, port,
+                                                       ssl=ssl_context)
+        imap = cls(reader, writer)
+        greeting = (await reader.readline()).rstrip(b'\r\n')
+        if not re.match(br'\* (OK|PREAUTH)', greeting):
+            writer.close()
+            raise cls.error("unexpected greeting: {!r}".format(greeting))
+        code = imaplib.Response_code.search(greeting)
+        if code is not None and code.group('type') == b'CAPABILITY':
+            imap._set_capabilities(code.group('data'))
+        imap._reader_task = asyncio.ensure_future(imap._read_responses())
+        if not imap.capabilities:
+            await imap.command('CAPABILITY')
+        return imap
+
+    def _set_capabilities(self, data):
+        """Update the capabilities."""
+        self.capabilities = tuple(
+            utils.get_ascii_or_value(data or b'').upper().split())
+
+    def _append_untagged(self, typ, dat):
+        """Store a untagged response for the oldest command waiting for it.
+
+        A ``FETCH`` response is never stored for a ``SEARCH`` command, and so
+        on (see :py:data:`_UNTAGGED`).
+        """
+        if typ == 'CAPABILITY':
+            self._set_capabilities(dat)
+        for _, untagged, types in self._pending.values():
+            if types is None or typ in types:
+                break
+        else:
+            untagged = self.unsolicited
+        untagged.setdefault(typ, []).append(dat)
+
+    async def _readline(self):
+        """Read a line, without the line break."""
+        line = await self.reader.readline()
+        if not line:
+            raise self.abort("socket error: EOF")
+        return line.rstrip(b'\r\n')
+
+    async def _read_responses(self):
+        """Read the responses of the server until the connection ends.
+
+        They are parsed as :py:mod:`imaplib` does, so the data of the
+        responses have the same format.
+        """
+        try:
+            while True:
+                resp = await self._readline()
+                tagged = _TAGGED.match(resp)
+                if tagged is not None and tagged.group('tag') in self._pending:
+                    typ = tagged.group('type').decode('ascii')
+                    dat = tagged.group('data')
+                    future, untagged, _ = self._pending[tagged.group('tag')]
+                    code = imaplib.Response_code.match(dat)
+                    if typ in ('OK', 'NO', 'BAD') and code is not None:
+                        ctyp = code.group('type').decode('ascii')
+                        untagged.setdefault(ctyp, []).append(
+                            code.group('data'))
+                        if ctyp == 'CAPABILITY':
+                            self._set_capabilities(code.group('data'))
+                    del self._pending[tagged.group('tag')]
+                    if not future.done():
+                        future.set_result(Response(typ, [dat], untagged))
+                    continue
+                if resp.startswith(b'+'):
+                    if self._continuation is not None and \
+                            not self._continuation.done():
+                        self._continuation.set_result(resp[2:])
+                    continue
+                await self._read_untagged(resp)
+        except Exception as exc:  # pylint: disable=broad-except
+            if not isinstance(exc, self.abort):
+                exc = self.abort("socket error: {}".format(exc))
+            for future, _, _ in self._pending.values():
+                if not future.done():
+                    future.set_exception(exc)
+            self._pending.clear()
+            if self._continuation is not None and \
+                    not self._continuation.done():
+                self._continuation.set_exception(exc)
+
+    async def _read_untagged(self, resp):
+        """Read a untagged response, with its literals."""
+        dat2 = None
+        match = imaplib.Untagged_response.match(resp)
+        if match is None:
+            match = imaplib.Untagged_status.match(resp)
+            if match is not None:
+                dat2 = match.group('data2')
+        if match is None:
+            raise self.abort("unexpected response: {!r}".format(resp))
+        if self._idle_lines is not None:
+            self._idle_lines.put_nowait(resp)
+
+        typ = match.group('type').decode('ascii')
+        dat = match.group('data') or b''
+        if dat2:
+            dat = dat + b' ' + dat2
+        literal = imaplib.Literal.match(dat)
+        while literal is not None:
+            data = await self.reader.readexactly(int(literal.group('size')))
+            self._append_untagged(typ, (dat, data))
+            dat = await self._readline()  # the trailer
+            literal = imaplib.Literal.match(dat)
+        self._append_untagged(typ, dat)
+
+        code = imaplib.Response_code.match(dat)
+        if typ in ('OK', 'NO', 'BAD') and code is not None:
+            self._append_untagged(code.group('type').decode('ascii'),
+                                  code.group('data'))
+
+    async def _send(self, name, args, literal=None):
+        """Send a command and return the future of its response.
+
+        The commands are sent one after the other, but without waiting for
+        the responses of the previous ones. A synchronizing literal waits
+        for the continuation of the server: it's sent without it if the
+        server has *LITERAL+* (RFC 7888). `literal` can be a list of them,
+        sent one after the other (as the messages of a *MULTIAPPEND*).
+        """
+        loop = asyncio.get_event_loop()
+        async with self._send_lock:
+            self._tagnum += 1
+            tag = __tagprefix__ + str(self._tagnum).encode()
+            data = tag + b' ' + name.encode()
+            for arg in args:
+                if arg is None:
+                    continue
+                if not isinstance(arg, bytes):
+                    arg = str(arg).encode()
+                data = data + b' ' + arg
+            future = loop.create_future()
+            command = name.upper()
+            if command == 'UID' and args:
+                command = utils.get_ascii_or_value(args[0]).upper()
+            self._pending[tag] = (future, {}, _UNTAGGED.get(command))
+            if isinstance(literal, bytes):
+                literal = [literal]
+            for lit in literal or []:
+                if 'LITERAL+' in self.capabilities:
+                    self.writer.write(data + ' {{{}+}}\r\n'.format(
+                        len(lit)).encode() + lit)
+                    data = b''
+                    continue
+                self._continuation = loop.create_future()
+                self.writer.write(data + ' {{{}}}\r\n'.format(
+                    len(lit)).encode())
+                data = b''
+                await self.writer.drain()
+                await asyncio.wait([self._continuation, future],
+                                   return_when=asyncio.FIRST_COMPLETED)
+                self._continuation = None
+                if future.done():  # the server has refused it
+                    break
+                self.writer.write(lit)
+            if not future.done():
+                self.writer.write(data + b'\r\n')
+            await self.writer.drain()
+        return future
+
+    async def command(self, name, *args, **kwargs):
+        """Run a command and wait for its response.
+
+        Every call is pipelined with the calls done at the same time (with
+        :py:func:`asyncio.gather`, ...).
+
+        Args:
+            name (str): The command, as ``SELECT`` or ``UID``.
+            args: Its arguments. The ``None`` ones are skipped.
+            literal (bytes, optional): A literal sent after the arguments,
+                or a list of them.
+        Returns:
+            Response: The response of the server.
+        Raises:
+            imaplib.IMAP4.error: If the server answers with ``BAD``.
+            imaplib.IMAP4.abort: If the connection is closed.
+
+        """
+        res = await (await self._send(name, args, kwargs.get('literal')))
+        if res.typ == 'BAD':
+            raise self.error("{} command error: {} {}".format(
+                name, res.typ, res.data))
+        return res
+
+    async def idle(self, timeout=1740):
+        """Wait for changes in the selected mailbox using *IDLE*.
+
+        Other commands are not sent until it finishes.
+
+        Args:
+            timeout (float): Maximum time to wait, in seconds.
+        Returns:
+            list(bytes): The untagged responses received while idling.
+
+        """
+        responses = []
+        async with self._send_lock:
+            loop = asyncio.get_event_loop()
+            self._tagnum += 1
+            tag = __tagprefix__ + str(self._tagnum).encode()
+            future = loop.create_future()
+            self._pending[tag] = (future, {}, None)
+            self._continuation = loop.create_future()
+            self._idle_lines = asyncio.Queue()
+            try:
+                self.writer.write(tag + b' IDLE\r\n')
+                await self.writer.drain()
+                await asyncio.wait([self._continuation, future],
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if future.done():
+                    raise self.error("IDLE returned {}".format(
+                        future.result().typ))
+                self._continuation.result()
+                deadline = time.time() + timeout
+                while True:
+                    try:
+                        line = await asyncio.wait_for(
+                            self._idle_lines.get(),
+                            max(deadline - time.time(), 0))
+                    except asyncio.TimeoutError:
+                        break
+                    responses.append(line)
+                    if re.match(br'\* \d+ (EXISTS|RECENT)', line):
+                        break
+                self.writer.write(b'DONE\r\n')
+                await self.writer.drain()
+                await future
+                while not self._idle_lines.empty():
+                    responses.append(self._idle_lines.get_nowait())
+            finally:
+                self._continuation, self._idle_lines = (None, None)
+        return responses
+
+    async def close(self):
+        """Close the connection."""
+        self.writer.close()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+
+
+class IsbgAioImap4(imaputils.IsbgImap4):
+    """Proxy class with the interface of IsbgImap4 over a :py:class:`AioImap`.
+
+    Every method runs its command in the shared event loop (see
+    :py:func:`event_loop`) and waits for its response, which has the same
+    format than the :py:mod:`imaplib` ones.
+
+    The commands don't hold :py:attr:`lock`: the ones sent at the same time
+    by several threads are pipelined. :py:meth:`pipeline` sends several
+    commands at once from a single thread.
+
+    *COMPRESS* is not supported: :py:meth:`compress` refuses it.
+
+    """
+
+    def _open(self, host, port):
+        """Connect with the server.
+
+        Returns:
+            AioImap: The connection.
+
+        """
+        context = None
+        if not self.nossl:  # as imaplib.IMAP4_SSL
+            # pylint: disable=protected-access
+            context = ssl._create_stdlib_context()
+        return run(AioImap.open(host, port, context))
+
+    def _command(self, name, *args, **kwargs):
+        """Run a command and return its :py:class:`Response`."""
+        return run(self.imap.command(name, *args, **kwargs))
+
+    @staticmethod
+    def _untagged_response(res, name):
+        """Get the result of a command as :py:mod:`imaplib` does."""
+        if res.typ == 'NO':
+            return res.typ, res.data
+        return res.typ, res.untagged.get(name, [None])
+
+    def pipeline(self, commands):
+        """Send several commands at once and wait for all their responses.
+
+        Args:
+            commands (list): The commands, as tuples of its name and its
+                arguments.
+        Returns:
+            list(Response): The responses, in the same order.
+
+        """
+        async def _pipeline():
+            return await asyncio.gather(
+                *[self.imap.command(cmd[0], *cmd[1:]) for cmd in commands])
+        return run(_pipeline())
+
+    # @assertok('append')  <-- it fails in some servers
+    @bytes_to_ascii
+    def append(self, mailbox, flags, date_time, message):
+        """Append message to named mailbox."""
+        if flags:
+            if (flags[0], flags[-1]) != ('(', ')'):
+                flags = '({})'.format(flags)
+        else:
+            flags = None
+        if date_time:
+            date_time = imaplib.Time2Internaldate(date_time)
+        else:
+            date_time = None
+        self.selected = None
+        res = self._command('APPEND', mailbox or 'INBOX', flags, date_time,
+                            literal=imaplib.MapCRLF.sub(imaplib.CRLF,
+                                                        message))
+        return res.typ, res.data
+
+    @bytes_to_ascii
+    def append_messages(self, mailbox, messages):
+        """Append several messages to named mailbox with a single command.
+
+        See :py:meth:`isbg.imaputils.IsbgImap4.append_messages`.
+        """
+        self.selected = None
+        res = self._command('APPEND', mailbox, literal=[
+            imaplib.MapCRLF.sub(imaplib.CRLF, message)
+            for message in messages])
+        return res.typ, res.data
+
+    @assertok('cabability')
+    @bytes_to_ascii
+    def capability(self):
+        """Fetch capabilities list from server."""
+        return self._untagged_response(self._command('CAPABILITY'),
+                                       'CAPABILITY')
+
+    @assertok('expunge')
+    @bytes_to_ascii
+    def expunge(self):
+        """Permanently remove deleted items from selected mailbox."""
+        self.selected = None
+        return self._untagged_response(self._command('EXPUNGE'), 'EXPUNGE')
+
+    @assertok('list')
+    @bytes_to_ascii
+    def list(self, directory='""', pattern='*'):
+        """List mailbox names in directory matching pattern."""
+        return self._untagged_response(
+            self._command('LIST', directory, pattern), 'LIST')
+
+    @assertok('login')
+    @bytes_to_ascii
+    def login(self, user, passwd):
+        """Identify client using plain text password.
+
+        The capabilities are updated as in
+        :py:meth:`isbg.imaputils.IsbgImap4.login`.
+        """
+        res = self._command('LOGIN', quote(user), quote(passwd))
+        if res.typ == 'OK' and 'CAPABILITY' not in res.untagged:
+            self._command('CAPABILITY')
+        return res.typ, res.data
+
+    @assertok('logout')
+    @bytes_to_ascii
+    def logout(self):
+        """Shutdown connection to server."""
+        try:
+            res = self._command('LOGOUT')
+        finally:
+            run(self.imap.close())
+        if 'BYE' in res.untagged:
+            return 'BYE', res.untagged['BYE']
+        return res.typ, res.data
+
+    @assertok('status')
+    @bytes_to_ascii
+    def status(self, mailbox, names):
+        """Request named status conditions for mailbox."""
+        return self._untagged_response(
+            self._command('STATUS', mailbox, names), 'STATUS')
+
+    @assertok('select')
+    @bytes_to_ascii
+    def select(self, mailbox='INBOX', readonly=False, cached=False):
+        """Select a Mailbox.
+
+        The status codes sent by the server are kept in
+        :py:attr:`mailbox_info`. See
+        :py:meth:`isbg.imaputils.IsbgImap4.select` for `cached`.
+        """
+        if cached and self._is_selected(mailbox, readonly):
+            return 'OK', [str(self.mailbox_info.get('EXISTS', ''))]
+        res = self._command('EXAMINE' if readonly else 'SELECT', mailbox)
+        self.selected = (mailbox, readonly) if res.typ == 'OK' else None
+        self.mailbox_info = {}
+        for name in ['UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ', 'EXISTS']:
+            try:
+                self.mailbox_info[name] = int(res.untagged[name][-1])
+            except (KeyError, TypeError, ValueError, IndexError):
+                pass
+        if res.typ != 'OK':
+            return res.typ, res.data
+        return res.typ, res.untagged.get('EXISTS', [None])
+
+    @bytes_to_ascii
+    def uid_unchecked(self, command, *args):
+        """Execute a UID command without checking its result with assertok.
+
+        See :py:meth:`isbg.imaputils.IsbgImap4.uid_unchecked`.
+        """
+        command = command.upper()
+        if command not in ('FETCH', 'SEARCH', 'SORT', 'THREAD'):
+            self.selected = None
+        res = self._command('UID', command, *args)
+        if command in ('SEARCH', 'SORT', 'THREAD'):
+            return self._untagged_response(res, command)
+        return self._untagged_response(res, 'FETCH')
+
+    def enable_condstore(self):
+        """Enable *CONDSTORE* (RFC 7162) if the server has it."""
+        if not self.condstore and self.has_capability('ENABLE') and (
+                self.has_capability('CONDSTORE') or
+                self.has_capability('QRESYNC')):
+            res = self._command('ENABLE', 'CONDSTORE')
+            self.condstore = res.typ == 'OK'
+        return self.condstore
+
+    def compress(self):
+        """Refuse *COMPRESS*: it's not supported with asyncio.
+
+        The connection is never compressed: if the server has the
+        capability, :py:func:`isbg.imaputils.login_imap` logs it.
+
+        Returns:
+            bool: Always False.
+
+        """
+        return False
+
+    def idle(self, timeout=1740):
+        """Wait for changes in the selected mailbox using *IDLE*.
+
+        See :py:meth:`isbg.imaputils.IsbgImap4.idle`.
+        """
+        self.selected = None
+        sock_timeout = socket.getdefaulttimeout()
+        if sock_timeout is not None:
+            sock_timeout += timeout  # the socket timeout after the IDLE one
+        return utils.get_ascii_or_value(run(self.imap.idle(timeout),
+                                            sock_timeout))
+
+    def status_mailboxes(self, mailboxes, names):
+        """Get the status of several mailboxes at once.
+
+        As :py:meth:`isbg.imaputils.IsbgImap4.status_mailboxes`, but the
+        ``STATUS`` commands are pipelined.
+        """
+        if self.has_capability('LIST-STATUS'):
+            res = [self._command('LIST', '""',
+                                 self._list_status(mailboxes, names))]
+        else:
+            res = self.pipeline(
+                [('STATUS', mailbox, '({})'.format(' '.join(names)))
+                 for mailbox in mailboxes])
+        data = []
+        for response in res:
+            if response.typ == 'OK':
+                data.extend(response.untagged.get('STATUS', []))
+        return self._parse_status(data, mailboxes)
+
+    def get_uidvalidity(self, mailbox):
+        """Validate a mailbox.
+
+        As :py:meth:`isbg.imaputils.IsbgImap4.get_uidvalidity`, it uses the
+        ``SELECT`` response if `mailbox` is the selected one.
+
+        Args:
+            mailbox (str): the mailbox to check for its *uidvalidity*.
+
+        Returns:
+            int: The *uidvalidity* returned from the *imap* server. If it
+            cannot be decoded, it returns 0.
+
+        """
+        if self._is_selected(mailbox, True) and \
+                'UIDVALIDITY' in self.mailbox_info:
+            return self.mailbox_info['UIDVALIDITY']
+        uidvalidity = 0
+        typ, data = self._untagged_response(
+            self._command('STATUS', mailbox, '(UIDVALIDITY)'), 'STATUS')
+        if typ == 'OK' and data[0] is not None:
+            uidval = re.search('UIDVALIDITY ([0-9]+)', data[0].decode())
+            if uidval is not None:
+                uidvalidity = int(uidval.groups()[0])
+        return uidvalidity
@@ -28,40 +28,60 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
+import contextlib
 import email          # To easily encapsulated emails messages
 import email.message  # required for typing.TypeVar to work in py3
 import imaplib
+import mmap
+import os
 import re             # For regular expressions
+import select
 import socket         # to catch the socket.error exception
+import ssl
+import tempfile
+import threading
 import time
+import zlib
 
 from hashlib import md5
 
 from isbg import utils
 from .utils import __
 
-from typing import List, TypeVar, Union
+from typing import Iterator, List, TypeVar, Union  # noqa: F401
 
 Email = TypeVar(email.message.Message)
 Uid = Union[int, str]
 Uids = List[int]
 
+#: Maximum length of a *sequence-set* sent in one command. RFC 7162
+#: recommends that clients limit their command lines to 8192 octets.
+__seqset_maxlen__ = 8000
+
+#: The IMAP clients that can be used by :py:func:`login_imap`.
+__backends__ = ['imaplib', 'asyncio']
+
 
 def mail_content(mail):
     # type: (Email) -> AnyStr
     """Get the email message content.
 
     Args:
-        mail (email.message.Message): The email message.
+        mail (:obj:`email.message.Message` or :obj:`RawMessage`): The email
+            message.
 
     Returns:
         :obj:`bytes` or :obj:`str`: The contents, with headers, of the email
-        message. In python 3 it returns `bytes`.
+        message. In python 3 it returns `bytes`. The content of a
+        :py:class:`RawMessage` is returned as it was fetched.
 
     Raises:
         email.errors.MessageError:  if mail is neither *bytes* nor *str*.
 
     """
+    if isinstance(mail, RawMessage):
+        return mail.raw  # as fetched, without serializing it again
     if not isinstance(mail, email.message.Message):
         raise email.errors.MessageError(
             "mail '{}' is not a email.message.Message.".format(repr(mail)))
@@ -90,13 +110,16 @@ def new_message(body):
     """
     mail = None
 
+    # A body with only line breaks is empty, there is no need to parse and
+    # serialize it to know it:
+    if not body or not body.strip(b'\r\n' if isinstance(body, bytes)
+                                  else '\r\n'):
+        raise TypeError(
+            __("body '{}' cannot be empty.".format(repr(body))))
+
     if isinstance(body, bytes):
         try:
-            mail = email.message_from_bytes(body)  # pylint: disable=no-member
-            if mail.as_bytes() in [b'', b'\n']:
-                raise TypeError(
-                    __("body '{}' cannot be empty.".format(repr(body))))
-            return mail
+            return email.message_from_bytes(body)  # pylint: disable=no-member
         except AttributeError:  # py2
             pass
 
@@ -105,12 +128,172 @@ def new_message(body):
     except UnicodeEncodeError:
         body = body.encode("ascii", errors='replace')
         mail = email.message_from_string(body)
-    if mail.as_string() in ['', '\n']:
-        raise TypeError(
-            __("body '{}' cannot be empty.".format(repr(body))))
     return mail
 
 
+def mail_file(mail):
+    # type: (Email) -> Optional[IO[bytes]]
+    """Get the spool file of a email message.
+
+    Args:
+        mail (:obj:`email.message.Message` or :obj:`RawMessage`): The email
+            message.
+
+    Returns:
+        file: The file with the content of the message, positioned at its
+        start, or ``None`` if the message is not spooled.
+
+    """
+    if isinstance(mail, RawMessage) and mail.file is not None:
+        mail.file.seek(0)
+        return mail.file
+    return None
+
+
+@contextlib.contextmanager
+def mail_buffer(mail):
+    # type: (Email) -> Iterator[AnyStr]
+    """Get the email message content, without reading the spooled ones.
+
+    It's a context manager: the map of a spooled message is closed when it
+    exits.
+
+    Example:
+        >>> with mail_buffer(mail) as content:
+        ...     unwrapped = sa_unwrap.unwrap(content)
+
+    Args:
+        mail (:obj:`email.message.Message` or :obj:`RawMessage`): The email
+            message.
+
+    Yields:
+        :obj:`bytes` or :obj:`mmap.mmap`: As :py:func:`mail_content`, but the
+        spooled messages are mapped in memory from their file.
+
+    """
+    if not isinstance(mail, RawMessage):
+        yield mail_content(mail)
+        return
+    content = mail.buffer()
+    try:
+        yield content
+    finally:
+        if isinstance(content, mmap.mmap):
+            content.close()
+
+
+def spool_file():
+    # type: () -> IO[bytes]
+    """Create a anonymous file, removed when it's closed.
+
+    It's a *memfd* file when the system supports it, else a temporary file.
+    """
+    if hasattr(os, 'memfd_create'):
+        try:
+            return os.fdopen(os.memfd_create('isbg'), 'w+b')
+        except OSError:
+            pass
+    return tempfile.TemporaryFile()
+
+
+class RawMessage(object):
+    """A email message kept as the raw bytes fetched from the server.
+
+    The scanners only need the content of the mails, so it is forwarded as it
+    was received. The :obj:`email.message.Message` is only parsed the first
+    time that it is needed (to read a header, to unwrap it, ...): the
+    attributes not defined here are taken from it.
+
+    The messages bigger than `spoolsize` are written to a anonymous file
+    (see :py:func:`spool_file`), and they are passed to the scanners using
+    it, instead of keeping them in memory.
+
+    Args:
+        raw (:obj:`bytes` or :obj:`str`): The content, with headers, of the
+            email message.
+        spoolsize (int, optional): If not ``None``, the size of the biggest
+            message kept in memory. Defaults to ``None``.
+
+    Attributes:
+        file (file): The spool file, or ``None`` if it's kept in memory.
+
+    Raises:
+        TypeError: If the content is empty.
+
+    """
+
+    def __init__(self, raw, spoolsize=None):
+        """Initialize a RawMessage object."""
+        if not isinstance(raw, bytes):
+            raw = raw.encode('utf-8', errors='replace')
+        if not raw.strip(b'\r\n'):
+            raise TypeError(
+                __("body '{}' cannot be empty.".format(repr(raw))))
+        self.file = None
+        self._raw = raw
+        self._size = len(raw)
+        self._message = None
+        if spoolsize and len(raw) > spoolsize:
+            self.file = spool_file()
+            self.file.write(raw)
+            self.file.flush()
+            self._raw = None
+
+    @property
+    def raw(self):
+        """bytes: The content. The spooled ones are read from its file."""
+        if self._raw is None:
+            return self.buffer()[:]
+        return self._raw
+
+    def buffer(self):
+        """Get the content, mapped in memory if it is spooled.
+
+        Returns:
+            :obj:`bytes` or :obj:`mmap.mmap`: The content. The map is
+            read-only, it should be closed once used (see
+            :py:func:`mail_buffer`).
+
+        """
+        if self._raw is None:
+            return mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._raw
+
+    @property
+    def message(self):
+        """email.message.Message: The parsed message."""
+        if self._message is None:
+            self._message = new_message(self.raw)
+        return self._message
+
+    def as_bytes(self):
+        """Return the content of the message, as it was fetched."""
+        return self.raw
+
+    def __getattr__(self, name):
+        """Get the attributes of the parsed message."""
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.message, name)
+
+    def __getitem__(self, name):
+        """Get a header of the parsed message."""
+        return self.message[name]
+
+    def __contains__(self, name):
+        """Check if the parsed message has a header."""
+        return name in self.message
+
+    def __len__(self):
+        """Return the size of the content."""
+        return self._size
+
+    def __repr__(self):
+        """Return a representation of the message."""
+        return "RawMessage({} bytes{})".format(
+            self._size, ", spooled" if self.file is not None else "")
+
+
 def get_message(imap, uid, append_to=None, logger=None):
     # type: (IsbgImap4, Uid, Optional[Uids], Optional[logging.Logger]) -> Email
     """Get a message by *uid* and optionally append it to a list.
@@ -125,7 +308,8 @@ def get_message(imap, uid, append_to=None, logger=None):
             mail a warning is written to this logger. Defaults to *None*.
 
     Returns:
-        email.message.Message: The message fetched from the *imap* connection.
+        RawMessage: The message fetched from the *imap* connection. It's a
+        empty :obj:`email.message.Message` if it cannot be fetched.
 
     """
     res = imap.uid("FETCH", uid, "(BODY.PEEK[])")
@@ -133,14 +317,14 @@ def get_message(imap, uid, append_to=None, logger=None):
     if res[0] != "OK":
         try:
             body = res[1][0][1]
-            mail = new_message(body)
+            mail = RawMessage(body)
         except Exception:  # pylint: disable=broad-except
             logger.warning(__(
                 ("Confused - rfc822 fetch gave {} - The message was " +
                  "probably deleted while we were running").format(res)))
     else:
         body = res[1][0][1]
-        mail = new_message(body)
+        mail = RawMessage(body)
 
     if append_to is not None:
         append_to.append(int(uid))
@@ -148,6 +332,283 @@ def get_message(imap, uid, append_to=None, logger=None):
     return mail
 
 
+def _fetch_uid(text):
+    # type: (AnyStr) -> Optional[str]
+    """Get the *uid* from a line of a ``FETCH`` response, if present."""
+    if isinstance(text, bytes):
+        text = text.decode('ascii', errors='ignore')
+    found = re.search(r'UID (\d+)', text)
+    if found is None:
+        return None
+    return found.group(1)
+
+
+def get_sizes(imap, uids):
+    # type: (IsbgImap4, List[Uid]) -> Dict[str, int]
+    """Get the *RFC822.SIZE* of a list of messages with one ``UID FETCH``.
+
+    Args:
+        imap (IsbgImap4): The imap helper object with the connection.
+        uids (:obj:`list` of :obj:`str`): The *uids* of the messages.
+
+    Returns:
+        dict: The size of every message found, indexed by its *uid*.
+
+    """
+    sizes = {}
+    if not uids:
+        return sizes
+    res = imap.uid("FETCH", ",".join(str(u) for u in uids), "(RFC822.SIZE)")
+    if res[0] != "OK":
+        return sizes
+    for line in res[1]:
+        if isinstance(line, tuple):
+            line = line[0]
+        if not line:
+            continue
+        if isinstance(line, bytes):
+            line = line.decode('ascii', errors='ignore')
+        uid = _fetch_uid(line)
+        size = re.search(r'RFC822\.SIZE (\d+)', line)
+        if uid is not None and size is not None:
+            sizes[uid] = int(size.group(1))
+    return sizes
+
+
+def prefetch(imap, uids, fields=()):
+    # type: (IsbgImap4, List[Uid], List[str]) -> Dict[str, Dict]
+    """Get the size, the flags and some headers of a list of messages.
+
+    They are requested with one ``UID FETCH`` for every *sequence-set* of
+    `uids` (usually only one), without downloading the message bodies.
+
+    Args:
+        imap (IsbgImap4): The imap helper object with the connection.
+        uids (:obj:`list` of :obj:`str`): The *uids* of the messages.
+        fields (list(str)): The header fields to get.
+
+    Returns:
+        dict: Indexed by the *uid* of every message found, a dict with its
+        ``size`` (int), its ``flags`` (list of str) and its ``headers``
+        (a :py:class:`email.message.Message` without body).
+
+    """
+    items = "RFC822.SIZE FLAGS"
+    if fields:
+        items += " BODY.PEEK[HEADER.FIELDS ({})]".format(" ".join(fields))
+    info = {}
+    for seqset in sequence_sets(uids):
+        res = imap.uid("FETCH", seqset, "({})".format(items))
+        if res[0] != "OK":
+            continue
+        lines = list(res[1])
+        for num, line in enumerate(lines):
+            if isinstance(line, tuple):
+                meta, header = line[0], line[1]
+                # The items after the literal are in the next line
+                if num + 1 < len(lines) and \
+                        not isinstance(lines[num + 1], tuple):
+                    meta = meta + lines[num + 1]
+            elif line and line not in [')', b')']:
+                meta, header = line, b''
+            else:
+                continue
+            if isinstance(meta, bytes):
+                meta = meta.decode('ascii', errors='ignore')
+            if isinstance(header, bytes):
+                header = header.decode('utf-8', errors='replace')
+            uid = _fetch_uid(meta)
+            if uid is None:
+                continue
+            size = re.search(r'RFC822\.SIZE (\d+)', meta)
+            flags = re.search(r'FLAGS \(([^)]*)\)', meta)
+            info[uid] = {
+                'size': int(size.group(1)) if size else None,
+                'flags': flags.group(1).split() if flags else [],
+                'headers': email.message_from_string(header),
+            }
+    return info
+
+
+def fetch_batches(uids, batchsize, batchbytes=None, sizes=None):
+    # type: (List[Uid], int, Optional[int], Optional[Dict]) -> List[List[str]]
+    """Split a list of *uids* in batches to be fetched together.
+
+    A batch is closed when it has `batchsize` *uids* or when the sum of the
+    sizes of its messages reaches `batchbytes`. A message bigger than
+    `batchbytes` is fetched alone.
+
+    Args:
+        uids (:obj:`list` of :obj:`str`): The *uids* to split.
+        batchsize (int): Maximum number of *uids* in a batch. If it's
+            ``None`` or lower than 1, only `batchbytes` is used.
+        batchbytes (int, optional): Maximum sum of sizes of the messages of
+            a batch. Defaults to ``None`` (no limit).
+        sizes (dict, optional): The size of the messages indexed by *uid*,
+            as returned by :py:func:`get_sizes`. Unknown sizes count as 0.
+
+    Returns:
+        list(list(str)): The batches.
+
+    """
+    batches = []
+    batch, total = [], 0
+    for uid in uids:
+        size = (sizes or {}).get(str(uid), 0)
+        if batch and batchbytes and total + size > batchbytes:
+            batches.append(batch)
+            batch, total = [], 0
+        batch.append(str(uid))
+        total += size
+        if batchsize and batchsize > 0 and len(batch) >= batchsize:
+            batches.append(batch)
+            batch, total = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def get_messages(imap, uids, batchsize=25, batchbytes=None, append_to=None,
+                 logger=None, sizes=None, maxbytes=None, spoolsize=None):
+    # type: (IsbgImap4, List[Uid], int, Optional[int], Optional[Uids],
+    #        Optional[logging.Logger]) -> Iterator[Tuple[str, Email]]
+    """Get messages by *uid* using multi-message ``UID FETCH`` commands.
+
+    It is the batched version of :py:func:`get_message`: the *uids* are
+    requested as a comma separated *sequence-set*, so fetching `batchsize`
+    messages costs only one round trip to the *imap* server.
+
+    Args:
+        imap (IsbgImap4): The imap helper object with the connection.
+        uids (:obj:`list` of :obj:`str`): The *uids* of the messages to
+            fetch from the *imap* connection.
+        batchsize (int): The number of messages fetched by every command.
+            Defaults to 25.
+        batchbytes (int, optional): If not ``None``, the cumulative
+            *RFC822.SIZE* of the messages fetched by every command. The sizes
+            are requested with one extra ``UID FETCH``. Defaults to ``None``.
+        append_to (:obj:`list` of :obj:`int`), optional): The integer value of
+            every *uid* is appended to this list. Defaults to *None*.
+        logger (logging.Logger, optional): When a message is not returned by
+            the server a warning is written to this logger. Defaults to
+            *None*.
+        sizes (dict, optional): The sizes of the messages, if they are
+            known, as returned by :py:func:`get_sizes`. Defaults to *None*.
+        maxbytes (int, optional): If not *None*, only the first `maxbytes`
+            bytes of every message are fetched (``BODY.PEEK[]<0.maxbytes>``).
+            Defaults to *None*.
+        spoolsize (int, optional): If not *None*, the messages bigger than it
+            are spooled to a file as soon as they are received (see
+            :py:class:`RawMessage`). Defaults to *None*.
+
+    Yields:
+        tuple(str, RawMessage): The *uid* and the message fetched from the
+        *imap* connection, as soon as its batch is received. The messages
+        not returned by the server are empty :obj:`email.message.Message`.
+
+    """
+    uids = [str(u) for u in uids]  # the caller may change its list
+    if batchbytes and sizes is None:
+        sizes = get_sizes(imap, uids)
+    items = "(BODY.PEEK[])"
+    if maxbytes:
+        items = "(BODY.PEEK[]<0.{}>)".format(maxbytes)
+        sizes = dict((u, min(size, maxbytes))
+                     for u, size in (sizes or {}).items())
+
+    for batch in fetch_batches(uids, batchsize, batchbytes, sizes):
+        res = imap.uid("FETCH", ",".join(batch), items)
+        found = set()
+        pending, body = None, None
+        data = res[1] if res[0] == "OK" else []
+        for index, item in enumerate(data):
+            data[index] = None  # don't keep the fetched messages
+            if isinstance(item, tuple):
+                pending = _fetch_uid(item[0])
+                body = item[1]
+                if pending is None:
+                    continue  # the UID comes after the literal
+            elif pending is None and item and body is not None:
+                pending = _fetch_uid(item)
+            else:
+                continue
+            if pending is not None and pending not in found:
+                try:
+                    mail = RawMessage(body, spoolsize)
+                except Exception:  # pylint: disable=broad-except
+                    mail = email.message.Message()
+                found.add(pending)
+                if append_to is not None:
+                    append_to.append(int(pending))
+                yield pending, mail
+            pending, body = None, None
+
+        for uid in batch:
+            if uid not in found:
+                if logger:
+                    logger.warning(__(
+                        ("Confused - rfc822 fetch gave {} for {} - The " +
+                         "message was probably deleted while we were " +
+                         "running").format(res[0], uid)))
+                if append_to is not None:
+                    append_to.append(int(uid))
+                yield uid, email.message.Message()  # an empty email
+
+
+def sequence_sets(uids, maxlen=__seqset_maxlen__):
+    # type: (List[Uid], Optional[int]) -> List[str]
+    """Convert a list of *uids* to compact *sequence-sets*.
+
+    The consecutive *uids* are joined in ranges, as ``1:5,9,12:40``. The
+    *sequence-sets* are split to not be longer than `maxlen`, so every one
+    can be sent in a single command.
+
+    Args:
+        uids (:obj:`list` of :obj:`str`): The *uids*, in any order.
+        maxlen (int, optional): The maximum length of a *sequence-set*. If
+            it's ``None`` all the *uids* are returned in one of them.
+
+    Returns:
+        list(str): The *sequence-sets*. It's empty if `uids` is empty.
+
+    Examples:
+        >>> sequence_sets(['3', 1, 2, 4, 9, 11, 12])
+        ['1:4,9,11,12']
+
+    """
+    nums = sorted(set(int(u) for u in uids))
+    parts = []
+    i = 0
+    while i < len(nums):
+        j = i
+        while j + 1 < len(nums) and nums[j + 1] == nums[j] + 1:
+            j += 1
+        if j - i >= 2:
+            parts.append("{}:{}".format(nums[i], nums[j]))
+        else:  # 'a:b' is not shorter than 'a,b'
+            parts.extend(str(n) for n in nums[i:j + 1])
+        i = j + 1
+
+    sets, current = [], ''
+    for part in parts:
+        if current and maxlen and len(current) + len(part) + 1 > maxlen:
+            sets.append(current)
+            current = ''
+        current = current + ',' + part if current else part
+    if current:
+        sets.append(current)
+    return sets
+
+
+def _in_sequence_set(uid, seqset):
+    """Check if `uid` is in a *sequence-set* without ``*``."""
+    for part in seqset.split(','):
+        first, _, last = part.partition(':')
+        if int(first) <= int(uid) <= int(last or first):
+            return True
+    return False
+
+
 def imapflags(flaglist):
     # type: (List[str]) -> str
     """Transform a list to a string as expected for the IMAP4 standard.
@@ -173,6 +634,14 @@ def bytes_to_ascii(func):
     return func_wrapper
 
 
+def synchronized(func):
+    """Decorate a method to run it holding the connection lock."""
+    def func_wrapper(cls, *args, **kwargs):
+        with cls.lock:
+            return func(cls, *args, **kwargs)
+    return func_wrapper
+
+
 def assertok(name):
     """Decorate with *assertok*."""
     def assertok_decorator(func):
@@ -184,12 +653,113 @@ def assertok(name):
                 elif name == 'uid':
                     cls.assertok(res, name + " " + args[0], args[1:])
                 else:
-                    cls.assertok(res, name, *args, **kwargs)
+                    cls.assertok(res, name, *args)
             return res
         return func_wrapper
     return assertok_decorator
 
 
+class GreetingCapabilities(object):
+    """Mixin for :obj:`imaplib.IMAP4` using the capabilities of the greeting.
+
+    :py:mod:`imaplib` always sends a ``CAPABILITY`` command once connected.
+    It's not needed if the server sends them with its greeting.
+    """
+
+    def _get_capabilities(self):
+        caps = self.untagged_responses.pop('CAPABILITY', None)
+        if not caps or not caps[-1]:
+            # pylint: disable=no-member
+            return super(GreetingCapabilities, self)._get_capabilities()
+        self.capabilities = tuple(
+            utils.get_ascii_or_value(caps[-1]).upper().split())
+        return None
+
+
+class Imap4(GreetingCapabilities, imaplib.IMAP4):
+    """A :obj:`imaplib.IMAP4` using the capabilities of the greeting."""
+
+
+class Imap4SSL(GreetingCapabilities, imaplib.IMAP4_SSL):
+    """A :obj:`imaplib.IMAP4_SSL` using the capabilities of the greeting."""
+
+
+class DeflateStream(object):
+    """The *COMPRESS=DEFLATE* (RFC 4978) transport of a IMAP connection.
+
+    It replaces the ``read``, ``readline`` and ``send`` methods of a
+    :obj:`imaplib.IMAP4` object, compressing and decompressing with raw
+    *deflate*, and counts the bytes sent and received.
+
+    Args:
+        imap (imaplib.IMAP4): The connection, just after the ``COMPRESS``
+            command.
+
+    Attributes:
+        wire_in (int): Compressed bytes received.
+        wire_out (int): Compressed bytes sent.
+        data_in (int): Bytes received, once decompressed.
+        data_out (int): Bytes sent, before compressing them.
+
+    """
+
+    def __init__(self, imap):
+        """Initialize the streams and install them in `imap`."""
+        self.imap = imap
+        self.wire_in, self.wire_out, self.data_in, self.data_out = (0, 0, 0, 0)
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                            zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+        self._buffer = bytearray()
+        imap.read, imap.readline, imap.send = (self.read, self.readline,
+                                               self.send)
+
+    def _fill(self):
+        """Read and decompress the data available in the socket."""
+        data = self.imap.file.read1(65536)
+        if not data:
+            return False
+        self.wire_in += len(data)
+        data = self._decompressor.decompress(data)
+        self.data_in += len(data)
+        self._buffer += data
+        return True
+
+    def pending(self):
+        """Check if there are decompressed bytes waiting to be read."""
+        return len(self._buffer) > 0
+
+    def read(self, size):
+        """Read `size` bytes from the server."""
+        while len(self._buffer) < size and self._fill():
+            pass
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self):
+        """Read a line from the server."""
+        start = 0
+        while True:
+            end = self._buffer.find(b'\n', start)
+            if end >= 0:
+                return self.read(end + 1)
+            start = len(self._buffer)
+            if start > imaplib._MAXLINE:  # pylint: disable=protected-access
+                raise self.imap.error("got more than {} bytes".format(
+                    imaplib._MAXLINE))  # pylint: disable=protected-access
+            if not self._fill():
+                return self.read(len(self._buffer))
+
+    def send(self, data):
+        """Compress and send `data` to the server."""
+        self.data_out += len(data)
+        data = self._compressor.compress(data) + \
+            self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.wire_out += len(data)
+        self.imap.sock.sendall(data)
+
+
 class IsbgImap4(object):
     """Proxy class for :obj:`imaplib.IMAP4` and :obj:`imaplib.IMAP4_SSL`.
 
@@ -200,74 +770,416 @@ class IsbgImap4(object):
     The only original method is ``get_uidvalidity``, used to return the current
     *uidvalidity* from a mailbox.
 
+    The capabilities of the server are cached: the ones of the greeting and,
+    once logged in, the ones sent with the ``LOGIN`` response (or asked with
+    a ``CAPABILITY`` command, if the server doesn't send them). The selected
+    mailbox is tracked too, so selecting it again can be avoided (see
+    :py:meth:`select`).
+
+    Every command holds :py:attr:`lock`, so the connection can be shared by
+    the threads of the fetch and action stages of
+    :py:meth:`isbg.spamproc.SpamAssassin.process_inbox`.
+
     """
 
     def __init__(self, host='', port=143, nossl=False, assertok=None):
         """Create a imaplib.IMAP4[_SSL] with an assertok method."""
         self.assertok = assertok
         self.nossl = nossl
-        if nossl:
-            self.imap = imaplib.IMAP4(host, port)
-        else:
-            self.imap = imaplib.IMAP4_SSL(host, port)
+        self.lock = threading.RLock()  #: Lock held by every command.
+        #: The status codes of the last selected mailbox.
+        self.mailbox_info = {}
+        #: The selected mailbox and if it's read-only, as a tuple. It's
+        #: ``None`` if it's unknown or it could have changed.
+        self.selected = None
+        #: True if *CONDSTORE* has been enabled.
+        self.condstore = False
+        #: The :py:class:`DeflateStream` if *COMPRESS* is enabled.
+        self.compression = None
+        self.imap = self._open(host, port)
+
+    def _open(self, host, port):
+        """Connect with the server.
+
+        Returns:
+            imaplib.IMAP4: The connection, a :obj:`Imap4` or a
+            :obj:`Imap4SSL`.
+
+        """
+        if self.nossl:
+            return Imap4(host, port)
+        return Imap4SSL(host, port)
 
     # @assertok('append')  <-- it fails in some servers
+    @synchronized
     @bytes_to_ascii
     def append(self, mailbox, flags, date_time, message):
         """Append message to named mailbox."""
+        self.selected = None
         return self.imap.append(mailbox, flags, date_time, message)
 
+    @synchronized
+    @bytes_to_ascii
+    def append_messages(self, mailbox, messages):
+        """Append several messages to named mailbox with a single command.
+
+        The server should have *MULTIAPPEND* (RFC 3502): all the messages
+        are appended, or none of them. If it has *LITERAL+* (RFC 7888) too,
+        the messages are sent without waiting for the server continuations.
+
+        Args:
+            mailbox (str): The mailbox.
+            messages (list(bytes)): The messages.
+        Returns:
+            (str, list): The result of the ``APPEND``, as :py:meth:`append`.
+
+        """
+        # pylint: disable=protected-access
+        self.selected = None
+        imap = self.imap
+        literalplus = self.has_capability('LITERAL+')
+        tag = imap._new_tag()
+        data = tag + b' APPEND ' + mailbox.encode()
+        for message in messages:
+            message = imaplib.MapCRLF.sub(imaplib.CRLF, message)
+            data += ' {{{}{}}}\r\n'.format(
+                len(message), '+' if literalplus else '').encode()
+            if not literalplus:
+                imap.send(data)
+                data = b''
+                while imap._get_response():
+                    if imap.tagged_commands[tag]:  # refused
+                        return imap._command_complete('APPEND', tag)
+            imap.send(data + message)
+            data = b''
+        imap.send(b'\r\n')
+        return imap._command_complete('APPEND', tag)
+
     @assertok('cabability')
+    @synchronized
     @bytes_to_ascii
     def capability(self):
-        """Fetch capabilities list from server."""
-        return self.imap.capability()
+        """Fetch capabilities list from server, updating the cached one."""
+        res = self.imap.capability()
+        if res[0] == 'OK' and res[1][-1]:
+            self.imap.capabilities = tuple(
+                utils.get_ascii_or_value(res[1][-1]).upper().split())
+        return res
 
     @assertok('expunge')
+    @synchronized
     @bytes_to_ascii
     def expunge(self):
         """Permanently remove deleted items from selected mailbox."""
+        self.selected = None
         return self.imap.expunge()
 
     @assertok('list')
+    @synchronized
     @bytes_to_ascii
     def list(self, directory='""', pattern='*'):
         """List mailbox names in directory matching pattern."""
         return self.imap.list(directory, pattern)
 
     @assertok('login')
+    @synchronized
     @bytes_to_ascii
     def login(self, user, passwd):
-        """Identify client using plain text password."""
-        return self.imap.login(user, passwd)
+        """Identify client using plain text password.
+
+        Servers usually advertise more capabilities once logged in, if they
+        are sent with the response they replace the previous ones. If not,
+        they are asked with a ``CAPABILITY`` command.
+        """
+        res = self.imap.login(user, passwd)
+        caps = self.imap.untagged_responses.pop('CAPABILITY', None)
+        if caps:
+            self.imap.capabilities = tuple(
+                utils.get_ascii_or_value(caps[-1]).upper().split())
+        elif res[0] == 'OK':
+            self.capability()
+        return res
 
     @assertok('logout')
+    @synchronized
     @bytes_to_ascii
     def logout(self):
         """Shutdown connection to server."""
         return self.imap.logout()
 
     @assertok('status')
+    @synchronized
     @bytes_to_ascii
     def status(self, mailbox, names):
         """Request named status conditions for mailbox."""
         return self.imap.status(mailbox, names)
 
     @assertok('select')
+    @synchronized
     @bytes_to_ascii
-    def select(self, mailbox='INBOX', readonly=False):
-        """Select a Mailbox."""
-        return self.imap.select(mailbox, readonly)
+    def select(self, mailbox='INBOX', readonly=False, cached=False):
+        """Select a Mailbox.
+
+        The status codes sent by the server (``UIDVALIDITY``, ``UIDNEXT``,
+        ``HIGHESTMODSEQ``...) are kept in :py:attr:`mailbox_info`.
+
+        If `cached` is True and `mailbox` is already selected (read-write, or
+        read-only if `readonly`) and not changed by us since then, the command
+        is not sent again.
+        """
+        if cached and self._is_selected(mailbox, readonly):
+            return 'OK', [str(self.mailbox_info.get('EXISTS', ''))]
+        res = self.imap.select(mailbox, readonly)
+        self.selected = (mailbox, readonly) if res[0] == 'OK' else None
+        self.mailbox_info = {}
+        for name in ['UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ', 'EXISTS']:
+            values = self.imap.untagged_responses.get(name)
+            try:
+                self.mailbox_info[name] = int(values[-1])
+            except (TypeError, ValueError, IndexError):
+                pass
+        return res
 
     @assertok('uid')
-    @bytes_to_ascii
     def uid(self, command, *args):
         """Execute "command arg ..." with messages identified by UID."""
+        return self.uid_unchecked(command, *args)
+
+    @synchronized
+    @bytes_to_ascii
+    def uid_unchecked(self, command, *args):
+        """Execute a UID command without checking its result with assertok.
+
+        It's used by :py:class:`ImapActions`, which reports the refused
+        actions and goes on with the other ones.
+        """
+        if command.upper() not in ('FETCH', 'SEARCH', 'SORT', 'THREAD'):
+            self.selected = None
         return self.imap.uid(command, *args)
 
+    def _is_selected(self, mailbox, readonly=False):
+        """Check if `mailbox` is selected, read-write or `readonly`."""
+        return self.selected is not None and \
+            self.selected[0] == mailbox and (readonly or not self.selected[1])
+
+    @property
+    def capabilities(self):
+        """tuple(str): The cached capabilities of the server."""
+        return tuple(utils.get_ascii_or_value(c).upper()
+                     for c in self.imap.capabilities)
+
+    def has_capability(self, name):
+        """Check if the server advertises a capability.
+
+        Args:
+            name (str): The capability name, as ``IDLE``.
+
+        Returns:
+            bool: True if the server has the capability.
+
+        """
+        return name.upper() in self.capabilities
+
+    def enable_condstore(self):
+        """Enable *CONDSTORE* (RFC 7162) if the server has it.
+
+        Once enabled, the server reports the ``HIGHESTMODSEQ`` of every
+        selected mailbox and the ``uids`` can be searched by ``MODSEQ``.
+
+        Returns:
+            bool: True if *CONDSTORE* is enabled.
+
+        """
+        if not self.condstore and self.has_capability('ENABLE') and (
+                self.has_capability('CONDSTORE') or
+                self.has_capability('QRESYNC')):
+            with self.lock:
+                typ, _ = self.imap.enable('CONDSTORE')
+            self.condstore = utils.get_ascii_or_value(typ) == 'OK'
+        return self.condstore
+
+    def compress(self):
+        """Compress the connection with *COMPRESS=DEFLATE* (RFC 4978).
+
+        It's only done if the server has the capability.
+
+        Returns:
+            bool: True if the connection is compressed.
+
+        """
+        if self.compression is None and \
+                self.has_capability('COMPRESS=DEFLATE'):
+            imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+            with self.lock:
+                # pylint: disable=protected-access
+                typ, _ = self.imap._simple_command('COMPRESS', 'DEFLATE')
+                if typ == 'OK':
+                    self.compression = DeflateStream(self.imap)
+        return self.compression is not None
+
+    def _buffered(self):
+        """Check if there is data waiting in the buffer of :py:mod:`imaplib`.
+
+        The buffer is peeked without blocking: if it's empty, only the data
+        already received by the socket is read.
+        """
+        sock = self.imap.sock
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return bool(self.imap.file.peek(1))
+        except (ssl.SSLWantReadError, BlockingIOError):
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+    def _readable(self, timeout):
+        """Wait until there is data to read from the server."""
+        if self.compression is not None and self.compression.pending():
+            return True  # decompressed data waiting
+        sock = self.imap.sock
+        if hasattr(sock, 'pending') and sock.pending():
+            return True  # decrypted data waiting in the ssl layer
+        if self._buffered():
+            return True  # data read with the last line, not returned yet
+        ready, _, _ = select.select([sock], [], [], max(timeout, 0))
+        return bool(ready)
+
+    def idle(self, timeout=1740):
+        """Wait for changes in the selected mailbox using *IDLE* (RFC 2177).
+
+        It returns as soon as the server reports new messages (``EXISTS`` or
+        ``RECENT``) or when `timeout` expires.
+
+        Args:
+            timeout (float): Maximum time to wait, in seconds. Defaults to
+                29 minutes, as recommended by the RFC.
+
+        Returns:
+            list(str): The untagged responses received while idling. It is
+            empty if `timeout` has expired without changes.
+
+        Raises:
+            imaplib.IMAP4.error: If the server refuses the *IDLE* command.
+            imaplib.IMAP4.abort: If the connection is closed.
+
+        """
+        responses = []
+        with self.lock:
+            self.selected = None
+            tag = self.imap._new_tag()  # pylint: disable=protected-access
+            self.imap.tagged_commands.pop(tag, None)
+            self.imap.send(tag + b' IDLE\r\n')
+            line = self.imap.readline()
+            while line.startswith(b'* '):
+                # untagged responses sent before the continuation
+                responses.append(line.strip())
+                line = self.imap.readline()
+            if not line:
+                raise self.imap.abort("socket closed while idling")
+            if not line.startswith(b'+'):
+                raise self.imap.error("IDLE returned {}".format(line))
+            deadline = time.time() + timeout
+            changed = any(re.match(br'\* \d+ (EXISTS|RECENT)', r)
+                          for r in responses)
+            try:
+                while not changed and self._readable(deadline - time.time()):
+                    line = self.imap.readline()
+                    if not line:
+                        raise self.imap.abort("socket closed while idling")
+                    responses.append(line.strip())
+                    changed = re.match(br'\* \d+ (EXISTS|RECENT)',
+                                       line) is not None
+            finally:
+                self.imap.send(b'DONE\r\n')
+                while True:
+                    line = self.imap.readline()
+                    if not line:
+                        raise self.imap.abort("socket closed while idling")
+                    if line.startswith(tag):
+                        break
+                    responses.append(line.strip())
+        return utils.get_ascii_or_value(responses)
+
+    @staticmethod
+    def _list_status(mailboxes, names):
+        """Get the ``LIST`` pattern to ask the status with *LIST-STATUS*."""
+        quoted = [m if m.startswith('"') else '"{}"'.format(
+            m.replace('\\', '\\\\').replace('"', '\\"')) for m in mailboxes]
+        return '({}) RETURN (STATUS ({}))'.format(' '.join(quoted),
+                                                  ' '.join(names))
+
+    @staticmethod
+    def _parse_status(data, mailboxes):
+        """Parse the ``STATUS`` responses of `mailboxes`."""
+        wanted = {}
+        for mailbox in mailboxes:
+            name = mailbox
+            if name.startswith('"') and name.endswith('"'):
+                name = re.sub(r'\\(.)', r'\1', name[1:-1])
+            wanted[name.upper() if name.upper() == 'INBOX' else name] = \
+                mailbox
+        status = {}
+        for item in data:
+            item = utils.get_ascii_or_value(item)
+            if not isinstance(item, str):
+                continue  # a literal, not sent for our mailboxes
+            match = re.match(
+                r'\s*(?:"((?:[^"\\]|\\.)*)"|(\S+))\s+\((.*)\)\s*$', item)
+            if match is None:
+                continue
+            if match.group(1) is not None:
+                name = re.sub(r'\\(.)', r'\1', match.group(1))
+            else:
+                name = match.group(2)
+            name = name.upper() if name.upper() == 'INBOX' else name
+            if name not in wanted:
+                continue
+            values = match.group(3).split()
+            status[wanted[name]] = {
+                key.upper(): int(value)
+                for key, value in zip(values[::2], values[1::2])
+                if value.isdigit()}
+        return status
+
+    def status_mailboxes(self, mailboxes, names):
+        """Get the status of several mailboxes at once.
+
+        If the server has *LIST-STATUS* (RFC 5819) it's asked with a single
+        ``LIST`` command, else with a ``STATUS`` command for every mailbox.
+
+        Args:
+            mailboxes (list(str)): The mailboxes.
+            names (list(str)): The status data items, as ``UIDNEXT``.
+        Returns:
+            dict: The status data items (as ``int``) of every mailbox,
+            indexed by the mailbox. The mailboxes which status is not known
+            (as the missing ones) are not included.
+
+        """
+        data = []
+        with self.lock:
+            if self.has_capability('LIST-STATUS'):
+                self.imap.untagged_responses.pop('STATUS', None)
+                typ, _ = self.imap.list('""', self._list_status(mailboxes,
+                                                                names))
+                status = self.imap.untagged_responses.pop('STATUS', [])
+                if typ == 'OK':
+                    data.extend(status)
+            else:
+                for mailbox in mailboxes:
+                    typ, dat = self.imap.status(
+                        mailbox, '({})'.format(' '.join(names)))
+                    if typ == 'OK':
+                        data.extend(dat)
+        return self._parse_status(data, mailboxes)
+
     def get_uidvalidity(self, mailbox):
         """Validate a mailbox.
 
+        If `mailbox` is the selected one, the *uidvalidity* sent with the
+        ``SELECT`` response is used, else it's asked with ``STATUS``.
+
         Args:
             mailbox (str): the mailbox to check for its *uidvalidity*.
 
@@ -276,8 +1188,12 @@ class IsbgImap4(object):
             cannot be decoded, it returns 0.
 
         """
+        if self._is_selected(mailbox, True) and \
+                'UIDVALIDITY' in self.mailbox_info:
+            return self.mailbox_info['UIDVALIDITY']
         uidvalidity = 0
-        mbstatus = self.imap.status(mailbox, '(UIDVALIDITY)')
+        with self.lock:
+            mbstatus = self.imap.status(mailbox, '(UIDVALIDITY)')
         if mbstatus[0] == 'OK':
             body = mbstatus[1][0].decode()
             uidval = re.search('UIDVALIDITY ([0-9]+)', body)
@@ -286,16 +1202,218 @@ class IsbgImap4(object):
         return uidvalidity
 
 
-def login_imap(imapsets, logger=None, assertok=None):
-    """Login to the imap server."""
+class ImapActions(object):
+    """The action stage: a queue of IMAP actions applied in batches.
+
+    The ``COPY`` and ``STORE`` actions with the same arguments are sent as a
+    single command for all their *uids*, as compact *sequence-sets* (see
+    :py:func:`sequence_sets`). If the server has *MULTIAPPEND* the messages
+    appended to the same mailbox are sent with a single ``APPEND`` too (see
+    :py:meth:`IsbgImap4.append_messages`). The actions are applied when
+    `batchsize` of them are queued and when :py:meth:`flush` is called.
+
+    Args:
+        imap (IsbgImap4): The imap helper object with the connection.
+        batchsize (int): The number of queued actions that triggers a flush.
+            If it's ``None`` only :py:meth:`flush` applies them.
+        logger (logging.Logger, optional): Used to report failed actions.
+
+    """
+
+    def __init__(self, imap, batchsize=100, logger=None):
+        """Initialize a ImapActions object."""
+        self.imap = imap
+        self.batchsize = batchsize
+        self.logger = logger
+        self.failed = []     #: The *uids* whose actions have failed.
+        self._copies = {}    # mailbox -> [uid, ...]
+        self._stores = {}    # (command, flags) -> [uid, ...]
+        self._moves = {}     # mailbox -> [uid, ...]
+        self._expunges = []  # [uid, ...]
+        self._appends = []   # [(mailbox, message, uid), ...]
+        self._queued = 0
+
+    def copy(self, uid, mailbox):
+        """Queue a ``UID COPY`` of `uid` to `mailbox`."""
+        self._copies.setdefault(mailbox, []).append(str(uid))
+        self._queued_one()
+
+    def store(self, uid, command, flags):
+        """Queue a ``UID STORE`` `command` of `flags` for `uid`."""
+        self._stores.setdefault((command, flags), []).append(str(uid))
+        self._queued_one()
+
+    def move(self, uid, mailbox):
+        """Queue a ``UID MOVE`` (RFC 6851) of `uid` to `mailbox`.
+
+        The mailbox should be selected read-write. If it fails, `uid` is
+        added to :py:attr:`failed`.
+        """
+        self._moves.setdefault(mailbox, []).append(str(uid))
+        self._queued_one()
+
+    def expunge(self, uid):
+        """Queue a ``UID EXPUNGE`` (RFC 4315, *UIDPLUS*) of `uid`."""
+        self._expunges.append(str(uid))
+        self._queued_one()
+
+    def append(self, mailbox, message, uid=None):
+        """Queue the ``APPEND`` of `message` to `mailbox`.
+
+        If it fails, `uid` is added to :py:attr:`failed`.
+        """
+        self._appends.append((mailbox, message, uid))
+        self._queued_one()
+
+    def _multiappend(self, appends):
+        """Append the messages of every mailbox with a single command.
+
+        Returns:
+            list: The appends to send one by one: the ones of the mailboxes
+            refusing the ``APPEND`` of all their messages.
+
+        """
+        mailboxes = collections.OrderedDict()
+        for append in appends:
+            mailboxes.setdefault(append[0], []).append(append)
+        remaining = []
+        for mailbox, group in mailboxes.items():
+            if len(group) == 1:
+                remaining.extend(group)
+                continue
+            try:
+                res = self.imap.append_messages(mailbox,
+                                                [a[1] for a in group])
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error as exc:  # BAD: not supported
+                res = ('BAD', [str(exc)])
+            if res[0] != 'OK':
+                if self.logger:
+                    self.logger.warning(__(
+                        ("MULTIAPPEND of {} messages to {} failed: {}. " +
+                         "Appending them one by one.").format(
+                            len(group), mailbox, repr(res))))
+                remaining.extend(group)
+        return remaining
+
+    def _queued_one(self):
+        self._queued += 1
+        if self.batchsize and self._queued >= self.batchsize:
+            self.flush()
+
+    def _uid(self, uids, command, seqset, *args):
+        """Send a ``UID`` action for the *uids* of `seqset`.
+
+        If it's refused, they are added to :py:attr:`failed`.
+
+        Returns:
+            bool: True if the action has been done.
+
+        """
+        try:
+            res = self.imap.uid_unchecked(command, seqset, *args)
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error as exc:  # BAD
+            res = ('BAD', [str(exc)])
+        if self.logger:
+            self.logger.debug(__("{} = {}".format(
+                repr(("uid " + command, seqset) + args), res)))
+        if res[0] == 'OK':
+            return True
+        if self.logger:
+            self.logger.error(__(
+                "UID {} of {} failed: {}. Leaving the messages alone.".format(
+                    command, ' '.join((seqset,) + args), repr(res))))
+        self.failed.extend(u for u in uids if _in_sequence_set(u, seqset))
+        return False
+
+    def flush(self):
+        r"""Apply the queued actions.
+
+        The ``APPEND`` and ``COPY`` actions are applied before the ``STORE``
+        ones, and then the ``MOVE`` and ``EXPUNGE`` ones. The refused actions
+        are reported, and their *uids* added to :py:attr:`failed`: the next
+        actions for them (as storing ``\Deleted`` after a failed ``COPY``)
+        are not sent.
+
+        Returns:
+            list: The *uids* whose actions have failed until now.
+
+        """
+        appends, self._appends = self._appends, []
+        copies, self._copies = self._copies, {}
+        stores, self._stores = self._stores, {}
+        moves, self._moves = self._moves, {}
+        expunges, self._expunges = self._expunges, []
+        self._queued = 0
+
+        if len(appends) > 1 and self.imap.has_capability('MULTIAPPEND'):
+            appends = self._multiappend(appends)
+        for mailbox, message, uid in appends:
+            res = self.imap.append(mailbox, None, None, message)
+            # It will fail on some IMAP servers for various reasons. We
+            # print out what happened and continue processing
+            if res[0] != 'OK':
+                if self.logger:
+                    self.logger.error(__(
+                        ("{} failed for uid {}: {}. Leaving original " +
+                         "message alone.").format(
+                            repr(["append", mailbox, "{email}"]),
+                            repr(uid), repr(res))))
+                self.failed.append(uid)
+        for mailbox, uids in copies.items():
+            for seqset in sequence_sets(uids):
+                self._uid(uids, "COPY", seqset, mailbox)
+        for (command, flags), uids in stores.items():
+            for seqset in sequence_sets(self._not_failed(uids)):
+                self._uid(uids, "STORE", seqset, command, flags)
+        for mailbox, uids in moves.items():
+            for seqset in sequence_sets(self._not_failed(uids)):
+                self._uid(uids, "MOVE", seqset, mailbox)
+        expunges = self._not_failed(expunges)
+        for seqset in sequence_sets(expunges):
+            self._uid(expunges, "EXPUNGE", seqset)
+        return self.failed
+
+    def _not_failed(self, uids):
+        """Get the *uids* whose previous actions have not failed."""
+        failed = set(str(uid) for uid in self.failed)
+        return [uid for uid in uids if uid not in failed]
+
+
+def login_imap(imapsets, logger=None, assertok=None, backend=None):
+    """Login to the imap server.
+
+    Args:
+        imapsets (ImapSettings): The settings used to login.
+        logger (logging.Logger, optional): Used to log the connection.
+        assertok (function, optional): As in :py:class:`IsbgImap4`.
+        backend (str, optional): The IMAP client, one of
+            :py:data:`__backends__`. ``imaplib`` (:py:class:`IsbgImap4`) is
+            used if it's ``None``. ``asyncio`` uses
+            :py:class:`isbg.aioimap.IsbgAioImap4`.
+    Returns:
+        IsbgImap4: The connection, logged in.
+    Raises:
+        socket.error: If the connection fails after the retries.
+
+    """
     if not isinstance(imapsets, ImapSettings):
         raise TypeError("imapsets is not a ImapSettings")
+    if backend not in [None] + __backends__:
+        raise ValueError("Unknown IMAP backend: {}".format(backend))
+    imapclass = IsbgImap4
+    if backend == 'asyncio':
+        from isbg import aioimap  # pylint: disable=import-outside-toplevel
+        imapclass = aioimap.IsbgAioImap4
 
     max_retry = 10
     retry_time = 0.60   # seconds
     for retry in range(1, max_retry + 1):
         try:
-            imap = IsbgImap4(imapsets.host, imapsets.port, imapsets.nossl,
+            imap = imapclass(imapsets.host, imapsets.port, imapsets.nossl,
                              assertok)
             break   # ok, exit from loop
         except socket.error as exc:
@@ -304,19 +1422,110 @@ def login_imap(imapsets, logger=None, assertok=None):
                     ("Error in IMAP connection: {} ... retry {} of {}"
                      ).format(exc, retry, max_retry)))
             if retry >= max_retry:
-                raise Exception(exc)
-            else:
-                time.sleep(retry_time)
-    if logger:
-        logger.debug(__("Server capabilities: {}".format(
-            imap.capability()[1])))
+                raise
+            time.sleep(retry_time)
     if imapsets.nossl and logger:
         logger.warning("WARNING: Using insecure IMAP connection: without SSL.")
     # Authenticate (only simple supported)
     imap.login(imapsets.user, imapsets.passwd)
+    if logger:
+        logger.debug(__("Server capabilities: {}".format(
+            ' '.join(imap.capabilities))))
+    # Ask only for the changes since the last run, if it's possible
+    if imap.enable_condstore() and logger:
+        logger.debug("CONDSTORE enabled")
+    if imap.compress():
+        if logger:
+            logger.debug("COMPRESS=DEFLATE enabled")
+    elif imap.has_capability('COMPRESS=DEFLATE') and logger:
+        logger.debug(__("COMPRESS=DEFLATE not enabled with the {} backend"
+                        .format(backend or 'imaplib')))
     return imap
 
 
+class ImapPool(object):
+    """A pool of read-only connections to fetch mails at the same time.
+
+    Every connection fetches a disjoint part of the *uids*, so the fetch is
+    not limited by a single TCP stream. The changes should be done with
+    other connection.
+
+    Args:
+        imapsets (ImapSettings): The settings used to login.
+        size (int): The number of connections. If the server refuses some of
+            them (it usually limits the connections of a user), the pool
+            keeps the ones opened.
+        logger (logging.Logger, optional): Used to report the refused
+            connections.
+        assertok (function, optional): As in :py:class:`IsbgImap4`.
+        backend (str, optional): As in :py:func:`login_imap`.
+
+    """
+
+    def __init__(self, imapsets, size, logger=None, assertok=None,
+                 backend=None):
+        """Open the connections of the pool."""
+        self.imaps = []  #: The opened connections.
+        for num in range(size):
+            try:
+                self.imaps.append(login_imap(imapsets, logger, assertok,
+                                             backend))
+            except Exception as exc:  # pylint: disable=broad-except
+                if logger:
+                    logger.warning(__(
+                        ("Connection {} of the pool refused: {}. Using {} " +
+                         "connections.").format(num + 1, exc, num)))
+                break
+
+    def __len__(self):
+        """Return the number of connections."""
+        return len(self.imaps)
+
+    def select(self, mailbox):
+        """Select (read-only) `mailbox` in every connection."""
+        for imap in self.imaps:
+            imap.select(mailbox, True)
+
+    def get_messages(self, uids, batchsize=25, batchbytes=None, depth=1,
+                     logger=None, sizes=None, maxbytes=None, spoolsize=None):
+        """Get messages by *uid*, fetching with all the connections.
+
+        The *uids* are split between the connections and every one fetches
+        its part with :py:func:`get_messages` in its own thread.
+
+        Args:
+            uids (:obj:`list` of :obj:`str`): The *uids* of the messages.
+            batchsize (int): As in :py:func:`get_messages`.
+            batchbytes (int, optional): As in :py:func:`get_messages`.
+            depth (int): The number of fetched messages waiting to be
+                consumed.
+            logger (logging.Logger, optional): As in :py:func:`get_messages`.
+            sizes (dict, optional): As in :py:func:`get_messages`.
+            maxbytes (int, optional): As in :py:func:`get_messages`.
+            spoolsize (int, optional): As in :py:func:`get_messages`.
+
+        Returns:
+            iterator: The *uid* and the message of every *uid*, as soon as
+            they are fetched by any connection.
+
+        """
+        uids = [str(u) for u in uids]
+        parts = [uids[num::len(self.imaps)] for num in range(len(self.imaps))]
+        return utils.threaded_merge(
+            [get_messages(imap, part, batchsize, batchbytes, logger=logger,
+                          sizes=sizes, maxbytes=maxbytes, spoolsize=spoolsize)
+             for imap, part in zip(self.imaps, parts) if part], depth)
+
+    def logout(self):
+        """Close all the connections."""
+        imaps, self.imaps = self.imaps, []
+        for imap in imaps:
+            try:
+                imap.logout()
+            except Exception:  # pylint: disable=broad-except
+                pass
+
+
 class ImapSettings(object):
     """Class to store the *imap* and imap folders settings."""
 
@@ -35,10 +35,13 @@ from .utils import __
 
 import atexit
 import getpass
+import imaplib
 import json
 import logging
 import re
+import socket
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 # xdg base dir specification (only xdg_cache_home is used)
 try:
@@ -168,6 +171,13 @@ class ISBG(object):
             and communication with the `IMAP` server. It's initialized calling
             :py:meth:`do_imap_login` and every time that calling
             :py:meth:`do_isbg`.
+        fetchpool (isbg.imaputils.ImapPool): If it's not ``None``, the
+            read-only connections used to fetch the inbox mails. It's opened
+            by :py:meth:`do_imap_login` when :py:attr:`imappool` is greater
+            than 1.
+        scanpool (concurrent.futures.ThreadPoolExecutor): If it's not
+            ``None``, the :py:attr:`scanworkers` threads shared by the passes
+            run at the same time with :py:attr:`concurrentpasses`.
         imapsets (isbg.imaputils.ImapSettings): Object to store the `IMAP`
             settings. It's initialized when `ISBG` is initialized and also
             stores the IMAP folders used by ISBG.
@@ -195,6 +205,12 @@ class ISBG(object):
         exitcodes (bool): If True returns more exit codes. Defaults to
             ``True``.
         imaplist (bool): If True shows the folder list. Default to ``False``.
+        daemon (bool): If True keeps running, processing the new mails as soon
+            as they arrive. Default to ``False``.
+        idletimeout (float): Seconds to wait with *IDLE* before issuing it
+            again in daemon mode. Default to ``1740`` (29 minutes).
+        pollinterval (float): Seconds between passes in daemon mode when the
+            server has not *IDLE*. Default to ``60``.
         noreport (bool): If True not adds SpamAssassin report to mails.
             Default to ``False``.
         nostats (bool): If True no shows stats. Default to ``False``.
@@ -210,12 +226,57 @@ class ISBG(object):
         dryrun (bool): If True don't do changes in the IMAP account. Default to
             ``False``.
         maxsize (int): Max file size to process. Default to ``120,000``.
+        scantruncated (bool): If True the mails bigger than `maxsize` are
+            scanned using only their first `maxsize` bytes. Default to
+            ``False``.
         teachonly (bool): If True don't search spam, only learn. Default to
             ``False``.
         spamc (bool): If True use spamc instead of standalone SpamAssassin.
             Default to ``False``.
+        spamd (str): If it's not None, the ``host[:port]`` or the unix socket
+            path of a ``spamd`` daemon that will be used directly, instead of
+            ``spamc`` or SpamAssassin. Default to ``None``.
+        scantimeout (int): If it's not None, the seconds given to scan or
+            learn a mail. The scanner is killed, or the request to ``spamd``
+            aborted, and the mail is retried in the next run. Default to
+            ``None``.
+        runtimeout (int): If it's not None, the seconds given to the run:
+            then no more mails are scanned or learned, they are left for the
+            next run. Default to ``None``.
+        checkfirst (bool): If True, with `spamc` or `spamd`, the mails are
+            checked getting only their score, and only the spams whose
+            report is needed are processed again to get it. Default to
+            ``False``.
+        spamdcompress (bool): If True the mails are sent compressed to
+            ``spamd``. Default to ``False``.
+        spoolsize (int): If it's not None, the mails bigger than it are
+            kept in a anonymous file instead of memory, and they are passed
+            to the scanners with it. Default to ``1,000,000``.
+        scanworkers (int): Number of mails scanned or learned at the same
+            time. Default to ``1``.
+        queuedepth (int): Number of fetched mails waiting to be scanned or
+            learned. Default to ``50``.
+        actionbatch (int): If it's not None, the number of IMAP actions
+            queued before they are sent, else they are sent at the end of
+            the run. Default to ``100``.
+        imapbackend (str): The IMAP client, one of
+            :py:data:`isbg.imaputils.__backends__`. Default to ``imaplib``.
+        imappool (int): Number of read-only IMAP connections fetching the
+            inbox mails at the same time. If it's greater than 1 they are
+            opened in addition to the connection that changes the mails.
+            Default to ``1``.
+        concurrentpasses (bool): If True the spam learning, the ham learning
+            and the inbox scanning are run at the same time, every one with
+            its own IMAP connection. Default to ``False``.
         gmail (bool): If True Delete by copying to `[Gmail]/Trash` folder.
             Default to ``False``.
+        trustspamheaders (bool): If True the ``X-Spam-Status`` headers
+            added by a SpamAssassin of the server are trusted, and these
+            mails are not scanned again. Default to ``False``.
+        fetchbatch (int): Number of mails fetched with every IMAP command.
+            Default to ``25``.
+        fetchbytes (int): If it's not None, the maximum sum of sizes of the
+            mails fetched with every IMAP command. Default to ``2,000,000``.
         deletehigherthan (float): If it's not None, the minimum score from a
             mail to be deleted. Default to ``None``.
         delete (bool): If True the spam mails will be marked for deletion.
@@ -228,6 +289,11 @@ class ISBG(object):
             ``False``.
         learnunflagged (bool): If True only learn unflagged messages. Default
             to ``False``.
+        learnbatch (int): If it's not None, the mails are learned in batches
+            of it with one ``sa-learn --mbox``, instead of one by one with
+            ``spamc``. ``sa-learn`` updates the local *Bayes* database of
+            the user running isbg, not the one of a remote ``spamd``. It's
+            not used with `spamd`. Default to ``None``.
         learnthendestroy (bool): If True mark learned messages for deletion.
             Default to ``False``.
         learnthenflag (bool): If True flag learned messages. Default to
@@ -267,6 +333,8 @@ class ISBG(object):
         """Initialize a ISBG object."""
         self.imapsets = imaputils.ImapSettings()
         self.imap = None
+        self.fetchpool = None
+        self.scanpool = None
 
         self.logger = logging.getLogger(__name__)       #: a logger
         self.logger.addHandler(logging.StreamHandler())
@@ -276,18 +344,29 @@ class ISBG(object):
             os.makedirs(os.path.join(xdg_cache_home, "isbg"))
 
         self.imaplist, self.nostats = (False, False)
+        self.daemon, self.idletimeout, self.pollinterval = (False, 1740, 60)
         self.noreport, self.exitcodes = (False, True)
         self.verbose_mails, self._verbose = (False, False)
         self._set_loglevel(logging.INFO)
         # Processing options:
         self.dryrun, self.maxsize, self.teachonly = (False, 120000, False)
-        self.spamc, self.gmail = (False, False)
+        self.scantruncated = False
+        self.spamc, self.gmail, self.trustspamheaders = (False, False, False)
+        self.spamd, self.spamdcompress = (None, False)
+        self.checkfirst = False
+        self.scantimeout, self.runtimeout = (None, None)
+        self.spoolsize = 1000000
+        self.scanworkers, self.queuedepth, self.actionbatch = (1, 50, 100)
+        self.fetchbatch, self.fetchbytes, self.imappool = (25, 2000000, 1)
+        self.imapbackend = 'imaplib'
+        self.concurrentpasses = False
         # spamassassin options:
         self.movehamto, self.delete = (None, False)
         self.deletehigherthan, self.flag, self.expunge = (None, False, False)
         # Learning options:
         self.learnflagged, self.learnunflagged = (False, False)
         self.learnthendestroy, self.learnthenflag = (False, False)
+        self.learnbatch = None
         # Lockfile options:
         self.ignorelockfile = False
         self.lockfilename = os.path.join(xdg_cache_home, "isbg", "lock")
@@ -377,30 +456,48 @@ class ISBG(object):
                             "\n%s returned %s - aborting\n" % (repr(args), res)
                             )
 
-    def pastuid_read(self, uidvalidity, folder='inbox'):
-        """Read the uids stored in a file for  a folder.
+    def trackstate_read(self, uidvalidity, folder='inbox'):
+        """Read the track state stored in a file for a folder.
+
+        Args:
+            uidvalidity (int): The current *uidvalidity* of the folder.
+            folder (str): The folder name used in the track file.
+        Returns:
+            dict: The track state, with the past ``uids`` in ``uids`` and
+            other values used to search only the new mails (as the
+            ``highestmodseq``). It's empty if the file doesn't exist or if
+            the *uidvalidity* has changed.
 
-        pastuids_read keeps track of which uids we have already seen, so
-        that we don't analyze them multiple times. We store its
-        contents between sessions by saving into a file as Python
-        code (makes loading it here real easy since we just source
-        the file)
         """
         if self.trackfile is None:
             self.trackfile = ISBG.set_filename(self.imapsets, "track")
-        pastuids = []
+        state = {}
         try:
             with open(self.trackfile + folder, 'r') as rfile:
                 struct = json.load(rfile)
                 if struct['uidvalidity'] == uidvalidity:
-                    pastuids = struct['uids']
+                    state = struct
         except Exception:  # pylint: disable=broad-except
             pass
-        return pastuids
+        return state
+
+    def pastuid_read(self, uidvalidity, folder='inbox'):
+        """Read the uids stored in a file for  a folder.
+
+        pastuids_read keeps track of which uids we have already seen, so
+        that we don't analyze them multiple times. We store its
+        contents between sessions by saving into a file as Python
+        code (makes loading it here real easy since we just source
+        the file)
+        """
+        return self.trackstate_read(uidvalidity, folder).get('uids', [])
 
     def pastuid_write(self, uidvalidity, origpastuids, newpastuids,
-                      folder='inbox'):
-        """Write the uids in a file for the folder."""
+                      folder='inbox', state=None):
+        """Write the uids in a file for the folder.
+
+        The values of `state` which are not ``None`` are stored with them.
+        """
         if self.trackfile is None:
             self.trackfile = ISBG.set_filename(self.imapsets, "track")
 
@@ -412,13 +509,19 @@ class ISBG(object):
         self.logger.debug(__(('Writing pastuids for folder {}: {} ' +
                               'origpastuids, newpastuids: {}').format(
             folder, len(origpastuids), newpastuids)))
-        struct = {
+        struct = {k: v for k, v in (state or {}).items() if v is not None}
+        struct.update({
             'uidvalidity': uidvalidity,
             'uids': list(set(newpastuids + origpastuids))
-        }
+        })
         json.dump(struct, wfile)
         wfile.close()
 
+    def _touch_lockfile(self):
+        """Update the lockfile time, to not be taken as stale."""
+        if not self.ignorelockfile and os.path.exists(self.lockfilename):
+            os.utime(self.lockfilename, None)
+
     def _do_lockfile_or_raise(self):
         """Create the lockfile or raise a error if it exists."""
         if (os.path.exists(self.lockfilename) and
@@ -475,6 +578,49 @@ class ISBG(object):
             x = re.sub(r'\(.*" (?=[a-zA-Z0-9])', "", x) # string formatting with
             self.logger.info(x)                         # lookbehind regex
 
+    def unchanged_folders(self):
+        """Check if the folders have not changed since the last run.
+
+        The status of the inbox and of the learn folders is asked at once
+        (see :py:meth:`isbg.imaputils.IsbgImap4.status_mailboxes`) and it's
+        compared with the ``uidnext``, ``messages`` and ``highestmodseq`` (or
+        ``statusmodseq``, the one after our own changes) of its track state.
+        The flags of the mails are only known to not be changed with
+        *CONDSTORE*.
+
+        Returns:
+            bool: True if no folder has changed.
+
+        """
+        folders = []
+        if self.imapsets.learnspambox:
+            folders.append((self.imapsets.learnspambox, 'spam'))
+        if self.imapsets.learnhambox:
+            folders.append((self.imapsets.learnhambox, 'ham'))
+        if not self.teachonly:
+            folders.append((self.imapsets.inbox, 'inbox'))
+        if not folders:
+            return False
+        names = ['UIDVALIDITY', 'UIDNEXT', 'MESSAGES']
+        if self.imap.condstore:
+            names.append('HIGHESTMODSEQ')
+        status = self.imap.status_mailboxes([f[0] for f in folders], names)
+        for mailbox, folder in folders:
+            values = status.get(mailbox, {})
+            state = self.trackstate_read(values.get('UIDVALIDITY'), folder)
+            last = [state.get('uidnext'), state.get('messages'),
+                    state.get('statusmodseq', state.get('highestmodseq'))]
+            if None in last[:2] or last != [values.get('UIDNEXT'),
+                                            values.get('MESSAGES'),
+                                            values.get('HIGHESTMODSEQ')]:
+                return False
+            if folder != 'inbox' and last[2] is None and (
+                    self.learnflagged or self.learnunflagged):
+                return False
+            if state.get('retry'):  # some mails have timed out
+                return False
+        return True
+
     def do_spamassassin(self):
         """Do the spamassassin procesing.
 
@@ -483,38 +629,32 @@ class ISBG(object):
         would contact to the IMAP server to get the emails and to
         ``SpamAssassin`` command line to process them.
 
+        If no folder has changed since the last run (see
+        :py:meth:`unchanged_folders`), it returns at once.
+
+        With :py:attr:`concurrentpasses` the passes are run at the same time
+        (see :py:meth:`_run_passes`).
+
         """
-        sa = spamproc.SpamAssassin.create_from_isbg(self)
-        proc = None
+        if self.unchanged_folders():
+            self.logger.debug("No changes since the last run")
+            return None if self.teachonly else spamproc.Sa_Process()
 
-        # SpamAssassin training: Learn spam
-        s_learned = spamproc.Sa_Learn()
+        # SpamAssassin training: Learn spam and ham. And search spam.
+        passes = []
         if self.imapsets.learnspambox:
-            uidvalidity = self.imap.get_uidvalidity(self.imapsets.learnspambox)
-            origpastuids = self.pastuid_read(uidvalidity, 'spam')
-            s_learned = sa.learn(self.imapsets.learnspambox, 'spam', None,
-                                 origpastuids)
-            self.pastuid_write(uidvalidity, s_learned.newpastuids,
-                               s_learned.uids, 'spam')
-
-        # SpamAssassin training: Learn ham
-        h_learned = spamproc.Sa_Learn()
+            passes.append(('spam', lambda sa: self._learn_pass(
+                sa, self.imapsets.learnspambox, 'spam', None)))
         if self.imapsets.learnhambox:
-            uidvalidity = self.imap.get_uidvalidity(self.imapsets.learnhambox)
-            origpastuids = self.pastuid_read(uidvalidity, 'ham')
-            h_learned = sa.learn(self.imapsets.learnhambox, 'ham',
-                                 self.movehamto, origpastuids)
-            self.pastuid_write(uidvalidity, h_learned.newpastuids,
-                               h_learned.uids, 'ham')
-
+            passes.append(('ham', lambda sa: self._learn_pass(
+                sa, self.imapsets.learnhambox, 'ham', self.movehamto)))
         if not self.teachonly:
-            # check spaminbox exists by examining it
-            self.imap.select(self.imapsets.spaminbox, 1)
+            passes.append(('inbox', self._inbox_pass))
+        results = self._run_passes(passes)
 
-            uidvalidity = self.imap.get_uidvalidity(self.imapsets.inbox)
-            origpastuids = self.pastuid_read(uidvalidity)
-            proc = sa.process_inbox(origpastuids)
-            self.pastuid_write(uidvalidity, proc.newpastuids, proc.uids)
+        s_learned = results.get('spam', spamproc.Sa_Learn())
+        h_learned = results.get('ham', spamproc.Sa_Learn())
+        proc = results.get('inbox')
 
         if self.nostats is False:
             if self.imapsets.learnspambox is not None:
@@ -534,14 +674,169 @@ class ISBG(object):
 
         return proc
 
+    def _learn_pass(self, sa, folder, learn_type, move_to):
+        """Learn the mails of a folder, updating its track file.
+
+        Every folder is selected once: its uidvalidity is taken from the
+        SELECT response and `sa` doesn't select it again.
+
+        Returns:
+            isbg.spamproc.Sa_Learn: The result of
+            :py:meth:`isbg.spamproc.SpamAssassin.learn`.
+
+        """
+        sa.imap.select(folder)
+        uidvalidity = sa.imap.get_uidvalidity(folder)
+        track = self.trackstate_read(uidvalidity, learn_type)
+        learned = sa.learn(folder, learn_type, move_to,
+                           track.get('uids', []), track)
+        self.pastuid_write(uidvalidity, learned.newpastuids, learned.uids,
+                           learn_type, learned.state)
+        return learned
+
+    def _inbox_pass(self, sa):
+        """Search spam in the inbox, updating its track file.
+
+        Returns:
+            isbg.spamproc.Sa_Process: The result of
+            :py:meth:`isbg.spamproc.SpamAssassin.process_inbox`.
+
+        """
+        # check spaminbox exists by examining it
+        sa.imap.select(self.imapsets.spaminbox, 1)
+
+        sa.imap.select(self.imapsets.inbox, 1)
+        uidvalidity = sa.imap.get_uidvalidity(self.imapsets.inbox)
+        track = self.trackstate_read(uidvalidity)
+        proc = sa.process_inbox(track.get('uids', []), track)
+        self.pastuid_write(uidvalidity, proc.newpastuids, proc.uids,
+                           state=proc.state)
+        return proc
+
+    def _run_passes(self, passes):
+        """Run the passes of :py:meth:`do_spamassassin`.
+
+        Every pass is called with a :py:class:`~isbg.spamproc.SpamAssassin`
+        instance. Without :py:attr:`concurrentpasses` they are run one after
+        the other with :py:attr:`imap`. With it, they are run at the same
+        time: the last one with :py:attr:`imap`, and every other one with its
+        own IMAP connection. They touch different folders and track files,
+        and their mails are scanned by the same :py:attr:`scanpool`.
+
+        Args:
+            passes (list): The name and the callable of every pass.
+        Returns:
+            dict: The result of every pass, indexed by its name.
+
+        """
+        if not self.concurrentpasses or len(passes) < 2:
+            sa = spamproc.SpamAssassin.create_from_isbg(self)
+            return dict((name, run(sa)) for name, run in passes)
+
+        if self.trackfile is None:
+            self.trackfile = ISBG.set_filename(self.imapsets, "track")
+        if self.scanworkers and self.scanworkers > 1:
+            self.scanpool = ThreadPoolExecutor(max_workers=self.scanworkers)
+        connections = []
+        try:
+            for _ in passes[:-1]:
+                connections.append(imaputils.login_imap(
+                    self.imapsets, logger=self.logger, assertok=self.assertok,
+                    backend=self.imapbackend))
+            connections.append(self.imap)
+            self.logger.debug(__("Running {} passes at the same time".format(
+                len(passes))))
+            executor = ThreadPoolExecutor(max_workers=len(passes))
+            futures = []
+            for (name, run), imap in zip(passes, connections):
+                sa = spamproc.SpamAssassin.create_from_isbg(self)
+                sa.imap = imap
+                futures.append((name, executor.submit(run, sa)))
+            executor.shutdown(wait=True)
+            return dict((name, future.result()) for name, future in futures)
+        finally:
+            for imap in connections[:len(passes) - 1]:
+                imap.logout()
+            if self.scanpool is not None:
+                self.scanpool.shutdown(wait=True)
+                self.scanpool = None
+
+    def do_daemon(self):
+        """Process the IMAP account until it's interrupted.
+
+        After every pass of :py:meth:`do_spamassassin` it waits in the inbox
+        for new mails, using *IDLE* if the server has it, or polling every
+        :py:attr:`pollinterval` seconds. If the connection is lost, it's
+        opened again.
+
+        Returns:
+            isbg.spamproc.Sa_Process: The result of the last pass.
+
+        """
+        proc = None
+        retry, reconnect = (0, False)
+        while True:
+            try:
+                if reconnect:
+                    self.do_imap_login()
+                    reconnect = False
+                proc = self.do_spamassassin()
+                self._touch_lockfile()
+                retry = 0
+                if proc is not None and self.partialrun and \
+                        proc.nummsg >= self.partialrun:
+                    continue  # There are more mails waiting
+                self.imap.select(self.imapsets.inbox, 1)
+                if self.imap.has_capability('IDLE'):
+                    self.logger.debug("Waiting for new mails with IDLE")
+                    self.imap.idle(self.idletimeout)
+                else:
+                    time.sleep(self.pollinterval)
+            except KeyboardInterrupt:
+                return proc
+            except (socket.error, imaplib.IMAP4.error) as exc:
+                retry += 1
+                delay = min(2 ** retry, 300)
+                self.logger.warning(__(
+                    "IMAP connection lost: {}. Reconnecting in {} s.".format(
+                        exc, delay)))
+                time.sleep(delay)
+                reconnect = True
+
     def do_imap_login(self):
-        """Login to the imap."""
+        """Login to the imap.
+
+        If :py:attr:`imappool` is greater than 1, the pool of connections
+        used to fetch the mails is opened too.
+        """
         self.imap = imaputils.login_imap(self.imapsets,
                                          logger=self.logger,
-                                         assertok=self.assertok)
+                                         assertok=self.assertok,
+                                         backend=self.imapbackend)
+        if self.fetchpool is not None:
+            self.fetchpool.logout()
+            self.fetchpool = None
+        if self.imappool > 1 and not self.imaplist:
+            self.fetchpool = imaputils.ImapPool(
+                self.imapsets, self.imappool, logger=self.logger,
+                assertok=self.assertok, backend=self.imapbackend)
+            self.logger.debug(__("Fetching with {} connections".format(
+                len(self.fetchpool))))
+            if not self.fetchpool:
+                self.fetchpool = None
 
     def do_imap_logout(self):
         """Sign off from the imap connection."""
+        compression = getattr(self.imap, 'compression', None)
+        if compression is not None:
+            self.logger.debug(__(
+                ("COMPRESS=DEFLATE: received {} bytes ({} uncompressed), " +
+                 "sent {} bytes ({} uncompressed)").format(
+                    compression.wire_in, compression.data_in,
+                    compression.wire_out, compression.data_out)))
+        if self.fetchpool is not None:
+            self.fetchpool.logout()
+            self.fetchpool = None
         self.imap.logout()
 
     def do_isbg(self):
@@ -590,6 +885,9 @@ class ISBG(object):
         if self.imaplist:
             # List imap directories
             self.do_list_imap()
+        elif self.daemon:
+            # Spamassasin training and processing, as new mails arrive:
+            proc = self.do_daemon()
         else:
             # Spamassasin training and processing:
             proc = self.do_spamassassin()
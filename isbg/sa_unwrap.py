@@ -36,7 +36,9 @@ from __future__ import unicode_literals
 import email
 import email.message
 from io import IOBase
+import mmap
 import os
+import re
 import sys
 
 if __package__ is None and not hasattr(sys, 'frozen'):
@@ -44,6 +46,7 @@ if __package__ is None and not hasattr(sys, 'frozen'):
     path = os.path.realpath(os.path.abspath(__file__))
     sys.path.insert(0, os.path.dirname(os.path.dirname(path)))
 import isbg  # noqa: E402
+from isbg import imaputils  # noqa: E402
 
 try:
     # Creating command-line interface
@@ -65,6 +68,16 @@ except AttributeError:
     PARSE_FILE = email.message_from_file         # Python2
     MESSAGE = email.message_from_string          # Python2+3
 
+#: The end of the headers.
+_HEADERS_END = re.compile(br'\r?\n\r?\n')
+#: A multipart ``Content-Type`` header, with its boundary.
+_MULTIPART = re.compile(
+    br'^content-type:[ \t]*multipart/[^\n]*?;[ \t]*boundary="?([^"\r\n;]+)',
+    re.IGNORECASE | re.MULTILINE)
+#: The parameter of the part with the original message.
+_ORIGINAL = re.compile(br'x-spam-type[ \t]*=[ \t]*"?original\b',
+                       re.IGNORECASE)
+
 
 def sa_unwrap_from_email(msg):
     """Unwrap a email from the spamassasin email.
@@ -93,14 +106,75 @@ def sa_unwrap_from_email(msg):
     return None
 
 
-def unwrap(mail):
+def _split_headers(raw, start=0, endpos=None):
+    """Get the unfolded headers of a mail and the position of its body."""
+    end = _HEADERS_END.search(raw, start, len(raw) if endpos is None
+                              else endpos)
+    if end is None:
+        return None, None
+    headers = re.sub(br'\r?\n[ \t]+', b' ', raw[start:end.start()])
+    return headers, end.end()
+
+
+def sa_unwrap_from_bytes(mail, spoolsize=None):
+    """Unwrap a email from the spamassasin email, scanning its bytes.
+
+    Only the headers of the mail are checked until it looks like a report:
+    the mails that are not multipart or that have not a part with
+    ``x-spam-type=original`` are discarded without parsing them. The
+    original mails are sliced from `mail` as they are.
+
+    Args:
+        mail (:obj:`bytes` or :obj:`mmap.mmap`): The content of the email to
+            unwrap.
+        spoolsize (int, optional): The `spoolsize` of the
+            :py:class:`isbg.imaputils.RawMessage` of the unwraped mails.
+
+    Returns:
+        [isbg.imaputils.RawMessage]: A list with the unwraped mails.
+
+    """
+    headers, _ = _split_headers(mail)
+    if headers is None:
+        return None
+    multipart = _MULTIPART.search(headers)
+    if multipart is None or _ORIGINAL.search(mail) is None:
+        return None
+
+    delimiter = re.compile(br'(?:^|\r?\n)--' + re.escape(multipart.group(1)) +
+                           br'(--)?[ \t]*(?:\r?\n|$)')
+    parts = []
+    found = delimiter.search(mail)
+    while found is not None and found.group(1) is None:
+        next_found = delimiter.search(mail, found.end())
+        if next_found is None:
+            break
+        headers, start = _split_headers(mail, found.end(),
+                                        next_found.start())
+        if headers is not None and _ORIGINAL.search(headers) is not None:
+            parts.append(imaputils.RawMessage(
+                mail[start:next_found.start()], spoolsize=spoolsize))
+        found = next_found
+    if parts:  # len(parts) > 0
+        return parts
+    return None
+
+
+def unwrap(mail, spoolsize=None):
     """Unwrap a email from the spamassasin email.
 
     the mail could be a email.message.Email, a file or a string or buffer.
     It ruturns a list with all the email.message.Email founds.
 
+    The `bytes` are scanned with :py:func:`sa_unwrap_from_bytes`, without
+    parsing them, and the mails found are
+    :py:class:`isbg.imaputils.RawMessage`.
+
     Args:
-        mail (email.message.Message, FILE_TYPES, str): the mail to unwrap.
+        mail (email.message.Message, FILE_TYPES, str, bytes): the mail to
+            unwrap.
+        spoolsize (int, optional): The mails found in `bytes` bigger than it
+            are written to a file (see :py:class:`isbg.imaputils.RawMessage`).
 
     Returns:
         [email.message.Message]: A list with the unwraped mails.
@@ -110,6 +184,8 @@ def unwrap(mail):
         return sa_unwrap_from_email(mail)
     if isinstance(mail, FILE_TYPES):  # files are also stdin...
         return sa_unwrap_from_email(PARSE_FILE(mail))
+    if isinstance(mail, (bytes, mmap.mmap)):
+        return sa_unwrap_from_bytes(mail, spoolsize)
     try:
         mail = email.message_from_bytes(mail)  # py3 only
     except AttributeError:
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  spamd.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+r"""Native spamd client for isbg - IMAP Spam Begone.
+
+It talks the *SPAMC/1.5* protocol used by ``spamc`` with a ``spamd`` daemon,
+over TCP or over a Unix socket, without spawning a process per mail.
+
+Examples:
+    >>> from isbg import spamd
+    >>> client = spamd.SpamdClient.from_address('localhost:783')
+    >>> res = client.check(b'Subject: test\r\n\r\nHello')
+    >>> res.spam, res.score, res.threshold
+    (False, 0.3, 5.0)
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import getpass
+import os
+import re
+import socket
+import time
+import zlib
+
+#: The protocol version sent with every request.
+__protocol__ = 'SPAMC/1.5'
+
+#: Headers sent with ``TELL`` for every learn type.
+__tell_headers__ = {
+    'spam': {'Message-class': 'spam', 'Set': 'local'},
+    'ham': {'Message-class': 'ham', 'Set': 'local'},
+    'forget': {'Remove': 'local'},
+}
+
+
+class SpamdError(Exception):
+    """Error talking with ``spamd``."""
+
+
+class SpamdResponse(object):
+    """A response from ``spamd``.
+
+    Attributes:
+        code (int): The response code. ``0`` means ``EX_OK``, other values
+            follow the `Exit Codes` of ``spamc``.
+        message (str): The response message (``EX_OK``, ...).
+        headers (dict): The response headers, indexed by its lowercase name.
+        body (bytes): The response body, if any.
+
+    """
+
+    def __init__(self, code, message, headers=None, body=b''):
+        """Initialize a SpamdResponse object."""
+        self.code = code
+        self.message = message
+        self.headers = headers or {}
+        self.body = body
+        self.spam, self.score, self.threshold = (False, None, None)
+
+        status = re.match(
+            r'\s*(\w+)\s*;\s*(-?\d+(?:\.\d+)?)\s*/\s*(-?\d+(?:\.\d+)?)',
+            self.headers.get('spam', ''))
+        if status is not None:
+            self.spam = status.group(1).lower() in ['true', 'yes']
+            self.score = float(status.group(2))
+            self.threshold = float(status.group(3))
+
+    @property
+    def learned(self):
+        """bool: If a ``TELL`` request has changed the SpamAssassin db."""
+        return bool(self.headers.get('didset') or
+                    self.headers.get('didremove'))
+
+    def __repr__(self):
+        """Return a representation of the response."""
+        return "SpamdResponse({}, {!r}, {!r})".format(
+            self.code, self.message, self.headers)
+
+
+class SpamdClient(object):
+    """Client for the ``spamd`` daemon.
+
+    Every request opens a new connection: ``spamd`` closes it after
+    answering.
+
+    Args:
+        host (str): The ``spamd`` host. Defaults to ``localhost``.
+        port (int): The ``spamd`` TCP port. Defaults to ``783``.
+        socket_path (str, optional): If not ``None``, the Unix socket used
+            instead of `host` and `port`.
+        user (str, optional): The user whose preferences ``spamd`` should
+            use. Defaults to the current user, as ``spamc`` does.
+        compress (bool): If True the mails are sent compressed with *zlib*.
+        timeout (float, optional): Socket timeout in seconds.
+
+    """
+
+    def __init__(self, host='localhost', port=783, socket_path=None,
+                 user=None, compress=False, timeout=None):
+        """Initialize a SpamdClient object."""
+        self.host = host
+        self.port = int(port)
+        self.socket_path = socket_path
+        if user is None:
+            try:
+                user = getpass.getuser()
+            except Exception:  # pylint: disable=broad-except
+                user = None
+        self.user = user
+        self.compress = compress
+        self.timeout = timeout
+
+    @classmethod
+    def from_address(cls, address, **kwargs):
+        """Create a client from a ``host[:port]`` or a Unix socket path.
+
+        Args:
+            address (str): A path (it contains a ``/``) or a host name with
+                an optional port.
+            kwargs: Other arguments for :py:class:`SpamdClient`.
+        Returns:
+            SpamdClient: The new client.
+
+        """
+        if '/' in address:
+            return cls(socket_path=address, **kwargs)
+        host, _, port = address.rpartition(':')
+        if not host or not port.isdigit():
+            return cls(host=address, **kwargs)
+        return cls(host=host, port=int(port), **kwargs)
+
+    def _connect(self, deadline=None):
+        """Open a new connection with ``spamd``."""
+        timeout = self._timeout(deadline)
+        if self.socket_path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            sock.connect(self.socket_path)
+            return sock
+        return socket.create_connection((self.host, self.port),
+                                        timeout=timeout)
+
+    def _timeout(self, deadline):
+        """Get the socket timeout, never beyond `deadline`.
+
+        Raises:
+            socket.timeout: If `deadline` has passed.
+
+        """
+        if deadline is None:
+            return self.timeout
+        left = deadline - time.time()
+        if left <= 0:
+            raise socket.timeout("spamd request timed out")
+        return left if self.timeout is None else min(left, self.timeout)
+
+    def request(self, verb, message, headers=None, timeout=None):
+        """Send a request to ``spamd`` and return its response.
+
+        Args:
+            verb (str): The ``spamd`` method (``CHECK``, ``PROCESS``, ...).
+            message (:obj:`bytes` or file): The mail content, or a file
+                with it. The file is sent from its current position with
+                :py:meth:`socket.socket.sendfile`, without reading it in
+                memory (unless it is compressed).
+            headers (dict, optional): Extra request headers.
+            timeout (float, optional): If not ``None``, the seconds given to
+                the whole request. :py:attr:`timeout` only bounds every
+                operation of the socket.
+        Returns:
+            SpamdResponse: The ``spamd`` response.
+        Raises:
+            SpamdError: If the response cannot be understood.
+            socket.timeout: If the request has lasted more than `timeout`.
+            socket.error: If there are problems with the connection.
+
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        spool = None
+        if hasattr(message, 'fileno'):
+            if self.compress:
+                message = message.read()
+            else:
+                spool, message = message, b''
+        if not isinstance(message, bytes):
+            message = message.encode('utf-8', errors='replace')
+        reqheaders = dict(headers or {})
+        if self.user:
+            reqheaders['User'] = self.user
+        if self.compress:
+            message = zlib.compress(message)
+            reqheaders['Compress'] = 'zlib'
+        if spool is not None:
+            reqheaders['Content-length'] = str(
+                os.fstat(spool.fileno()).st_size - spool.tell())
+        else:
+            reqheaders['Content-length'] = str(len(message))
+
+        request = "{} {}\r\n".format(verb, __protocol__)
+        for name, value in reqheaders.items():
+            request += "{}: {}\r\n".format(name, value)
+        request += "\r\n"
+
+        sock = self._connect(deadline)
+        try:
+            sock.settimeout(self._timeout(deadline))
+            sock.sendall(request.encode('ascii') + message)
+            if spool is not None:
+                sock.settimeout(self._timeout(deadline))
+                sock.sendfile(spool)
+            sock.shutdown(socket.SHUT_WR)
+            chunks = []
+            while True:
+                sock.settimeout(self._timeout(deadline))
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            sock.close()
+
+        return SpamdClient.parse_response(b''.join(chunks))
+
+    @staticmethod
+    def parse_response(data):
+        """Parse a raw ``spamd`` response.
+
+        Args:
+            data (bytes): The response, as read from the socket.
+        Returns:
+            SpamdResponse: The parsed response.
+        Raises:
+            SpamdError: If the response cannot be understood.
+
+        """
+        head, sep, body = data.partition(b'\r\n\r\n')
+        if not sep:
+            head, body = data, b''
+        lines = head.decode('ascii', errors='replace').split('\r\n')
+        status = re.match(r'SPAMD/[\d.]+\s+(\d+)\s*(.*)', lines[0])
+        if status is None:
+            raise SpamdError("Unexpected spamd response: {!r}".format(
+                lines[0]))
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if 'content-length' in headers:
+            body = body[:int(headers['content-length'])]
+        return SpamdResponse(int(status.group(1)), status.group(2).strip(),
+                             headers, body)
+
+    def check(self, message, timeout=None):
+        """Check if a mail is spam, without any other output."""
+        return self.request('CHECK', message, timeout=timeout)
+
+    def symbols(self, message, timeout=None):
+        """Check a mail and get the list of rules hit as body."""
+        return self.request('SYMBOLS', message, timeout=timeout)
+
+    def report(self, message, timeout=None):
+        """Check a mail and get the SpamAssassin report as body."""
+        return self.request('REPORT', message, timeout=timeout)
+
+    def process(self, message, timeout=None):
+        """Check a mail and get it rewritten by SpamAssassin as body."""
+        return self.request('PROCESS', message, timeout=timeout)
+
+    def tell(self, message, learn_type, timeout=None):
+        """Learn or forget a mail.
+
+        Args:
+            message (bytes): The mail content.
+            learn_type (str): ``spam``, ``ham`` or ``forget``.
+            timeout (float, optional): As in :py:meth:`request`.
+        Returns:
+            SpamdResponse: The ``spamd`` response. Its
+            :py:attr:`~SpamdResponse.learned` is False if the mail was already
+            learned or forgotten.
+
+        """
+        if learn_type not in __tell_headers__:
+            raise ValueError("Unknown learn_type: {}".format(learn_type))
+        return self.request('TELL', message, __tell_headers__[learn_type],
+                            timeout=timeout)
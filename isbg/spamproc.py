@@ -33,11 +33,29 @@ import isbg
 
 from isbg import imaputils
 from isbg import sa_unwrap
+from isbg import spamd as spamdclient
 from isbg import utils
 
 from .utils import __
 
+import collections
+import itertools
 import logging
+import re
+import socket
+import time
+
+#: Header fields fetched before the mails to decide if they are scanned.
+__prefetch_fields__ = ['X-Spam-Status']
+
+#: Default maximum size of the mails checked by ``spamc`` (its ``-s``).
+__spamc_maxsize__ = 500 * 1024
+
+#: The result of learning some mails: the ``uid`` and the mail of every one,
+#: their :py:func:`learn_mail` codes (``(None, None)`` if they are learned in
+#: a batch with an unknown outcome) and the number of mails learned.
+LearnedMails = collections.namedtuple('LearnedMails',
+                                      ['mails', 'codes', 'learned'])
 
 #: Used to detect already our successfully (un)learned messages.
 __spamc_msg__ = {
@@ -46,21 +64,28 @@ __spamc_msg__ = {
 }
 
 
-def learn_mail(mail, learn_type):
+def learn_mail(mail, learn_type, spamd=None, timeout=None):
     """Process a email and try to learn or unlearn it.
 
     Args:
-        mail (email.message.Message): email to learn.
+        mail (:obj:`email.message.Message` or
+            :obj:`isbg.imaputils.RawMessage`): email to learn.
         learn_type (str): ```spam``` to learn spam, ```ham``` to learn
             nonspam or ```forget```.
+        spamd (isbg.spamd.SpamdClient, optional): If not ``None``, the mail
+            is sent to ``spamd`` with a ``TELL`` request instead of running
+            ``spamc``.
+        timeout (float, optional): If not ``None``, the seconds given to
+            ``spamc`` before it's killed, or to the ``spamd`` request.
     Returns:
         int, int: It returns a pair of `int`
 
         The first integer:
             A return code of ``6`` means it was already learned or forgotten,
             a return code of ``5`` means it has been learned or forgotten,
-            a ``-9999`` means an error communicating with ``spamc``. If
-            ``spamc`` returns an exit code, it returns it.
+            a ``-9999`` means an error communicating with ``spamc`` and a
+            ``-9998`` means it has timed out. If ``spamc`` returns an exit
+            code, it returns it.
 
         The second integer:
             It's the original exit code from ``spamc``
@@ -70,17 +95,26 @@ def learn_mail(mail, learn_type):
         information about other exit codes.
 
     """
+    if spamd is not None:
+        return _learn_mail_spamd(mail, learn_type, spamd, timeout)
+
     out = ""
     orig_code = None
-    proc = utils.popen(["spamc", "--learntype=" + learn_type])
+    spool = imaputils.mail_file(mail)
+    proc = utils.popen(["spamc", "--learntype=" + learn_type], spool)
     try:
-        out = proc.communicate(imaputils.mail_content(mail))
+        out = utils.communicate(
+            proc, None if spool is not None else imaputils.mail_content(mail),
+            timeout)
         code = int(proc.returncode)
         orig_code = code
+    except utils.TimeoutExpired:
+        code = -9998
     except Exception:  # pylint: disable=broad-except
         code = -9999
 
-    proc.stdin.close()
+    if proc.stdin is not None:
+        proc.stdin.close()
 
     if code == 0:
         out = out[0].decode(errors='ignore').strip()
@@ -92,8 +126,97 @@ def learn_mail(mail, learn_type):
     return code, orig_code
 
 
-def test_mail(mail, spamc=False, cmd=False):
-    """Test a email with spamassassin."""
+def _mbox_entry(mail):
+    """Get a mail as a *mbox* entry, escaping its ``From`` lines."""
+    content = imaputils.mail_content(mail)
+    if not isinstance(content, bytes):
+        content = content.encode(errors='replace')
+    content = re.sub(br'^(>*From )', br'>\1',
+                     content.replace(b'\r\n', b'\n'), flags=re.M)
+    if not content.endswith(b'\n'):
+        content += b'\n'
+    return b'From isbg@localhost Thu Jan  1 00:00:00 1970\n' + content + b'\n'
+
+
+def learn_mails(mails, learn_type, timeout=None):
+    """Learn several emails at once with ``sa-learn --mbox``.
+
+    The mails are written as a *mbox* in a anonymous file (see
+    :py:func:`isbg.imaputils.spool_file`), which is the standard input of a
+    single ``sa-learn``, so the *Bayes* database is locked and synced once.
+    It's the local database of the user running isbg, which is not the one
+    used by a ``spamd`` running in other host or as other user.
+
+    Args:
+        mails (list): The emails to learn, as in :py:func:`learn_mail`.
+        learn_type (str): ```spam```, ```ham``` or ```forget```.
+        timeout (float, optional): If not ``None``, the seconds given to
+            ``sa-learn`` before it's killed.
+    Returns:
+        int, int: The number of mails learned and the number of mails
+        examined by ``sa-learn`` (the ones already learned, and the ones
+        skipped by it, are not learned). The first one is ``-9999`` if
+        ``sa-learn`` fails, or ``-9998`` if it times out.
+    Raises:
+        OSError: If ``sa-learn`` can't be run, as in :py:func:`learn_mail`.
+
+    """
+    spool = imaputils.spool_file()
+    try:
+        for mail in mails:
+            spool.write(_mbox_entry(mail))
+        spool.seek(0)
+        proc = utils.popen(["sa-learn", "--" + learn_type, "--mbox", "-"],
+                           spool)
+        try:
+            out = utils.communicate(proc, None, timeout)[0]
+        except utils.TimeoutExpired:
+            return -9998, 0
+        except Exception:  # pylint: disable=broad-except
+            return -9999, 0
+        if proc.returncode != 0:
+            return -9999, 0
+    finally:
+        spool.close()
+    res = re.search(r'from (\d+) message\(s\) \((\d+) message\(s\) examined',
+                    out.decode(errors='ignore'))
+    if res is None:
+        return -9999, 0
+    return int(res.group(1)), int(res.group(2))
+
+
+def _spamd_content(mail):
+    """Get the content sent to ``spamd``: the spool file, if there is one."""
+    spool = imaputils.mail_file(mail)
+    return spool if spool is not None else imaputils.mail_content(mail)
+
+
+def _learn_mail_spamd(mail, learn_type, spamd, timeout=None):
+    """Learn or unlearn a email with a ``spamd`` ``TELL`` request."""
+    try:
+        res = spamd.tell(_spamd_content(mail), learn_type, timeout=timeout)
+    except socket.timeout:
+        return -9998, None
+    except Exception:  # pylint: disable=broad-except
+        return -9999, None
+    if res.code != 0:
+        return res.code, res.code
+    if res.learned:
+        return 5, res.code
+    return 6, res.code
+
+
+def test_mail(mail, spamc=False, cmd=False, spamd=None, timeout=None):
+    """Test a email with spamassassin.
+
+    If `spamd` is a :py:class:`isbg.spamd.SpamdClient` the mail is sent to
+    ``spamd`` with a ``PROCESS`` request, else `cmd` (or the command selected
+    with `spamc`) is run. Both are stopped if they last more than `timeout`
+    seconds. The score is ``-9999`` on errors and ``-9998`` on timeouts.
+    """
+    if spamd is not None:
+        return _test_mail_spamd(mail, spamd, timeout)
+
     score = "0/0\n"
     orig_code = None
     spamassassin_result = None
@@ -107,20 +230,80 @@ def test_mail(mail, spamc=False, cmd=False):
     else:
         satest = ["spamassassin", "--exit-code"]
 
-    proc = utils.popen(satest)
+    spool = imaputils.mail_file(mail)
+    proc = utils.popen(satest, spool)
 
     try:
-        spamassassin_result = proc.communicate(imaputils.mail_content(mail))[0]
+        spamassassin_result = utils.communicate(
+            proc, None if spool is not None else imaputils.mail_content(mail),
+            timeout)[0]
         returncode = proc.returncode
-        proc.stdin.close()
+        if proc.stdin is not None:
+            proc.stdin.close()
         score = utils.score_from_mail(spamassassin_result.decode(errors='ignore'))
 
+    except utils.TimeoutExpired:
+        score = "-9998"
     except Exception:  # pylint: disable=broad-except
         score = "-9999"
 
     return score, returncode, spamassassin_result
 
 
+def check_mail(mail, spamd=None, timeout=None):
+    """Check if a email is spam, without getting the processed email.
+
+    It's a ``CHECK`` request if `spamd` is a
+    :py:class:`isbg.spamd.SpamdClient`, else ``spamc -c`` is run: only the
+    score is sent back, not the email with the report.
+
+    Returns:
+        str, int, None: The score, the return code (``1`` if it's spam) and
+        ``None`` instead of the processed email, as :py:func:`test_mail`.
+        The score is ``-9999`` on errors and ``-9998`` on timeouts.
+
+    """
+    if spamd is not None:
+        try:
+            res = spamd.check(_spamd_content(mail), timeout=timeout)
+        except socket.timeout:
+            return "-9998", None, None
+        except Exception:  # pylint: disable=broad-except
+            return "-9999", None, None
+        if res.code != 0 or res.score is None:
+            return "-9999", res.code, None
+        return "{}/{}\n".format(res.score, res.threshold), \
+            1 if res.spam else 0, None
+
+    spool = imaputils.mail_file(mail)
+    proc = utils.popen(["spamc", "-c", "--max-size=268435450"], spool)
+    try:
+        out = utils.communicate(
+            proc, None if spool is not None else imaputils.mail_content(mail),
+            timeout)[0]
+    except utils.TimeoutExpired:
+        return "-9998", None, None
+    except Exception:  # pylint: disable=broad-except
+        return "-9999", None, None
+    if proc.returncode not in [0, 1]:
+        return "-9999", proc.returncode, None
+    return out.decode(errors='ignore').strip() + "\n", proc.returncode, None
+
+
+def _test_mail_spamd(mail, spamd, timeout=None):
+    """Test a email with a ``spamd`` ``PROCESS`` request."""
+    try:
+        res = spamd.process(_spamd_content(mail), timeout=timeout)
+    except socket.timeout:
+        return "-9998", None, None
+    except Exception:  # pylint: disable=broad-except
+        return "-9999", None, None
+    if res.code != 0 or res.score is None:
+        return "-9999", res.code, None
+    score = "{}/{}\n".format(res.score, res.threshold)
+    return score, 1 if res.spam else 0, res.body
+
+
 class Sa_Learn(object):
     """Commodity class to store information about learning processes."""
 
@@ -130,6 +313,7 @@ class Sa_Learn(object):
         self.learned = 0         #: Number of messages learned.
         self.uids = []           #: The list of ``uids``.
         self.newpastuids = []    #: The new past ``uids``.
+        self.state = {}          #: The new track state of the folder.
 
 
 class Sa_Process(object):
@@ -142,6 +326,7 @@ class Sa_Process(object):
         self.spamdeleted = 0     #: Number of deleted spam.
         self.uids = []           #: The list of ``uids``.
         self.newpastuids = []    #: The new past ``uids``.
+        self.state = {}          #: The new track state of the folder.
 
 
 class SpamAssassin(object):
@@ -164,7 +349,11 @@ class SpamAssassin(object):
     _kwargs = ['imap', 'spamc', 'logger', 'partialrun', 'dryrun',
                'learnthendestroy', 'gmail', 'learnthenflag', 'learnunflagged',
                'learnflagged', 'deletehigherthan', 'imapsets', 'maxsize',
-               'noreport', 'spamflags', 'delete', 'expunge']
+               'noreport', 'spamflags', 'delete', 'expunge', 'fetchbatch',
+               'fetchbytes', 'spamd', 'spamdcompress', 'scanworkers',
+               'queuedepth', 'actionbatch', 'fetchpool', 'trustspamheaders',
+               'scantruncated', 'spoolsize', 'learnbatch', 'scanpool',
+               'checkfirst', 'scantimeout', 'runtimeout']
 
     def __init__(self, **kwargs):
         """Initialize a SpamAssassin object."""
@@ -189,6 +378,19 @@ class SpamAssassin(object):
         # what we use to set flags on the original spam in imapbox
         self.spamflagscmd = "+FLAGS.SILENT"
 
+        # spamd can be given as a address or as a client
+        if self.spamd and not isinstance(self.spamd, spamdclient.SpamdClient):
+            self.spamd = spamdclient.SpamdClient.from_address(
+                self.spamd, compress=bool(self.spamdcompress),
+                timeout=self.scantimeout)
+
+        #: The time when the run must stop, if `runtimeout` is set.
+        self.deadline = None
+        if self.runtimeout:
+            self.deadline = time.time() + self.runtimeout
+        #: True if the run has stopped because of the `deadline`.
+        self.expired = False
+
     @property
     def cmd_save(self):
         """Is the command that dumps out a munged message including report."""
@@ -221,7 +423,7 @@ class SpamAssassin(object):
         return SpamAssassin(**kw)
 
     @staticmethod
-    def get_formated_uids(uids, origpastuids, partialrun):
+    def get_formated_uids(uids, origpastuids, partialrun, prune=True):
         """Get the uids formated.
 
         Args:
@@ -229,6 +431,9 @@ class SpamAssassin(object):
                 ```['1 2 3 4']```
             origpastuids (list(int)): The original past ``uids``.
             partialrun (int): If not none the number of ``uids`` to return.
+            prune (bool): If True, the past ``uids`` not found in `uids` are
+                removed. It should be False when `uids` only has the mails
+                changed since the last run.
         Returns:
             list(str): The ``uids`` formated.
 
@@ -237,15 +442,189 @@ class SpamAssassin(object):
             ```None``` it return all.
 
         """
-        uids = sorted(uids[0].split(), key=int, reverse=True)
-        newpastuids = [u for u in origpastuids if str(u) in uids]
+        uids = sorted((uids[0] or '').split(), key=int, reverse=True)
+        if prune:
+            newpastuids = [u for u in origpastuids if str(u) in uids]
+        else:
+            newpastuids = list(origpastuids)
         uids = [u for u in uids if int(u) not in newpastuids]
         # Take only X elements if partialrun is enabled
         if partialrun:
             uids = uids[:int(partialrun)]
         return uids, newpastuids
 
-    def learn(self, folder, learn_type, move_to, origpastuids):
+    def search_uids(self, criteria, origpastuids, state=None,
+                    uidrange=False):
+        r"""Search the new ``uids`` of the selected folder.
+
+        If the server has *CONDSTORE* and `state` has the ``highestmodseq``
+        of the last run, only the mails changed since then are searched.
+        If `uidrange` is True and `state` has the ``lastuid`` of the last
+        run, only the mails with a greater ``uid`` are searched. Otherwise
+        all the folder is searched. The mails in the ``retry`` and
+        ``deleted`` lists of `state` (the ones timed out in the last run,
+        and the ones skipped because they were flagged as ``\Deleted``)
+        are always searched.
+
+        Args:
+            criteria (list(str)): The search criteria.
+            origpastuids (list(int)): ``uids`` to not process.
+            state (dict, optional): The track state of the last run.
+            uidrange (bool): If True, the mails with a ``uid`` lower than
+                the ``lastuid`` are never searched again. It only should be
+                used when `criteria` don't depend on mutable data, as the
+                flags.
+        Returns:
+            (list(str), list(int), dict): The ``uids`` to process, the past
+            ``uids`` and the new track state, as
+            :py:meth:`get_formated_uids`.
+
+            The new ``highestmodseq`` and ``lastuid`` are only stored if all
+            the mails found are going to be processed, if not the next run
+            continues from the old ones.
+
+            An incremental search only finds the changed mails, so the past
+            ``uids`` are pruned with a search of all the folder when some
+            mails have been expunged (see :py:meth:`_expunged`).
+
+        """
+        state = state or {}
+        criteria = list(criteria)
+        modseq = getattr(self.imap, 'mailbox_info', {}).get('HIGHESTMODSEQ')
+        lastmodseq = state.get('highestmodseq')
+        lastuid = state.get('lastuid') if uidrange else None
+        newstate = {'highestmodseq': modseq}
+        retry = [u for u in (state.get('retry') or []) +
+                 (state.get('deleted') or []) if u not in origpastuids]
+        search = list(criteria)
+        if lastuid is not None:
+            criteria += ["UID", "{}:*".format(lastuid + 1)]
+
+        incremental = modseq is not None and lastmodseq is not None and \
+            lastmodseq <= modseq
+        if incremental and lastmodseq == modseq:
+            self.logger.debug("No changes since the last run")
+            uids = ['']
+        elif incremental:
+            _, uids = self.imap.uid("SEARCH", None, *(
+                criteria + ["MODSEQ", str(lastmodseq + 1)]))
+            uids = [re.sub(r'\(MODSEQ \d+\)', '', uids[0] or '')]
+        else:
+            _, uids = self.imap.uid("SEARCH", None, *criteria)
+        if retry and (incremental or lastuid is not None):
+            # The mails timed out are searched again
+            _, found = self.imap.uid("SEARCH", None, *(
+                search + ["UID", imaputils.sequence_sets(retry, None)[0]]))
+            uids = [' '.join(set((uids[0] or '').split()) |
+                             set((found[0] or '').split()))]
+
+        if uidrange:
+            newstate['lastuid'] = max([lastuid or 0] + [
+                int(u) for u in (uids[0] or '').split()]) or None
+        if incremental and self._expunged(origpastuids, state):
+            # The uids of the expunged mails are removed from the past uids
+            _, found = self.imap.uid("SEARCH", None, "ALL")
+            found = set((found[0] or '').split())
+            origpastuids = [u for u in origpastuids if str(u) in found]
+        uids, newpastuids = SpamAssassin.get_formated_uids(
+            uids, origpastuids, None, prune=not incremental)
+        if lastuid is not None:
+            # 'n:*' always matches the last mail, even if its uid is lower
+            uids = [u for u in uids if int(u) > lastuid or int(u) in retry]
+            newpastuids = [u for u in newpastuids if int(u) > lastuid]
+
+        if self.partialrun and len(uids) > int(self.partialrun):
+            uids = uids[:int(self.partialrun)]
+            newstate = SpamAssassin._keep_state(newstate, state)
+        return uids, newpastuids, newstate
+
+    def _expunged(self, pastuids, state):
+        """Check if some mails of the selected folder have been expunged.
+
+        The folder had ``messages`` mails in the last run, and at most
+        ``UIDNEXT - uidnext`` mails have been added since then: if it has
+        less mails now, some have been expunged. It's also the case if
+        there are more `pastuids` than mails.
+
+        Args:
+            pastuids (list(int)): The past ``uids`` of the folder.
+            state (dict): The track state of the last run.
+        Returns:
+            bool: True if some mails have been expunged, or if it's unknown
+            and `pastuids` could have ``uids`` of expunged mails.
+
+        """
+        info = getattr(self.imap, 'mailbox_info', {})
+        exists, uidnext = (info.get('EXISTS'), info.get('UIDNEXT'))
+        if exists is None:
+            return bool(pastuids)
+        if len(pastuids) > exists:
+            return True
+        if None in (uidnext, state.get('messages'), state.get('uidnext')):
+            return False
+        return exists < state['messages'] + uidnext - state['uidnext']
+
+    def prefilter(self, uids, learn=False):
+        r"""Decide which mails are fetched, using only their size and headers.
+
+        The size and the flags of all the `uids` (and their
+        ``X-Spam-Status`` header, if :py:attr:`trustspamheaders` is used) are
+        fetched with one command (see :py:func:`isbg.imaputils.prefetch`),
+        and:
+
+        - The mails flagged as ``\Deleted`` are skipped. They are not
+          past ``uids``: they are looked at again in the next run (see
+          :py:meth:`search_uids`), in case they are undeleted.
+        - When learning with ``spamc`` (not with :py:attr:`learnbatch`,
+          ``sa-learn`` has no size limit), the mails bigger than its limit
+          are not fetched: they get the ``spamc`` code ``98`` (too big).
+        - If :py:attr:`trustspamheaders` is True, the verdict of a upstream
+          SpamAssassin in ``X-Spam-Status`` is used for the hams and, with
+          :py:attr:`noreport`, for the spams.
+
+        Args:
+            uids (list(str)): The ``uids`` to filter.
+            learn (bool): If True the mails are going to be learned.
+        Returns:
+            (list(str), list(str), dict, dict): The ``uids`` to fetch, the
+            ``uids`` skipped, the verdicts (``(score, code)``) indexed by
+            ``uid`` of the mails not fetched, and the known sizes.
+
+        """
+        toscan, skipped, verdicts = ([], [], {})
+        # The headers are only needed to trust the upstream verdicts
+        fields = () if learn or not self.trustspamheaders \
+            else __prefetch_fields__
+        info = imaputils.prefetch(self.imap, uids, fields)
+        for uid in uids:
+            item = info.get(str(uid))
+            if item is None:  # it will be reported when fetched
+                toscan.append(uid)
+                continue
+            status = re.match(
+                r'\s*(yes|no)\b.*?score=(-?[\d.]+)\s+required=(-?[\d.]+)',
+                item['headers'].get('X-Spam-Status', ''), re.I | re.S)
+            if '\\Deleted' in item['flags']:
+                self.logger.debug(__("{} is deleted, skipped".format(uid)))
+                skipped.append(uid)
+            elif learn and not self.spamd and not self.learnbatch and \
+                    item['size'] is not None and \
+                    item['size'] > __spamc_maxsize__:
+                verdicts[uid] = (None, 98)
+            elif (not learn and self.trustspamheaders and status and
+                  (status.group(1).lower() == 'no' or self.noreport)):
+                self.logger.debug(__("{} trusted X-Spam-Status: {}".format(
+                    uid, status.group(0).strip())))
+                verdicts[uid] = (
+                    "{}/{}\n".format(status.group(2), status.group(3)),
+                    1 if status.group(1).lower() == 'yes' else 0)
+            else:
+                toscan.append(uid)
+        sizes = dict((uid, item['size']) for uid, item in info.items()
+                     if item['size'] is not None)
+        return toscan, skipped, verdicts, sizes
+
+    def learn(self, folder, learn_type, move_to, origpastuids, state=None):
         """Learn the spams (and if requested deleted or move them).
 
         Args:
@@ -255,6 +634,8 @@ class SpamAssassin(object):
             move_to (str): If not ```None```, the imap folder where the emails
                 will be moved.
             origpastuids (list(int)): ``uids`` to not process.
+            state (dict, optional): The track state of the last run, used to
+                search only the changes since then.
         Returns:
             Sa_Learn:
                 It contains the information about the result of the process.
@@ -280,96 +661,142 @@ class SpamAssassin(object):
         self.logger.debug(__(
             "Teach {} to SA from: {}".format(learn_type, folder)))
 
-        self.imap.select(folder)
+        self.imap.select(folder, cached=True)
         if self.learnunflagged:
-            _, uids = self.imap.uid("SEARCH", None, "UNFLAGGED")
+            criteria = ["UNFLAGGED"]
         elif self.learnflagged:
-            _, uids = self.imap.uid("SEARCH", None, "(FLAGGED)")
+            criteria = ["(FLAGGED)"]
         else:
-            _, uids = self.imap.uid("SEARCH", None, "ALL")
-
-        uids, sa_learning.newpastuids = SpamAssassin.get_formated_uids(
-            uids, origpastuids, self.partialrun)
-
-        sa_learning.tolearn = len(uids)
-
-        for uid in uids:
-            mail = imaputils.get_message(self.imap, uid, logger=self.logger)
-
-            # Unwrap spamassassin reports
-            unwrapped = sa_unwrap.unwrap(mail)
-            if unwrapped is not None:
-                self.logger.debug(__("{} Unwrapped: {}".format(
-                    uid, utils.shorten(imaputils.mail_content(
-                        unwrapped[0]), 140))))
-
-            if unwrapped is not None and unwrapped:  # len(unwrapped)>0
-                mail = unwrapped[0]
-
-            if self.dryrun:
-                self.logger.warning("Skipped learning due to dryrun!")
-                continue
-            else:
-                code, code_orig = learn_mail(mail, learn_type)
-
-            if code == -9999:  # error processing email, try next.
-                self.logger.exception(__(
-                    'spamc error for mail {}'.format(uid)))
-                self.logger.debug(repr(imaputils.mail_content(mail)))
-                continue
+            criteria = ["ALL"]
+
+        uids, sa_learning.newpastuids, sa_learning.state = self.search_uids(
+            criteria, origpastuids, state, uidrange=criteria == ["ALL"])
+        folder_state = self._folder_state(uids)
+        found, timedout = (list(uids), [])
+
+        uids, skipped, verdicts, sizes = self.prefilter(uids, learn=True)
+        sa_learning.tolearn = len(uids) + len(verdicts)
+
+        actions = imaputils.ImapActions(self.imap, None, logger=self.logger)
+        completed = True
+        # The next mails are fetched while the previous ones are learned
+        fetch = utils.threaded_iter(imaputils.get_messages(
+            self.imap, uids, self.fetchbatch, self.fetchbytes,
+            logger=self.logger, sizes=sizes, spoolsize=self.spoolsize),
+            self.queuedepth)
+        mails = self._unwrap_reports(itertools.chain(
+            [(uid, None) for uid in verdicts], fetch))
+        learned = self._learn_codes(learn_type, self._until_deadline(mails),
+                                    verdicts)
+        try:
+            for res in learned:
+                sa_learning.learned += res.learned
+                for (uid, mail), (code, code_orig) in zip(res.mails,
+                                                          res.codes):
+                    if code == -9999:  # error processing email, try next.
+                        self.logger.exception(__(
+                            'spamc error for mail {}'.format(uid)))
+                        self.logger.debug(repr(imaputils.mail_content(mail)))
+                        completed = False
+                        continue
+
+                    if code == -9998:  # timed out, retried in the next run.
+                        self.logger.warning(__(
+                            'Learning mail {} has timed out'.format(uid)))
+                        timedout.append(uid)
+                        continue
+
+                    if code in [69, 74]:
+                        raise isbg.ISBGError(
+                            isbg.__exitcodes__['flags'],
+                            "spamassassin is misconfigured (use --allow-tell)")
+
+                    if code == 5:  # learned.
+                        self.logger.debug(__(
+                            "Learned {} (spamc return code {})".format(
+                                uid, code_orig)))
+
+                    elif code == 6:  # already learned.
+                        self.logger.debug(__(
+                            "Already learned {} (spamc return code {})".format(
+                                uid, code_orig)))
+
+                    elif code == 98:  # too big.
+                        self.logger.warning(__(
+                            "{} is too big (spamc return code {})".format(
+                                uid, code_orig)))
+
+                    elif code is None:  # in a batch, maybe already learned.
+                        self.logger.debug(__(
+                            "Learned {} in a batch".format(uid)))
 
-            if code in [69, 74]:
-                raise isbg.ISBGError(
-                    isbg.__exitcodes__['flags'],
-                    "spamassassin is misconfigured (use --allow-tell)")
-
-            if code == 5:  # learned.
-                sa_learning.learned += 1
-                self.logger.debug(__(
-                    "Learned {} (spamc return code {})".format(uid,
-                                                               code_orig)))
-
-            elif code == 6:  # already learned.
-                self.logger.debug(__(
-                    "Already learned {} (spamc return code {})".format(
-                        uid, code_orig)))
-
-            elif code == 98:  # too big.
-                self.logger.warning(__(
-                    "{} is too big (spamc return code {})".format(
-                        uid, code_orig)))
+                    else:
+                        raise isbg.ISBGError(
+                            -1, ("{}: Unknown return code {} from " +
+                                 "spamc").format(uid, code_orig))
+
+                    sa_learning.uids.append(int(uid))
+
+                    if not self.dryrun:
+                        if self.learnthendestroy:
+                            if self.gmail:
+                                actions.copy(uid, "[Gmail]/Trash")
+                            else:
+                                actions.store(uid, self.spamflagscmd,
+                                              "(\\Deleted)")
+                        elif move_to is not None:
+                            actions.copy(uid, move_to)
+                        elif self.learnthenflag:
+                            actions.store(uid, self.spamflagscmd,
+                                          "(\\Flagged)")
+        finally:
+            # The fetch thread is stopped before using the connection
+            learned.close()
+            fetch.close()
+
+        # The learned mails are moved or flagged with a command per action
+        actions.flush()
+        if not completed or self.expired or self.dryrun:
+            # The failed (or not learned) mails should be searched again.
+            sa_learning.state = SpamAssassin._keep_state(
+                sa_learning.state, state)
+        else:
+            if sa_learning.uids and (self.learnthendestroy or
+                                     move_to is not None or
+                                     self.learnthenflag):
+                folder_state = self._flushed_state(
+                    folder, folder_state,
+                    self.learnflagged or self.learnunflagged)
+            sa_learning.state.update(folder_state)
+        sa_learning.state['retry'] = SpamAssassin._retry_uids(
+            state, timedout, [u for u in found
+                              if int(u) not in sa_learning.uids])
+        sa_learning.state['deleted'] = sorted(int(u) for u in skipped)
+        return sa_learning
 
-            else:
-                raise isbg.ISBGError(-1, ("{}: Unknown return code {} from " +
-                                          "spamc").format(uid, code_orig))
+    def _process_spam(self, uid, score, mail, spamdeletelist, code,
+                      spamassassin_result, actions=None, truncated=False):
+        """Copy or append a spam to the spam folder.
 
-            sa_learning.uids.append(int(uid))
+        If `actions` is a :py:class:`~isbg.imaputils.ImapActions`, the
+        ``APPEND`` or ``COPY`` is queued in it instead of being sent now. In
+        this case a failed ``APPEND`` is only known when `actions` is flushed.
 
-            if not self.dryrun:
-                if self.learnthendestroy:
-                    if self.gmail:
-                        self.imap.uid("COPY", uid, "[Gmail]/Trash")
-                    else:
-                        self.imap.uid("STORE", uid, self.spamflagscmd,
-                                      "(\\Deleted)")
-                elif move_to is not None:
-                    self.imap.uid("COPY", uid, move_to)
-                elif self.learnthenflag:
-                    self.imap.uid("STORE", uid, self.spamflagscmd,
-                                  "(\\Flagged)")
+        If `truncated` is True, only a part of the mail was scanned: it's
+        copied without report, so the whole mail is kept.
 
-        return sa_learning
+        Returns:
+            bool: ``True`` if the mail should be marked as spam.
 
-    def _process_spam(self, uid, score, mail, spamdeletelist, code, spamassassin_result):
+        """
         self.logger.debug(__("{} is spam".format(uid)))
 
-        if (self.deletehigherthan is not None and
-                float(score.split('/')[0]) > self.deletehigherthan):
+        if self._deleted(score):
             spamdeletelist.append(uid)
             return False
 
         # do we want to include the spam report
-        if self.noreport is False:
+        if self.noreport is False and not truncated:
             if self.dryrun:
                 self.logger.info("Skipping report because of --dryrun")
             else:
@@ -383,6 +810,10 @@ class SpamAssassin(object):
                         spamdeletelist.remove(uid)
                     return False
 
+                if actions is not None:
+                    actions.append(self.imapsets.spaminbox, new_mail, uid)
+                    return True
+
                 res = self.imap.append(self.imapsets.spaminbox, None, None,
                                        new_mail)
                 # The above will fail on some IMAP servers for various
@@ -403,83 +834,456 @@ class SpamAssassin(object):
             if self.dryrun:
                 self.logger.info("Skipping copy to spambox because" +
                                  " of --dryrun")
+            elif actions is not None and self.can_move():
+                pass  # moved when the inbox is selected read-write
+            elif actions is not None:
+                actions.copy(uid, self.imapsets.spaminbox)
             else:
                 # just copy it as is
                 self.imap.uid("COPY", uid, self.imapsets.spaminbox)
 
         return True
 
-    def process_inbox(self, origpastuids):
-        """Run spamassassin in the folder for spam."""
+    def can_move(self):
+        """Check if the spams can be relocated with ``UID MOVE``.
+
+        It's done when the server has *MOVE* (RFC 6851) and the spams are
+        copied without report, deleted and expunged from the inbox, as a
+        ``UID MOVE`` does.
+
+        Returns:
+            bool: True if the spams should be moved.
+
+        """
+        return bool(self.noreport and not self.gmail and self.expunge and
+                    "\\Deleted" in (self.spamflags or []) and
+                    self.imap.has_capability('MOVE'))
+
+    def _scan_mail(self, uid_mail, truncated=False):
+        """Unwrap and test a mail. It's called by the scan workers.
+
+        With :py:attr:`checkfirst`, and ``spamc`` or ``spamd``, the mail is
+        checked with :py:func:`check_mail`, and only the spams whose report
+        is copied to the spam folder are tested again with
+        :py:func:`test_mail`.
+
+        Args:
+            uid_mail (tuple): The *uid* and the mail to test.
+            truncated (bool): If True the mail is truncated, and its report
+                is not used.
+        Returns:
+            tuple: The mail tested, the score, the return code and the result
+            of :py:func:`test_mail`. The last three are ``None`` if `dryrun`
+            is True.
+
+        """
+        _, mail = uid_mail
+
+        # Unwrap spamassassin reports
+        with imaputils.mail_buffer(mail) as content:
+            unwrapped = sa_unwrap.unwrap(content, spoolsize=self.spoolsize)
+        if unwrapped is not None and unwrapped:  # len(unwrapped) > 0
+            mail = unwrapped[0]
+
+        if self.dryrun:  # dryrun doesn't run test_mail()
+            return mail, None, None, None
+        if self.checkfirst and (self.spamc or self.spamd is not None):
+            score, code, spamassassin_result = check_mail(
+                mail, self.spamd, timeout=self._timeout())
+            if code != 1 or self.noreport or truncated or \
+                    self._deleted(score):
+                return mail, score, code, spamassassin_result
+        score, code, spamassassin_result = test_mail(
+            mail, cmd=self.cmd_test, spamd=self.spamd,
+            timeout=self._timeout())
+        return mail, score, code, spamassassin_result
+
+    def _timeout(self, mails=1):
+        """Get the seconds given to the scanner for `mails` mails.
+
+        They are :py:attr:`scantimeout` seconds for every mail, but never
+        more than the time left to the :py:attr:`deadline` of the run.
+
+        Returns:
+            float: The seconds, or ``None`` if there is not any limit.
+
+        """
+        timeout = self.scantimeout * mails if self.scantimeout else None
+        if self.deadline is not None:
+            left = max(self.deadline - time.time(), 0.001)
+            timeout = left if timeout is None else min(timeout, left)
+        return timeout
+
+    def _until_deadline(self, mails):
+        """Yield `mails` until the :py:attr:`deadline` of the run passes.
+
+        Then :py:attr:`expired` is set, and the mails left are not scanned.
+        """
+        for item in mails:
+            if self.deadline is not None and time.time() >= self.deadline:
+                if not self.expired:
+                    self.logger.warning(
+                        "The run has timed out, the mails left are " +
+                        "processed in the next run")
+                self.expired = True
+                return
+            yield item
+
+    @staticmethod
+    def _retry_uids(state, timedout, unprocessed):
+        """Get the ``uids`` of the mails to retry in the next run.
+
+        They are the ones timed out now, and the ones to retry from the last
+        run which have not been processed now.
+
+        Args:
+            state (dict): The track state of the last run.
+            timedout (list(str)): The ``uids`` timed out.
+            unprocessed (list(str)): The ``uids`` found and not processed.
+        Returns:
+            list(int): The sorted ``uids``.
+
+        """
+        unprocessed = set(int(u) for u in unprocessed)
+        retry = set(int(u) for u in timedout)
+        retry.update(u for u in (state or {}).get('retry', [])
+                     if u in unprocessed)
+        return sorted(retry)
+
+    def _deleted(self, score):
+        """Check if a spam is deleted by :py:attr:`deletehigherthan`."""
+        return (self.deletehigherthan is not None and
+                float(score.split('/')[0]) > self.deletehigherthan)
+
+    def _unwrap_reports(self, mails):
+        """Unwrap the SpamAssassin reports of the mails to learn.
+
+        Args:
+            mails (iterator): The ``uid`` and the mail of every mail. The
+                mail is ``None`` if it's not fetched.
+        Yields:
+            (str, mail): The ``uid`` and the mail, or the original mail of
+            the report.
+
+        """
+        for uid, mail in mails:
+            if mail is not None:
+                # Unwrap spamassassin reports
+                with imaputils.mail_buffer(mail) as content:
+                    unwrapped = sa_unwrap.unwrap(content,
+                                                 spoolsize=self.spoolsize)
+                if unwrapped is not None:
+                    self.logger.debug(__("{} Unwrapped: {}".format(
+                        uid, utils.shorten(imaputils.mail_content(
+                            unwrapped[0]), 140))))
+
+                if unwrapped is not None and unwrapped:  # len(unwrapped)>0
+                    mail = unwrapped[0]
+            yield uid, mail
+
+    def _learn_codes(self, learn_type, mails, verdicts):
+        """Learn the mails, getting the return code of every one.
+
+        If :py:attr:`learnbatch` is set, and ``spamd`` is not used, they are
+        learned in batches of :py:attr:`learnbatch` mails with
+        :py:func:`learn_mails`, else one by one with :py:func:`learn_mail`,
+        up to :py:attr:`scanworkers` of them at the same time.
+
+        Args:
+            learn_type (str): As in :py:func:`learn_mail`.
+            mails (iterator): The ``uid`` and the mail of every mail. The
+                mail is ``None`` if it's not fetched.
+            verdicts (dict): The codes of the mails not fetched, indexed by
+                ``uid``.
+        Yields:
+            LearnedMails: The result of every mail learned alone, or of
+            every batch (see :py:meth:`_learn_batch`).
+
+        """
+        if self.dryrun:
+            for _ in mails:
+                self.logger.warning("Skipped learning due to dryrun!")
+            return
+
+        if not self.learnbatch or self.spamd is not None:
+            for uid_mail, codes in utils.ordered_map(
+                    lambda uid_mail: self._learn_mail(learn_type, verdicts,
+                                                      uid_mail),
+                    mails, self.scanworkers, self.scanpool):
+                yield LearnedMails([uid_mail], [codes],
+                                   1 if codes[0] == 5 else 0)
+            return
+
+        batch = []
+        for uid, mail in mails:
+            if mail is None:  # not fetched, we know it by its size
+                yield LearnedMails([(uid, mail)], [(verdicts[uid][1],
+                                                    verdicts[uid][1])], 0)
+                continue
+            batch.append((uid, mail))
+            if len(batch) >= self.learnbatch:
+                yield self._learn_batch(learn_type, batch)
+                batch = []
+        if batch:
+            yield self._learn_batch(learn_type, batch)
+
+    def _learn_mail(self, learn_type, verdicts, uid_mail):
+        """Learn a mail. It's called by the learn workers.
+
+        Returns:
+            (int, int): The codes of :py:func:`learn_mail`, or the code of
+            `verdicts` if the mail is not fetched.
+
+        """
+        uid, mail = uid_mail
+        if mail is None:  # not fetched, we know it by its size
+            return verdicts[uid][1], verdicts[uid][1]
+        return learn_mail(mail, learn_type, self.spamd,
+                          timeout=self._timeout())
+
+    @staticmethod
+    def _sa_learn_code(learned, examined):
+        """Get the :py:func:`learn_mail` codes of a mail learned alone."""
+        if learned in [-9999, -9998]:
+            return learned, None
+        if not examined:  # skipped by sa-learn
+            return 98, 0
+        return (5 if learned else 6), 0
+
+    def _learn_batch(self, learn_type, batch):
+        """Learn a batch of mails with :py:func:`learn_mails`.
+
+        ``sa-learn`` only reports how many mails are learned and examined, so
+        the code of every mail is only known when all of them have the same
+        one. If not, their codes are ``(None, None)``: learned in the batch,
+        with an unknown outcome.
+
+        Returns:
+            LearnedMails: The result of the batch.
+
+        """
+        learned, examined = learn_mails([m for _, m in batch], learn_type,
+                                        timeout=self._timeout(len(batch)))
+        if learned in [-9999, -9998] or len(batch) == 1:
+            code = self._sa_learn_code(learned, examined)
+            return LearnedMails(batch, [code] * len(batch),
+                                len(batch) if code[0] == 5 else 0)
+        if learned == len(batch):
+            codes = [(5, 0)] * len(batch)
+        elif not examined:
+            codes = [(98, 0)] * len(batch)
+        elif not learned and examined == len(batch):
+            codes = [(6, 0)] * len(batch)
+        else:
+            self.logger.debug(__(
+                "sa-learn learned {} and examined {} of {} mails".format(
+                    learned, examined, len(batch))))
+            codes = [(None, None)] * len(batch)
+        return LearnedMails(batch, codes, learned)
+
+    def _folder_state(self, uids):
+        """Get the status of the selected folder, to detect its changes.
+
+        The ``UIDNEXT`` and the number of mails are stored in the track
+        state when all the folder is processed: if they, and the
+        ``HIGHESTMODSEQ``, don't change, the next run has nothing to do (see
+        :py:meth:`isbg.isbg.ISBG.do_spamassassin`). If we change the folder,
+        they are updated with :py:meth:`_flushed_state`.
+
+        Args:
+            uids (list(str)): The ``uids`` found by :py:meth:`search_uids`.
+        Returns:
+            dict: The ``uidnext`` and ``messages`` of the folder. It's empty
+            if :py:attr:`partialrun` could have left mails to process.
+
+        """
+        if self.partialrun and len(uids) >= int(self.partialrun):
+            return {}
+        info = getattr(self.imap, 'mailbox_info', {})
+        return {'uidnext': info.get('UIDNEXT'),
+                'messages': info.get('EXISTS')}
+
+    def _flushed_state(self, folder, folder_state, flags=False):
+        """Get the status of `folder` once our actions on it are done.
+
+        Our own ``STORE``, ``MOVE`` and ``EXPUNGE`` change the status got by
+        :py:meth:`_folder_state`, so the next run would never be skipped.
+        The folder, which is already selected, is selected again (read-only)
+        to get its new status without a ``STATUS`` command. If some mail has
+        arrived meanwhile (``UIDNEXT`` has changed) `folder_state` is kept,
+        so the next run processes it.
+
+        Args:
+            folder (str): The selected folder.
+            folder_state (dict): The status got by :py:meth:`_folder_state`.
+            flags (bool): If True, the flags of the mails are searched, so
+                their changes made by other clients while our actions were
+                sent can not be hidden: the ``HIGHESTMODSEQ`` is not stored.
+        Returns:
+            dict: The ``uidnext``, ``messages`` and ``statusmodseq`` of the
+            folder.
+
+        """
+        if folder_state.get('uidnext') is None:
+            return folder_state
+        self.imap.select(folder, True)
+        info = getattr(self.imap, 'mailbox_info', {})
+        if info.get('UIDNEXT') != folder_state['uidnext']:
+            return folder_state
+        return {'uidnext': info['UIDNEXT'], 'messages': info.get('EXISTS'),
+                'statusmodseq': None if flags else info.get('HIGHESTMODSEQ')}
+
+    @staticmethod
+    def _keep_state(newstate, state):
+        """Get the values of `newstate` keys from the old `state`."""
+        state = state or {}
+        return {k: state.get(k) for k in newstate}
+
+    def process_inbox(self, origpastuids, state=None):
+        """Run spamassassin in the folder for spam.
+
+        Args:
+            origpastuids (list(int)): ``uids`` to not process.
+            state (dict, optional): The track state of the last run, used to
+                search only the changes since then.
+        Returns:
+            Sa_Process:
+                It contains the information about the result of the process.
+
+        """
         sa_proc = Sa_Process()
 
         spamlist = []
         spamdeletelist = []
 
-        # select inbox
-        self.imap.select(self.imapsets.inbox, 1)
+        # select inbox (if it's not already selected)
+        self.imap.select(self.imapsets.inbox, 1, cached=True)
 
-        # get the uids of all mails with a size less then the maxsize
-        _, uids = self.imap.uid("SEARCH", None, "SMALLER", str(self.maxsize))
-
-        uids, sa_proc.newpastuids = SpamAssassin.get_formated_uids(
-            uids, origpastuids, self.partialrun)
+        # get the uids of all mails with a size less then the maxsize (or of
+        # all the mails, if the bigger ones are scanned truncated)
+        criteria = ["SMALLER", str(self.maxsize)]
+        if self.scantruncated:
+            criteria = ["ALL"]
+        uids, sa_proc.newpastuids, sa_proc.state = self.search_uids(
+            criteria, origpastuids, state, uidrange=True)
+        folder_state = self._folder_state(uids)
+        found, timedout = (list(uids), [])
 
         self.logger.debug(__('Got {} mails to check'.format(len(uids))))
 
+        # Only the mails that should be scanned are fetched
+        toscan, skipped, verdicts, sizes = self.prefilter(uids)
+        uids = [uid for uid in uids if uid not in skipped]
+
         if self.dryrun:
             processednum = 0
             fakespammax = 1
             processmax = 5
 
-        # Main loop that iterates over each new uid we haven't seen before
-        for uid in uids:
-            # Retrieve the entire message
-            mail = imaputils.get_message(self.imap, uid, sa_proc.uids,
-                                         logger=self.logger)
-
-            # Unwrap spamassassin reports
-            unwrapped = sa_unwrap.unwrap(mail)
-            if unwrapped is not None and unwrapped:  # len(unwrapped) > 0
-                mail = unwrapped[0]
-
-            # Feed it to SpamAssassin in test mode
-            if self.dryrun:
-                if processednum > processmax:
-                    break
-                if processednum < fakespammax:
-                    self.logger.info("Faking spam mail")
-                    score = "10/10"
-                    code = 1
-                else:
-                    self.logger.info("Faking ham mail")
-                    score = "0/10"
-                    code = 0
-                processednum = processednum + 1
-                spamassassin_result = None  # since dryrun doesn't run
-                                            # test_mail()
-            else:
-                score, code, spamassassin_result = test_mail(mail, cmd=self.cmd_test)
-                if score == "-9999":
+        # Main loop that iterates over each new uid we haven't seen before.
+        # It's a pipeline of three stages connected by bounded queues:
+        #  - fetch: a thread retrieves the entire messages, several of them
+        #    with every command (a thread for every connection of the
+        #    `fetchpool`).
+        #  - scan: up to `scanworkers` of them are tested at the same time.
+        #  - act: this thread queues the IMAP actions and sends them in
+        #    batches.
+        # The mails bigger than `maxsize` are fetched truncated
+        truncated = set()
+        if self.scantruncated:
+            truncated = set(uid for uid in toscan
+                            if sizes.get(str(uid), 0) >= self.maxsize)
+        parts = [([uid for uid in toscan if uid not in truncated], None),
+                 ([uid for uid in toscan if uid in truncated], self.maxsize)]
+        if self.fetchpool:
+            # Several read-only connections fetch the mails
+            self.fetchpool.select(self.imapsets.inbox)
+            fetches = [self.fetchpool.get_messages(
+                part, self.fetchbatch, self.fetchbytes, self.queuedepth,
+                logger=self.logger, sizes=sizes, maxbytes=maxbytes,
+                spoolsize=self.spoolsize)
+                for part, maxbytes in parts]
+        else:
+            fetches = [utils.threaded_iter(itertools.chain(*[
+                imaputils.get_messages(self.imap, part, self.fetchbatch,
+                                       self.fetchbytes, logger=self.logger,
+                                       sizes=sizes, maxbytes=maxbytes,
+                                       spoolsize=self.spoolsize)
+                for part, maxbytes in parts]), self.queuedepth)]
+        actions = imaputils.ImapActions(self.imap, self.actionbatch,
+                                        logger=self.logger)
+
+        # The mails with a trusted verdict are not fetched
+        for uid, (score, code) in verdicts.items():
+            sa_proc.uids.append(int(uid))
+            if code != 0 and self._process_spam(uid, score, None,
+                                                spamdeletelist, code, None,
+                                                actions):
+                spamlist.append(uid)
+        completed = True
+        scanned = utils.ordered_map(
+            lambda uid_mail: self._scan_mail(uid_mail,
+                                             uid_mail[0] in truncated),
+            self._until_deadline(itertools.chain(*fetches)),
+            self.scanworkers, self.scanpool)
+        try:
+            for (uid, _), (mail, score, code, spamassassin_result) in scanned:
+                sa_proc.uids.append(int(uid))
+
+                # Feed it to SpamAssassin in test mode
+                if self.dryrun:
+                    if processednum > processmax:
+                        completed = False
+                        break
+                    if processednum < fakespammax:
+                        self.logger.info("Faking spam mail")
+                        score = "10/10"
+                        code = 1
+                    else:
+                        self.logger.info("Faking ham mail")
+                        score = "0/10"
+                        code = 0
+                    processednum = processednum + 1
+                elif score == "-9999":
                     self.logger.exception(__(
                         '{} error for mail {}'.format(self.cmd_test, uid)))
                     self.logger.debug(repr(mail))
                     uids.remove(uid)
+                    completed = False
+                    continue
+                elif score == "-9998":  # it's retried in the next run.
+                    self.logger.warning(__(
+                        'Scanning mail {} has timed out'.format(uid)))
+                    sa_proc.uids.remove(int(uid))
+                    uids.remove(uid)
+                    timedout.append(uid)
                     continue
 
-            if score == "0/0\n":
-                raise isbg.ISBGError(isbg.__exitcodes__['spamc'],
-                                     "spamc -> spamd error - aborting")
-
-            self.logger.debug(__(
-                "Score for uid {}: {}".format(uid, score.strip())))
+                if score == "0/0\n":
+                    raise isbg.ISBGError(isbg.__exitcodes__['spamc'],
+                                         "spamc -> spamd error - aborting")
 
-            if code != 0:
-                # Message is spam, delete it or move it to spaminbox
-                # (optionally with report)
-                if not self._process_spam(uid, score, mail, spamdeletelist, code, spamassassin_result):
-                    continue
-                spamlist.append(uid)
+                self.logger.debug(__(
+                    "Score for uid {}: {}".format(uid, score.strip())))
+
+                if code != 0:
+                    # Message is spam, delete it or move it to spaminbox
+                    # (optionally with report)
+                    if not self._process_spam(uid, score, mail,
+                                              spamdeletelist, code,
+                                              spamassassin_result, actions,
+                                              uid in truncated):
+                        continue
+                    spamlist.append(uid)
+        finally:
+            # The fetch threads are stopped before using the connection
+            scanned.close()
+            for fetch in fetches:
+                fetch.close()
+
+        # Failed appends leave the original message alone
+        for uid in actions.flush():
+            spamlist.remove(uid)
 
         sa_proc.nummsg = len(uids)
         sa_proc.spamdeleted = len(spamdeletelist)
@@ -492,24 +1296,51 @@ class SpamAssassin(object):
                                  ' because of --dryrun')
             else:
                 self.imap.select(self.imapsets.inbox)
+                # Send every action with one command for all the uids
+                actions.batchsize = None
+                # With UIDPLUS only our deleted mails are expunged
+                deleted = []
+                uidexpunge = self.expunge and \
+                    self.imap.has_capability('UIDPLUS')
+                if self.can_move():
+                    # Copy, flag as deleted and expunge with one command
+                    for uid in spamlist:
+                        actions.move(uid, self.imapsets.spaminbox)
                 # Only set message flags if there are any
-                if self.spamflags:  # len(self.smpamflgs) > 0
+                elif self.spamflags:  # len(self.smpamflgs) > 0
                     for uid in spamlist:
-                        self.imap.uid("STORE", uid, self.spamflagscmd,
+                        actions.store(uid, self.spamflagscmd,
                                       imaputils.imapflags(self.spamflags))
                         sa_proc.newpastuids.append(uid)
+                    if "\\Deleted" in self.spamflags:
+                        deleted.extend(spamlist)
                 # If its gmail, and --delete was passed, we actually copy!
                 if self.delete and self.gmail:
                     for uid in spamlist:
-                        self.imap.uid("COPY", uid, "[Gmail]/Trash")
+                        actions.copy(uid, "[Gmail]/Trash")
                 # Set deleted flag for spam with high score
                 for uid in spamdeletelist:
                     if self.gmail is True:
-                        self.imap.uid("COPY", uid, "[Gmail]/Trash")
+                        actions.copy(uid, "[Gmail]/Trash")
                     else:
-                        self.imap.uid("STORE", uid, self.spamflagscmd,
-                                      "(\\Deleted)")
-                if self.expunge:
+                        actions.store(uid, self.spamflagscmd, "(\\Deleted)")
+                        deleted.append(uid)
+                if uidexpunge:
+                    for uid in deleted:
+                        actions.expunge(uid)
+                actions.flush()
+                if self.expunge and not uidexpunge:
                     self.imap.expunge()
+                folder_state = self._flushed_state(self.imapsets.inbox,
+                                                   folder_state)
+
+        if not completed or self.expired or self.dryrun:
+            # The failed (or not scanned) mails should be searched again.
+            sa_proc.state = SpamAssassin._keep_state(sa_proc.state, state)
+        else:
+            sa_proc.state.update(folder_state)
+        sa_proc.state['retry'] = SpamAssassin._retry_uids(
+            state, timedout, [u for u in found if int(u) not in sa_proc.uids])
+        sa_proc.state['deleted'] = sorted(int(u) for u in skipped)
 
         return sa_proc
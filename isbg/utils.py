@@ -31,10 +31,20 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
 import os
 import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from platform import python_version  # To check py version
 from subprocess import Popen, PIPE   # To call Popen
+from subprocess import TimeoutExpired
+
+try:
+    import queue  # Python 3
+except ImportError:
+    import Queue as queue  # Python 2
 
 try:
     # C implementation:
@@ -211,20 +221,191 @@ def get_ascii_or_value(value):
     return value
 
 
-def popen(cmd):
+def popen(cmd, stdin=None):
     """Create a :py:class:`subprocess.Popen` instance.
 
     It calls `Popen(cmd, stdin=PIPE, stdout=PIPE, close_fds=True)`.
 
     Args:
         cmd (str): The command to use in the call to Popen.
+        stdin (file, optional): If not ``None``, the file used as standard
+            input instead of a pipe. Defaults to ``None``.
     Returns:
         subprocess.Popen: The `Popen` object.
 
     """
+    if stdin is None:
+        stdin = PIPE
     if os.name == 'nt':
-        return Popen(cmd, stdin=PIPE, stdout=PIPE)
-    return Popen(cmd, stdin=PIPE, stdout=PIPE, close_fds=True)
+        return Popen(cmd, stdin=stdin, stdout=PIPE)
+    return Popen(cmd, stdin=stdin, stdout=PIPE, close_fds=True)
+
+
+def communicate(proc, data=None, timeout=None):
+    """Call :py:meth:`subprocess.Popen.communicate` with a timeout.
+
+    If `proc` doesn't finish in `timeout` seconds it's killed.
+
+    Args:
+        proc (subprocess.Popen): The process.
+        data (bytes, optional): The data sent to its standard input.
+        timeout (float, optional): The seconds to wait for it. If it's
+            ``None`` it waits until it finishes.
+    Returns:
+        tuple: The standard output and error of `proc`.
+    Raises:
+        subprocess.TimeoutExpired: If `proc` has been killed.
+
+    """
+    try:
+        return proc.communicate(data, timeout=timeout)
+    except TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise
+
+
+def threaded_iter(iterable, depth=1):
+    """Consume `iterable` in a background thread.
+
+    The items are passed to the calling thread through a queue holding at
+    most `depth` items, so the producer is never more than `depth` items
+    ahead of the consumer. Exceptions raised by `iterable` are raised again
+    in the calling thread.
+
+    When the returned generator is closed, the producer thread is stopped:
+    once it returns no more items are taken from `iterable`.
+
+    Args:
+        iterable (iterable): The items to produce.
+        depth (int): The size of the queue. If it's ``None`` or lower than 1,
+            `iterable` is consumed in the calling thread.
+    Yields:
+        The items of `iterable`.
+
+    """
+    if not depth or depth < 1:
+        for item in iterable:
+            yield item
+        return
+
+    merged = threaded_merge([iterable], depth)
+    try:
+        for item in merged:
+            yield item
+    finally:
+        merged.close()
+
+
+def threaded_merge(iterables, depth=1):
+    """Consume several iterables at the same time, one thread for each one.
+
+    It's :py:func:`threaded_iter` with several producers: their items are
+    yielded as soon as they are produced, so the order is only kept for the
+    items of the same iterable.
+
+    Args:
+        iterables (list(iterable)): The iterables to consume.
+        depth (int): The size of the queue shared by all the producers.
+    Yields:
+        The items of all the `iterables`.
+
+    """
+    items = queue.Queue(maxsize=max(depth or 1, 1))
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(iterable):
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    break
+            else:
+                put((done, None))
+        except BaseException:  # pylint: disable=broad-except
+            put((done, sys.exc_info()))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()  # a generator left before its end
+
+    producers = [threading.Thread(target=produce, args=(iterable,),
+                                  name="isbg-producer")
+                 for iterable in iterables]
+    for producer in producers:
+        producer.daemon = True
+        producer.start()
+    try:
+        running = len(producers)
+        while running:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error[1].with_traceback(error[2])
+                running -= 1
+                continue
+            yield item
+    finally:
+        stop.set()
+        for producer in producers:
+            producer.join()
+
+
+def ordered_map(func, iterable, workers=1, executor=None):
+    """Call `func` for every item of `iterable` with concurrent workers.
+
+    At most `workers` calls are in flight at the same time. `iterable` is
+    consumed and the results are yielded by the calling thread, in the same
+    order as the items, so only `func` runs in the workers.
+
+    Args:
+        func (callable): The function to call with every item.
+        iterable (iterable): The items.
+        workers (int): The number of concurrent calls. If it's ``None`` or
+            lower than 2, `func` is called in the calling thread.
+        executor (concurrent.futures.Executor, optional): If it's not
+            ``None``, the calls are run by it, which can be shared with
+            other callers, instead of by a new pool of `workers` threads.
+            It's not shut down.
+    Yields:
+        tuple: The item and the value returned by `func` for it.
+
+    """
+    if not workers or workers < 2:
+        for item in iterable:
+            yield item, func(item)
+        return
+
+    shared = executor is not None
+    if not shared:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    pending = collections.deque()
+    try:
+        for item in iterable:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= workers:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        if shared:
+            for _, future in pending:
+                if not future.cancelled():
+                    future.exception()  # wait for it
+        else:
+            executor.shutdown(wait=True)
 
 
 def score_from_mail(mail):
@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  fakeimapd.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""A small in-memory IMAP server used by the tests.
+
+It implements the subset of *IMAP4rev1* and its extensions used by isbg. It
+is not a complete nor a strict server.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import re
+import select
+import threading
+import zlib
+
+try:
+    import queue  # Python 3
+except ImportError:
+    import Queue as queue  # Python 2
+
+try:
+    import socketserver  # Python 3
+except ImportError:
+    import SocketServer as socketserver  # Python 2
+
+
+class Mailbox(object):
+    """A mailbox: its mails, indexed by uid, and their flags."""
+
+    def __init__(self, uidvalidity=1):
+        """Initialize a empty mailbox."""
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.modseq = 1
+        self.mails = {}   # uid -> [content, set(flags), modseq]
+
+    def add(self, content, flags=()):
+        """Add a mail, returning its uid."""
+        uid = self.uidnext
+        self.uidnext += 1
+        self.modseq += 1
+        self.mails[uid] = [content, set(flags), self.modseq]
+        return uid
+
+    def uids(self):
+        """Return the sorted uids."""
+        return sorted(self.mails)
+
+    def seq(self, uid):
+        """Return the sequence number of a uid."""
+        return self.uids().index(uid) + 1
+
+    def expunge(self, uids=None):
+        """Expunge the deleted mails (only from uids if not None)."""
+        expunged = []
+        for uid in self.uids():
+            if '\\Deleted' in self.mails[uid][1] and \
+                    (uids is None or uid in uids):
+                expunged.append(self.seq(uid))
+                del self.mails[uid]
+                self.modseq += 1
+        return expunged
+
+
+def parse_set(text, mailbox):
+    """Parse a uid sequence-set."""
+    uids = set()
+    last = max(mailbox.uids() or [0])
+    for part in text.split(','):
+        if ':' in part:
+            low, high = part.split(':')
+            low = last if low == '*' else int(low)
+            high = last if high == '*' else int(high)
+            if low > high:
+                low, high = high, low
+            uids.update(range(low, high + 1))
+        else:
+            uids.add(last if part == '*' else int(part))
+    return sorted(u for u in uids if u in mailbox.mails)
+
+
+def tokenize(line):
+    """Split a command line in tokens, keeping the parenthesized groups."""
+    tokens = []
+    i = 0
+    while i < len(line):
+        char = line[i:i + 1]
+        if char == b' ':
+            i += 1
+        elif char == b'"':
+            match = re.compile(br'"((?:[^"\\]|\\.)*)"').match(line, i)
+            tokens.append(re.sub(br'\\(.)', br'\1', match.group(1)).decode())
+            i = match.end()
+        elif char == b'(':
+            depth, end = 0, i
+            while True:
+                if line[end:end + 1] == b'(':
+                    depth += 1
+                elif line[end:end + 1] == b')':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                end += 1
+            tokens.append(line[i:end + 1].decode())
+            i = end + 1
+        else:
+            end = line.find(b' ', i)
+            end = len(line) if end < 0 else end
+            tokens.append(line[i:end].decode())
+            i = end
+    return tokens
+
+
+class DeflateReader(object):
+    """Read the stream of a client after COMPRESS DEFLATE."""
+
+    def __init__(self, rfile):
+        """Decompress the data read from `rfile`."""
+        self.rfile = rfile
+        self.decompressor = zlib.decompressobj(-15)
+        self.buffer = b''
+
+    def _fill(self):
+        data = self.rfile.read1(65536)
+        self.buffer += self.decompressor.decompress(data)
+        return bool(data)
+
+    def readline(self):
+        """Read a line."""
+        while b'\n' not in self.buffer and self._fill():
+            pass
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def read(self, size):
+        """Read `size` bytes."""
+        while len(self.buffer) < size and self._fill():
+            pass
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        """Close the underlying file."""
+        self.rfile.close()
+
+
+class FakeImapHandler(socketserver.StreamRequestHandler):
+    """Handle a IMAP connection."""
+
+    def send(self, data):
+        """Send a line or bytes."""
+        if not isinstance(data, bytes):
+            data = data.encode()
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + \
+                self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def readcommand(self):
+        """Read a command line, with its literals, as tokens."""
+        tokens = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return None
+            line = line.rstrip(b'\r\n')
+            literal = re.search(br'\{(\d+)(\+?)\}$', line)
+            if literal is None:
+                tokens.extend(tokenize(line))
+                return tokens
+            tokens.extend(tokenize(line[:literal.start()]))
+            if not literal.group(2):
+                self.send("+ go ahead\r\n")
+            tokens.append(self.rfile.read(int(literal.group(1))))
+
+    def handle(self):
+        """Handle the connection."""
+        self.selected = None
+        self.readonly = True
+        self.compressor = None
+        self.send("* OK [CAPABILITY {}] fake imapd ready\r\n".format(
+            ' '.join(self.server.capabilities)))
+        while True:
+            tokens = self.readcommand()
+            if not tokens:
+                return
+            self.server.commands.append(tokens)
+            tag, command, args = tokens[0], tokens[1].upper(), tokens[2:]
+            if command == 'UID':
+                command, args = 'UID ' + args[0].upper(), args[1:]
+            method = getattr(self, 'do_' + command.replace(' ', '_'), None)
+            if method is None:
+                self.send("{} BAD unknown command\r\n".format(tag))
+                continue
+            with self.server.lock:
+                res = method(tag, args)
+            if res is False:
+                return
+            if res is True:
+                continue  # already answered
+            if res is None:
+                res = "OK {} completed".format(command)
+            self.send("{} {}\r\n".format(tag, res))
+
+    def do_CAPABILITY(self, tag, args):
+        """CAPABILITY command."""
+        self.send("* CAPABILITY {}\r\n".format(
+            ' '.join(self.server.capabilities)))
+
+    def do_LOGIN(self, tag, args):
+        """LOGIN command."""
+        if self.server.max_logins is not None and \
+                self.server.logins >= self.server.max_logins:
+            return "NO [LIMIT] too many connections"
+        self.server.logins += 1
+        if self.server.login_capabilities:
+            return "OK [CAPABILITY {}] logged in".format(
+                ' '.join(self.server.login_capabilities))
+
+    def do_LOGOUT(self, tag, args):
+        """LOGOUT command."""
+        self.send("* BYE bye\r\n{} OK LOGOUT completed\r\n".format(tag))
+        return False
+
+    def do_NOOP(self, tag, args):
+        """NOOP command."""
+
+    def do_COMPRESS(self, tag, args):
+        """COMPRESS command: the next data is compressed."""
+        if args[0].upper() != 'DEFLATE' or self.compressor is not None:
+            return "BAD can't compress"
+        self.send("{} OK DEFLATE active\r\n".format(tag))
+        self.rfile = DeflateReader(self.rfile)
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                           zlib.DEFLATED, -15)
+        return True
+
+    def do_ENABLE(self, tag, args):
+        """ENABLE command."""
+        self.send("* ENABLED {}\r\n".format(' '.join(args)))
+
+    def do_LIST(self, tag, args):
+        """LIST command, with the LIST-STATUS return option."""
+        names = sorted(self.server.mailboxes)
+        if len(args) > 1 and args[1].startswith('('):
+            names = [n for n in re.findall(r'"([^"]*)"', args[1])
+                     if n in self.server.mailboxes]
+        for name in names:
+            self.send('* LIST () "/" "{}"\r\n'.format(name))
+            if len(args) > 3 and args[2].upper() == 'RETURN':
+                items = re.search(r'STATUS \(([^)]*)\)', args[3].upper())
+                self.do_STATUS(tag, [name, '(' + items.group(1) + ')'])
+
+    def do_SELECT(self, tag, args, readonly=False):
+        """SELECT command."""
+        name = args[0]
+        if name not in self.server.mailboxes:
+            self.selected = None
+            return "NO no such mailbox"
+        self.selected = self.server.mailboxes[name]
+        self.readonly = readonly
+        self.send("* {} EXISTS\r\n".format(len(self.selected.mails)))
+        self.send("* OK [UIDVALIDITY {}] ok\r\n".format(
+            self.selected.uidvalidity))
+        self.send("* OK [UIDNEXT {}] ok\r\n".format(self.selected.uidnext))
+        if 'CONDSTORE' in (self.server.capabilities +
+                           self.server.login_capabilities):
+            self.send("* OK [HIGHESTMODSEQ {}] ok\r\n".format(
+                self.selected.modseq))
+        return "OK [{}] selected".format(
+            "READ-ONLY" if readonly else "READ-WRITE")
+
+    def do_EXAMINE(self, tag, args):
+        """EXAMINE command."""
+        return self.do_SELECT(tag, args, readonly=True)
+
+    def do_STATUS(self, tag, args):
+        """STATUS command."""
+        if args[0] not in self.server.mailboxes:
+            return "NO no such mailbox"
+        mbox = self.server.mailboxes[args[0]]
+        values = {'MESSAGES': len(mbox.mails), 'UIDNEXT': mbox.uidnext,
+                  'UIDVALIDITY': mbox.uidvalidity,
+                  'HIGHESTMODSEQ': mbox.modseq, 'UNSEEN': 0, 'RECENT': 0}
+        items = args[1].strip('()').split()
+        self.send('* STATUS "{}" ({})\r\n'.format(args[0], ' '.join(
+            "{} {}".format(i.upper(), values[i.upper()]) for i in items)))
+
+    def do_APPEND(self, tag, args):
+        """APPEND command, with MULTIAPPEND."""
+        if args[0] not in self.server.mailboxes:
+            return "NO [TRYCREATE] no such mailbox"
+        mbox = self.server.mailboxes[args[0]]
+        uids = []
+        flags = ()
+        for arg in args[1:]:
+            if isinstance(arg, bytes):
+                uids.append(mbox.add(arg, flags))
+                flags = ()
+            elif arg.startswith('('):
+                flags = arg.strip('()').split()
+        return "OK [APPENDUID {} {}] APPEND completed".format(
+            mbox.uidvalidity, ','.join(str(u) for u in uids))
+
+    def do_EXPUNGE(self, tag, args):
+        """EXPUNGE command."""
+        for seq in reversed(self.selected.expunge()):
+            self.send("* {} EXPUNGE\r\n".format(seq))
+
+    def do_UID_EXPUNGE(self, tag, args):
+        """UID EXPUNGE command."""
+        uids = parse_set(args[0], self.selected)
+        for seq in reversed(self.selected.expunge(uids)):
+            self.send("* {} EXPUNGE\r\n".format(seq))
+
+    def do_UID_SEARCH(self, tag, args):
+        """UID SEARCH command."""
+        mbox = self.selected
+        found = set(mbox.uids())
+        args = [a.strip('()').upper() for a in args if a.upper() != 'NIL']
+        i = 0
+        while i < len(args):
+            key = args[i]
+            if key == 'SMALLER':
+                found &= set(u for u in found
+                             if len(mbox.mails[u][0]) < int(args[i + 1]))
+                i += 1
+            elif key == 'LARGER':
+                found &= set(u for u in found
+                             if len(mbox.mails[u][0]) > int(args[i + 1]))
+                i += 1
+            elif key == 'UID':
+                found &= set(parse_set(args[i + 1], mbox))
+                i += 1
+            elif key == 'MODSEQ':
+                found &= set(u for u in found
+                             if mbox.mails[u][2] >= int(args[i + 1]))
+                i += 1
+            elif key == 'FLAGGED':
+                found &= set(u for u in found
+                             if '\\Flagged' in mbox.mails[u][1])
+            elif key == 'UNFLAGGED':
+                found &= set(u for u in found
+                             if '\\Flagged' not in mbox.mails[u][1])
+            i += 1
+        modseq = ''
+        if 'MODSEQ' in args and found:
+            modseq = ' (MODSEQ {})'.format(
+                max(mbox.mails[u][2] for u in found))
+        self.send("* SEARCH {}{}\r\n".format(
+            ' '.join(str(u) for u in sorted(found)), modseq).replace(
+                ' \r', '\r'))
+
+    def do_UID_FETCH(self, tag, args):
+        """UID FETCH command."""
+        mbox = self.selected
+        items = args[1].upper()
+        for uid in parse_set(args[0], mbox):
+            content, flags, modseq = mbox.mails[uid]
+            out = "* {} FETCH (UID {}".format(mbox.seq(uid), uid).encode()
+            if 'RFC822.SIZE' in items:
+                out += " RFC822.SIZE {}".format(len(content)).encode()
+            if 'FLAGS' in items:
+                out += " FLAGS ({})".format(' '.join(sorted(flags))).encode()
+            if 'MODSEQ' in items:
+                out += " MODSEQ ({})".format(modseq).encode()
+            fields = re.search(r'HEADER\.FIELDS \(([^)]*)\)', items)
+            if fields is not None:
+                names = fields.group(1).lower().split()
+                header = content.split(b'\n\n')[0].split(b'\r\n\r\n')[0]
+                lines = [line for line in re.split(br'\r?\n(?![ \t])', header)
+                         if line.split(b':')[0].strip().decode().lower()
+                         in names]
+                data = b''.join(line + b'\r\n' for line in lines) + b'\r\n'
+                out += " BODY[HEADER.FIELDS ({})] {{{}}}\r\n".format(
+                    fields.group(1), len(data)).encode() + data
+            partial = re.search(r'BODY\.PEEK\[\]<(\d+)\.(\d+)>', items)
+            if partial is not None:
+                start, count = int(partial.group(1)), int(partial.group(2))
+                data = content[start:start + count]
+                out += " BODY[]<{}> {{{}}}\r\n".format(
+                    start, len(data)).encode() + data
+            elif 'BODY.PEEK[]' in items or 'BODY[]' in items:
+                out += " BODY[] {{{}}}\r\n".format(
+                    len(content)).encode() + content
+            self.send(out + b")\r\n")
+
+    def do_UID_STORE(self, tag, args):
+        """UID STORE command."""
+        mbox = self.selected
+        flags = args[2].strip('()').replace(',', ' ').split()
+        for uid in parse_set(args[0], mbox):
+            mbox.modseq += 1
+            mbox.mails[uid][2] = mbox.modseq
+            if args[1].upper().startswith('+'):
+                mbox.mails[uid][1].update(flags)
+            elif args[1].upper().startswith('-'):
+                mbox.mails[uid][1].difference_update(flags)
+            else:
+                mbox.mails[uid][1] = set(flags)
+
+    def do_UID_COPY(self, tag, args):
+        """UID COPY command."""
+        if args[1] not in self.server.mailboxes:
+            return "NO [TRYCREATE] no such mailbox"
+        dest = self.server.mailboxes[args[1]]
+        for uid in parse_set(args[0], self.selected):
+            dest.add(*self.selected.mails[uid][:2])
+
+    def do_UID_MOVE(self, tag, args):
+        """UID MOVE command."""
+        res = self.do_UID_COPY(tag, args)
+        if res is not None:
+            return res
+        uids = parse_set(args[0], self.selected)
+        for uid in uids:
+            self.selected.mails[uid][1].add('\\Deleted')
+        for seq in reversed(self.selected.expunge(uids)):
+            self.send("* {} EXPUNGE\r\n".format(seq))
+
+    def do_IDLE(self, tag, args):
+        """IDLE command: send the queued events until DONE."""
+        self.server.lock.release()
+        try:
+            self.send(self.server.idle_continuation)
+            self.server.idling.set()
+            while True:
+                try:
+                    self.send(self.server.events.get(timeout=0.02))
+                except queue.Empty:
+                    pass
+                ready, _, _ = select.select([self.connection], [], [], 0)
+                if ready:
+                    line = self.rfile.readline()
+                    if line.strip().upper() == b'DONE':
+                        break
+        finally:
+            self.server.idling.clear()
+            self.server.lock.acquire()
+        return "OK IDLE terminated"
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    """A threaded fake IMAP server listening in localhost.
+
+    Attributes:
+        capabilities (list): The advertised capabilities.
+        login_capabilities (list): If not empty, the capabilities sent in the
+            ``LOGIN`` response.
+        max_logins (int): If not ``None``, the number of ``LOGIN`` commands
+            accepted.
+        logins (int): The number of accepted ``LOGIN`` commands.
+        mailboxes (dict): The mailboxes, indexed by name.
+        commands (list): The received commands, as tokens.
+        events (queue.Queue): Lines sent to the idling clients.
+        idle_continuation (str): The continuation sent to ``IDLE``, with the
+            untagged lines sent with it in the same write.
+
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 50
+
+    def __init__(self, capabilities=None):
+        """Initialize the server, with a empty INBOX and INBOX.Spam."""
+        socketserver.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), FakeImapHandler)
+        self.capabilities = capabilities or ['IMAP4rev1', 'IDLE']
+        self.login_capabilities = []
+        self.max_logins, self.logins = (None, 0)
+        self.mailboxes = {'INBOX': Mailbox(), 'INBOX.Spam': Mailbox()}
+        self.commands = []
+        self.events = queue.Queue()
+        self.idle_continuation = "+ idling\r\n"
+        self.idling = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def port(self):
+        """The port the server is listening to."""
+        return self.server_address[1]
+
+    def start(self):
+        """Serve in a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        self.shutdown()
+        self.server_close()
+
+    def command_names(self):
+        """Return the names of the received commands."""
+        names = []
+        for tokens in self.commands:
+            name = tokens[1].upper()
+            if name == 'UID':
+                name += ' ' + tokens[2].upper()
+            names.append(name)
+        return names
@@ -163,6 +163,16 @@ def test_parse_args():
         __main__.parse_args(sbg)
         pytest.fail("It should rise a invalid literal " + "ValueError")
 
+    # Parse with bogus imapbackend
+    del sys.argv[1:]
+    for op in ["--imaphost", "localhost", "--imapuser", "anonymous",
+               "--imappasswd", "none", "--dryrun", "--imapbackend", "foo"]:
+        sys.argv.append(op)
+    sbg = isbg.ISBG()
+    with pytest.raises(isbg.ISBGError, match="Unknown IMAP backend"):
+        __main__.parse_args(sbg)
+        pytest.fail("It should rise a Unknown IMAP backend ISBGError")
+
     # Parse with ok partialrun and verbose and nossl
     del sys.argv[1:]
     for op in ["--imaphost", "localhost", "--imapuser", "anonymous",
@@ -172,6 +182,16 @@ def test_parse_args():
     sbg = isbg.ISBG()
     __main__.parse_args(sbg)
     assert sbg.partialrun == 10
+    assert sbg.actionbatch == 100
+
+    # Parse with actionbatch 0: the actions are sent at the end
+    del sys.argv[1:]
+    for op in ["--imaphost", "localhost", "--imapuser", "anonymous",
+               "--imappasswd", "none", "--actionbatch", "0"]:
+        sys.argv.append(op)
+    sbg = isbg.ISBG()
+    __main__.parse_args(sbg)
+    assert sbg.actionbatch is None
 
     # Restore pytest options:
     del sys.argv[1:]
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_aioimap.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Tests for aioimap.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import asyncio
+import imaplib
+import os
+import sys
+import threading
+try:
+    from unittest import mock  # Python 3
+except ImportError:
+    try:
+        import mock                # Python 2
+    except ImportError:
+        pass
+try:
+    import pytest
+except ImportError:
+    pass
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+from isbg import aioimap    # noqa: E402
+from isbg import imaputils  # noqa: E402
+import fakeimapd            # noqa: E402
+
+
+@pytest.fixture
+def imapd():
+    """Run a fake IMAP server."""
+    server = fakeimapd.FakeImapServer().start()
+    yield server
+    server.stop()
+
+
+def test_commands(imapd):
+    """Test the commands of IsbgAioImap4."""
+    imap = aioimap.IsbgAioImap4('127.0.0.1', imapd.port, nossl=True)
+    assert isinstance(imap, imaputils.IsbgImap4)
+    assert imap.has_capability('idle')
+    assert imap.login('user', 'pass') == ('OK', ['LOGIN completed'])
+    assert imap.capability() == ('OK', ['IMAP4rev1 IDLE'])
+    assert imap.list()[1] == ['() "/" "INBOX"', '() "/" "INBOX.Spam"']
+    assert imap.get_uidvalidity('INBOX') == 1
+
+    # A synchronizing literal:
+    res = imap.append('INBOX', None, None, b"Subject: one\n\n1")
+    assert res[0] == 'OK'
+    assert imapd.mailboxes['INBOX'].mails[1][0] == b"Subject: one\r\n\r\n1"
+    imap.append('INBOX', '\\Seen', None, b"Subject: two\r\n\r\n2")
+    assert imapd.mailboxes['INBOX'].mails[2][1] == set(['\\Seen'])
+    assert imap.status_mailboxes(['INBOX', 'INBOX.Spam', 'Foo'],
+                                 ['MESSAGES', 'UIDNEXT']) == {
+        'INBOX': {'MESSAGES': 2, 'UIDNEXT': 3},
+        'INBOX.Spam': {'MESSAGES': 0, 'UIDNEXT': 1}}
+    # MULTIAPPEND, with synchronizing literals:
+    res = imap.append_messages('INBOX.Spam', [b"Subject: a\n\nA",
+                                              b"Subject: b\r\n\r\nB"])
+    assert res[0] == 'OK'
+    assert [m[0] for m in imapd.mailboxes['INBOX.Spam'].mails.values()] == [
+        b"Subject: a\r\n\r\nA", b"Subject: b\r\n\r\nB"]
+    assert imap.append_messages('Foo', [b"a", b"b"])[0] == 'NO'
+
+    assert imap.select('INBOX') == ('OK', ['2'])
+    assert imap.mailbox_info == {'EXISTS': 2, 'UIDVALIDITY': 1,
+                                 'UIDNEXT': 3}
+    assert imap.uid('SEARCH', 'ALL') == ('OK', ['1 2'])
+    assert imap.uid('FETCH', '1:2', '(BODY.PEEK[])') == ('OK', [
+        ('1 (UID 1 BODY[] {17}', 'Subject: one\r\n\r\n1'), ')',
+        ('2 (UID 2 BODY[] {17}', 'Subject: two\r\n\r\n2'), ')'])
+    mails = dict(imaputils.get_messages(imap, ['2', '1', '5']))
+    assert mails['2']['Subject'] == 'two'
+    assert mails['5'].as_string() == '\n', "Missing mails are empty."
+    assert imap.uid('STORE', '1', '+FLAGS', '(\\Deleted)')[0] == 'OK'
+    assert imap.expunge() == ('OK', ['1'])
+    assert imap.select('Foo')[0] == 'NO'
+    with pytest.raises(imaplib.IMAP4.error):
+        imap.uid('FOO', '1')
+    assert imap.logout()[0] == 'BYE'
+
+
+def test_login_quoted(imapd):
+    """Test the LOGIN arguments are quoted."""
+    imap = aioimap.IsbgAioImap4('127.0.0.1', imapd.port, nossl=True)
+    assert imap.login('my "user"', 'pa ss\\')[0] == 'OK'
+    login = imapd.command_names().index('LOGIN')
+    assert imapd.commands[login][2:] == ['my "user"', 'pa ss\\']
+    imap.logout()
+
+
+def test_run_timeout(imapd):
+    """Test the commands are bounded by the socket timeout."""
+    import socket
+    imap = aioimap.IsbgAioImap4('127.0.0.1', imapd.port, nossl=True)
+    imap.login('user', 'pass')
+    timeout = socket.getdefaulttimeout()
+    socket.setdefaulttimeout(0.2)
+    try:
+        with imapd.lock:  # the server doesn't answer
+            with pytest.raises(socket.timeout):
+                imap.capability()
+    finally:
+        socket.setdefaulttimeout(timeout)
+    assert imap.capability()[0] == 'OK'
+    imap.logout()
+
+
+def test_pipeline(imapd):
+    """Test pipelined commands."""
+    imapd.capabilities.append('LITERAL+')
+    imap = aioimap.IsbgAioImap4('127.0.0.1', imapd.port, nossl=True)
+    imap.login('user', 'pass')
+    res = imap.pipeline(
+        [('APPEND', 'INBOX', '{{{}+}}\r\nSubject: {}\r\n\r\nhi'.format(
+            15 + len(str(num)), num)) for num in range(10)] +
+        [('STATUS', 'INBOX', '(MESSAGES)'), ('SELECT', 'INBOX'),
+         ('UID', 'SEARCH', 'ALL')])
+    assert [r.typ for r in res] == ['OK'] * 13
+    assert res[10].untagged['STATUS'] == [b'"INBOX" (MESSAGES 10)']
+    assert res[11].untagged['EXISTS'] == [b'10']
+    assert res[12].untagged['SEARCH'] == [b'1 2 3 4 5 6 7 8 9 10']
+
+    # The commands of several threads are pipelined too:
+    results = {}
+
+    def fetch(uid):
+        results[uid] = imap.uid('FETCH', str(uid), '(BODY.PEEK[])')
+    threads = [threading.Thread(target=fetch, args=(uid,))
+               for uid in range(1, 11)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [results[uid][1][0][1] for uid in range(1, 11)] == [
+        'Subject: {}\r\n\r\nhi'.format(num) for num in range(10)]
+
+    # The literals are not synchronizing with LITERAL+:
+    imap.append('INBOX', None, None, b"Subject: 11\r\n\r\nhi")
+    assert imapd.command_names()[-1] == 'APPEND'
+    res = imap.append_messages('INBOX.Spam', [b"a", b"b"])
+    assert res == ('OK', ['[APPENDUID 1 1,2] APPEND completed'])
+    imap.logout()
+
+    # The status is asked with LIST-STATUS:
+    imapd.capabilities.append('LIST-STATUS')
+    imap = aioimap.IsbgAioImap4('127.0.0.1', imapd.port, nossl=True)
+    imap.login('user', 'pass')
+    assert imap.status_mailboxes(['INBOX'], ['MESSAGES']) == {
+        'INBOX': {'MESSAGES': 11}}
+    assert imapd.command_names()[-1] == 'LIST'
+    imap.logout()
+
+
+def test_untagged_routing():
+    """Test the untagged responses are stored for the right command."""
+    class Writer(object):
+        def write(self, data):
+            pass
+
+        async def drain(self):
+            pass
+
+        def close(self):
+            pass
+
+    async def commands():
+        reader = asyncio.StreamReader()
+        imap = aioimap.AioImap(reader, Writer())
+        imap._reader_task = asyncio.ensure_future(imap._read_responses())
+        futures = [await imap._send('UID', ['SEARCH', 'ALL']),
+                   await imap._send('UID', ['FETCH', '2', '(FLAGS)']),
+                   await imap._send('STATUS', ['INBOX', '(MESSAGES)'])]
+        # The responses of the last commands come before the first is done:
+        reader.feed_data(b"* 2 FETCH (UID 2 FLAGS ())\r\n"
+                         b"* STATUS INBOX (MESSAGES 3)\r\n"
+                         b"* SEARCH 1 2\r\n* 3 EXISTS\r\n"
+                         b"ISBG1 OK done\r\nISBG2 OK done\r\n"
+                         b"ISBG3 OK done\r\n")
+        res = await asyncio.gather(*futures)
+        await imap.close()
+        return imap, res
+
+    imap, (search, fetch, status) = aioimap.run(commands())
+    assert search.untagged == {'SEARCH': [b'1 2']}
+    assert fetch.untagged == {'FETCH': [b'2 (UID 2 FLAGS ())']}
+    assert status.untagged == {'STATUS': [b'INBOX (MESSAGES 3)']}
+    assert imap.unsolicited == {'EXISTS': [b'3']}
+
+
+def test_connections(imapd):
+    """Test many connections sharing the event loop."""
+    async def status(num):
+        imap = await aioimap.AioImap.open('127.0.0.1', imapd.port)
+        await imap.command('LOGIN', 'user{}'.format(num),
+                           aioimap.quote('pa"ss'))
+        res = await imap.command('STATUS', 'INBOX', '(UIDNEXT)')
+        await imap.command('LOGOUT')
+        await imap.close()
+        return res.untagged['STATUS'][0]
+
+    async def status_all():
+        return await asyncio.gather(*[status(num) for num in range(20)])
+    assert aioimap.run(status_all()) == [b'"INBOX" (UIDNEXT 1)'] * 20
+    assert imapd.logins == 20
+
+
+def test_idle(imapd):
+    """Test IsbgAioImap4.idle."""
+    imap = aioimap.IsbgAioImap4('127.0.0.1', imapd.port, nossl=True)
+    imap.login('user', 'pass')
+    imap.select('INBOX')
+    assert imap.idle(0.1) == []
+
+    def notify():
+        imapd.idling.wait(5)
+        imapd.events.put("* 1 EXISTS\r\n")
+    thread = threading.Thread(target=notify)
+    thread.start()
+    assert imap.idle(5) == ['* 1 EXISTS']
+    thread.join()
+    assert imap.select('INBOX') == ('OK', ['0'])
+    imap.logout()
+
+
+def test_login_imap(imapd):
+    """Test login_imap with the asyncio backend."""
+    imapsets = imaputils.ImapSettings()
+    imapsets.host, imapsets.port, imapsets.nossl = (
+        '127.0.0.1', imapd.port, True)
+    imapsets.user, imapsets.passwd = ('user', 'pass')
+    imapd.capabilities += ['ENABLE', 'CONDSTORE']
+    imap = imaputils.login_imap(imapsets, backend='asyncio')
+    assert isinstance(imap, aioimap.IsbgAioImap4)
+    assert imap.condstore
+    imap.select('INBOX')
+    assert imap.mailbox_info['HIGHESTMODSEQ'] == 1
+    assert imap.get_uidvalidity('INBOX') == 1
+    assert imap.select('INBOX', cached=True)[0] == 'OK'
+    assert imapd.command_names() == ['LOGIN', 'CAPABILITY', 'ENABLE',
+                                     'SELECT']
+    imap.logout()
+
+    # COMPRESS is refused, and it's logged:
+    imapd.capabilities.append('COMPRESS=DEFLATE')
+    logger = mock.Mock()
+    imap = imaputils.login_imap(imapsets, logger=logger, backend='asyncio')
+    assert imap.compression is None
+    assert 'COMPRESS' not in imapd.command_names()
+    assert "COMPRESS=DEFLATE not enabled with the asyncio backend" in [
+        str(call[0][0]) for call in logger.debug.call_args_list]
+    imap.logout()
+
+    pool = imaputils.ImapPool(imapsets, 2, backend='asyncio')
+    assert len(pool) == 2
+    pool.logout()
+    with pytest.raises(ValueError, match="Unknown IMAP backend"):
+        imaputils.login_imap(imapsets, backend='foo')
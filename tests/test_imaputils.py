@@ -31,7 +31,10 @@ from __future__ import unicode_literals
 import email
 import logging
 import os
+import socket
 import sys
+import threading
+import time
 try:
     import pytest
 except ImportError:
@@ -42,7 +45,10 @@ from socket import gaierror
 # We add the upper dir to the path
 sys.path.insert(0, os.path.abspath(os.path.join(
     os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 from isbg import imaputils  # noqa: E402
+from isbg import isbg       # noqa: E402
+import fakeimapd            # noqa: E402
 
 
 def test_mail_content():
@@ -80,12 +86,172 @@ def test_new_message():
     assert isinstance(foo, email.message.Message)
 
 
+def test_rawmessage():
+    """Test RawMessage."""
+    content = b"Subject: test\r\nX-Foo: bar\r\n\r\nBody\r\n"
+    mail = imaputils.RawMessage(content)
+    assert imaputils.mail_content(mail) is content, "It's not serialized."
+    assert mail._message is None, "It's not parsed until it's needed."
+    assert len(mail) == len(content)
+    assert mail['Subject'] == 'test'
+    assert 'X-Foo' in mail
+    assert mail.get_payload() == "Body\r\n"
+    assert isinstance(mail.message, email.message.Message)
+    assert imaputils.RawMessage("Subject: ñ\n\n").raw == \
+        "Subject: ñ\n\n".encode('utf-8')
+    with pytest.raises(TypeError, match="cannot be empty"):
+        imaputils.RawMessage(b"\r\n")
+    assert imaputils.mail_file(mail) is None
+    with imaputils.mail_buffer(mail) as buf:
+        assert buf is content
+
+    # Spooled to a file:
+    mail = imaputils.RawMessage(content, spoolsize=10)
+    assert mail._raw is None, "It's not kept in memory."
+    assert len(mail) == len(content)
+    assert imaputils.mail_content(mail) == content
+    with imaputils.mail_buffer(mail) as buf:
+        assert buf[:] == content
+    assert buf.closed, "The map is closed."
+    assert mail['Subject'] == 'test'
+    spool = imaputils.mail_file(mail)
+    assert spool.read() == content
+    assert imaputils.mail_file(mail).read() == content, "It's rewound."
+    assert repr(mail) == "RawMessage({} bytes, spooled)".format(len(content))
+    assert imaputils.RawMessage(content, spoolsize=100).file is None
+
+
 def test_get_message():
     """Test get_message."""
     # FIXME:
     pass
 
 
+class FakeImap(object):
+    """A fake IsbgImap4 replying to ``UID FETCH`` commands."""
+
+    def __init__(self, mails):
+        """Store the mails indexed by uid."""
+        self.mails = mails
+        self.commands = []
+
+    def uid(self, command, *args):
+        """Reply to the FETCH command as imaplib does."""
+        self.commands.append((command,) + args)
+        data = []
+        for uid in args[0].split(','):
+            if uid not in self.mails:
+                continue
+            if 'RFC822.SIZE' in args[1]:
+                data.append('1 (UID {} RFC822.SIZE {})'.format(
+                    uid, len(self.mails[uid])))
+            else:
+                data.append(('1 (UID {} BODY[] {{{}}}'.format(
+                    uid, len(self.mails[uid])), self.mails[uid]))
+                data.append(')')
+        return 'OK', data
+
+
+def test_fetch_batches():
+    """Test fetch_batches."""
+    uids = ['5', '4', '3', '2', '1']
+    assert imaputils.fetch_batches(uids, 2) == [['5', '4'], ['3', '2'],
+                                                ['1']]
+    assert imaputils.fetch_batches(uids, None) == [uids]
+    sizes = {'5': 10, '4': 10, '3': 30, '2': 5, '1': 5}
+    assert imaputils.fetch_batches(uids, 10, 20, sizes) == [
+        ['5', '4'], ['3'], ['2', '1']]
+
+
+def test_get_messages():
+    """Test get_messages."""
+    imap = FakeImap({'1': b'Subject: one\n\n1', '2': b'Subject: two\n\n2',
+                     '3': b'Subject: three\n\n3'})
+    uids = []
+    mails = list(imaputils.get_messages(imap, ['3', '2', '9', '1'],
+                                        batchsize=2, append_to=uids))
+    assert [uid for uid, _ in mails] == ['3', '2', '1', '9']
+    assert mails[0][1]['Subject'] == 'three'
+    assert mails[3][1].as_string() == '\n', "Missing mails are empty."
+    assert sorted(uids) == [1, 2, 3, 9]
+    assert [c[1] for c in imap.commands] == ['3,2', '9,1']
+
+    imap.commands = []
+    mails = list(imaputils.get_messages(imap, ['3', '2', '1'], batchsize=10,
+                                        batchbytes=32))
+    assert [c[1] for c in imap.commands] == ['3,2,1', '3,2', '1']
+
+
+def test_imapactions():
+    """Test ImapActions."""
+    class Imap(object):
+        def __init__(self):
+            self.commands = []
+
+        def uid_unchecked(self, command, *args):
+            self.commands.append((command,) + args)
+            if command == 'COPY' and args[1] == 'Missing':
+                return 'NO', [b'[TRYCREATE] no such mailbox']
+            return 'OK', []
+
+        def append(self, mailbox, flags, date_time, message):
+            self.commands.append(('APPEND', mailbox, message))
+            return ('NO', []) if message == 'bad' else ('OK', [])
+
+    imap = Imap()
+    actions = imaputils.ImapActions(imap, batchsize=None)
+    actions.store(1, '+FLAGS', '(\\Deleted)')
+    actions.copy(1, 'Spam')
+    actions.copy(2, 'Spam')
+    actions.append('Spam', 'bad', 3)
+    actions.store(2, '+FLAGS', '(\\Deleted)')
+    assert imap.commands == []
+    assert actions.flush() == [3]
+    assert imap.commands == [('APPEND', 'Spam', 'bad'),
+                             ('COPY', '1,2', 'Spam'),
+                             ('STORE', '1,2', '+FLAGS', '(\\Deleted)')]
+
+    imap.commands = []
+    actions = imaputils.ImapActions(imap, batchsize=None)
+    for uid in [7, 3, 4, 5, 6, 10]:
+        actions.store(uid, '+FLAGS', '(\\Deleted)')
+    actions.flush()
+    assert imap.commands == [('STORE', '3:7,10', '+FLAGS', '(\\Deleted)')]
+
+    imap.commands = []
+    actions = imaputils.ImapActions(imap, batchsize=2)
+    actions.copy(1, 'Spam')
+    assert imap.commands == []
+    actions.copy(2, 'Spam')
+    assert imap.commands == [('COPY', '1,2', 'Spam')]
+
+    # The mails not copied are not deleted:
+    imap.commands = []
+    actions = imaputils.ImapActions(imap, batchsize=None)
+    for uid in [1, 2, 3]:
+        actions.copy(uid, 'Missing' if uid == 2 else 'Spam')
+        actions.store(uid, '+FLAGS', '(\\Deleted)')
+        actions.expunge(uid)
+    assert actions.flush() == ['2']
+    assert imap.commands == [('COPY', '1,3', 'Spam'),
+                             ('COPY', '2', 'Missing'),
+                             ('STORE', '1,3', '+FLAGS', '(\\Deleted)'),
+                             ('EXPUNGE', '1,3')]
+
+
+def test_sequence_sets():
+    """Test sequence_sets."""
+    assert imaputils.sequence_sets([]) == []
+    assert imaputils.sequence_sets(['3', 1, 2, 4, 9, 11, 12, 4]) == [
+        '1:4,9,11,12']
+    assert imaputils.sequence_sets(range(1, 10, 2), 5) == ['1,3,5', '7,9']
+    seqsets = imaputils.sequence_sets(range(1, 20000, 2))
+    assert len(seqsets) > 1
+    assert all(len(s) <= imaputils.__seqset_maxlen__ for s in seqsets)
+    assert sorted(int(u) for s in seqsets for u in s.split(',')) == list(
+        range(1, 20000, 2))
+
+
 def test_imapflags():
     """Test imapflags."""
     assert imaputils.imapflags(['foo', 'boo']) == '(foo,boo)'
@@ -100,12 +266,214 @@ def test_login_imap():
     imapsets = imaputils.ImapSettings()
     imapsets.host = ''  # don't try to connect to internet
     imapsets.nossl = True
-    with pytest.raises(Exception, match="[Errno -5]"):
+    with pytest.raises(socket.error, match="[Errno -5]"):
         imaputils.login_imap(imapsets, logger=logging.getLogger(__name__))
         pytest.fail("No address associated with hostname")
     # FIXME: require network
 
 
+@pytest.fixture
+def imapd():
+    """Run a fake IMAP server."""
+    server = fakeimapd.FakeImapServer().start()
+    yield server
+    server.stop()
+
+
+def test_idle(imapd):
+    """Test IsbgImap4.idle."""
+    imap = imaputils.IsbgImap4('127.0.0.1', imapd.port, nossl=True)
+    assert imap.has_capability('idle')
+    assert not imap.has_capability('MOVE')
+    imap.login('user', 'pass')
+    imap.select('INBOX')
+
+    # Nothing happens:
+    assert imap.idle(0.1) == []
+
+    # A new mail arrives:
+    def notify():
+        imapd.idling.wait(5)
+        imapd.events.put("* 1 EXISTS\r\n")
+    thread = threading.Thread(target=notify)
+    thread.start()
+    assert imap.idle(5) == ['* 1 EXISTS']
+    thread.join()
+
+    # The connection is still usable:
+    assert imap.select('INBOX')[0] == 'OK'
+
+    # The responses sent with the continuation are not lost:
+    imapd.idle_continuation = "* 1 RECENT\r\n+ idling\r\n* 2 EXISTS\r\n"
+    assert imap.idle(5) == ['* 1 RECENT', '* 2 EXISTS']
+    imapd.idle_continuation = "+ idling\r\n* 2 EXISTS\r\n"
+    start = time.time()
+    assert imap.idle(5) == ['* 2 EXISTS']
+    assert time.time() - start < 5
+    imap.logout()
+
+
+def test_session_cache(imapd):
+    """Test the capabilities and the selected mailbox cached."""
+    imapd.login_capabilities = ['IMAP4rev1', 'IDLE', 'MOVE']
+    imap = imaputils.IsbgImap4('127.0.0.1', imapd.port, nossl=True)
+    assert not imap.has_capability('MOVE')
+    imap.login('user', 'pass')
+    assert imap.has_capability('MOVE'), "Sent with the LOGIN response."
+    assert imap.capabilities == ('IMAP4REV1', 'IDLE', 'MOVE')
+
+    assert imap.select('INBOX', True)[0] == 'OK'
+    assert imap.get_uidvalidity('INBOX') == 1
+    assert imap.select('INBOX', True, cached=True) == ('OK', ['0'])
+    assert imap.select('INBOX', cached=True)[0] == 'OK'
+    assert imap.select('INBOX', True, cached=True)[0] == 'OK'
+    assert imapd.command_names() == ['LOGIN', 'EXAMINE', 'SELECT']
+    # Our changes invalidate the cache:
+    imap.uid('STORE', '1', '+FLAGS', '(\\Seen)')
+    imap.select('INBOX', cached=True)
+    assert imapd.command_names()[-1] == 'SELECT'
+    # Other mailboxes use STATUS:
+    assert imap.get_uidvalidity('INBOX.Spam') == 1
+    assert imapd.command_names()[-1] == 'STATUS'
+    imap.logout()
+
+    # Without capabilities in the LOGIN response, they are asked:
+    imapd.login_capabilities = []
+    imapd.capabilities.append('UIDPLUS')
+    del imapd.commands[:]
+    imap = imaputils.IsbgImap4('127.0.0.1', imapd.port, nossl=True)
+    imap.login('user', 'pass')
+    assert imap.has_capability('UIDPLUS')
+    assert imap.has_capability('IDLE')
+    assert imapd.command_names() == ['LOGIN', 'CAPABILITY']
+    imap.logout()
+
+
+def test_select_cached_assertok(imapd):
+    """Test the cached selects checked with ISBG.assertok."""
+    sbg = isbg.ISBG()
+    imap = imaputils.IsbgImap4('127.0.0.1', imapd.port, nossl=True,
+                               assertok=sbg.assertok)
+    imap.login('user', 'pass')
+    assert imap.select('INBOX', 1, cached=True)[0] == 'OK'
+    assert imap.select('INBOX', 1, cached=True)[0] == 'OK'
+    with pytest.raises(isbg.ISBGError):
+        imap.select('Foo', cached=True)
+    imap.logout()
+
+
+@pytest.mark.parametrize("caps, appends", [
+    (['MULTIAPPEND', 'LITERAL+'], 1),
+    (['MULTIAPPEND'], 1),
+    ([], 3)])
+def test_multiappend(imapd, caps, appends):
+    """Test the APPEND actions with MULTIAPPEND."""
+    imapd.capabilities += caps
+    imap = imaputils.IsbgImap4('127.0.0.1', imapd.port, nossl=True)
+    imap.login('user', 'pass')
+    del imapd.commands[:]
+    actions = imaputils.ImapActions(imap, batchsize=None)
+    for num in range(3):
+        actions.append('INBOX.Spam', "Subject: {}\n\nspam".format(
+            num).encode(), num)
+    actions.append('INBOX', b"Subject: ham\r\n\r\nham", 3)
+    assert actions.flush() == []
+    assert imapd.command_names() == ['APPEND'] * (appends + 1)
+    spam = imapd.mailboxes['INBOX.Spam'].mails
+    assert [spam[u][0] for u in sorted(spam)] == [
+        "Subject: {}\r\n\r\nspam".format(num).encode() for num in range(3)]
+    assert imapd.mailboxes['INBOX'].mails[1][0] == \
+        b"Subject: ham\r\n\r\nham"
+
+    # Refused, they are appended one by one:
+    del imapd.commands[:]
+    actions.append('Foo', b"Subject: 1\r\n\r\nspam", 1)
+    actions.append('Foo', b"Subject: 2\r\n\r\nspam", 2)
+    assert actions.flush() == [1, 2]
+    assert imapd.command_names() == ['APPEND'] * (3 if caps else 2)
+    imap.logout()
+
+
+def test_compress(imapd):
+    """Test IsbgImap4.compress."""
+    imap = imaputils.IsbgImap4('127.0.0.1', imapd.port, nossl=True)
+    imap.login('user', 'pass')
+    assert not imap.compress(), "The server has not COMPRESS=DEFLATE."
+    imap.logout()
+
+    imapd.capabilities.append('COMPRESS=DEFLATE')
+    content = b"Subject: test\r\n\r\n" + b"hello world\r\n" * 5000
+    imapd.mailboxes['INBOX'].add(content)
+    imap = imaputils.IsbgImap4('127.0.0.1', imapd.port, nossl=True)
+    imap.login('user', 'pass')
+    assert imap.compress()
+    assert imap.compress(), "It's already compressed."
+    assert imapd.command_names().count('COMPRESS') == 1
+    imap.select('INBOX')
+    mails = list(imaputils.get_messages(imap, ['1']))
+    assert mails[0][1].as_bytes().endswith(b"hello world\r\n" * 3)
+    stream = imap.compression
+    assert stream.data_in > len(content)
+    assert stream.wire_in < stream.data_in / 10
+    assert 0 < stream.wire_out and 0 < stream.data_out
+
+    # Idle works with the decompressed data:
+    def notify():
+        imapd.idling.wait(5)
+        imapd.events.put("* 2 EXISTS\r\n* 1 RECENT\r\n")
+    thread = threading.Thread(target=notify)
+    thread.start()
+    assert imap.idle(5) == ['* 2 EXISTS', '* 1 RECENT']
+    thread.join()
+    assert imap.select('INBOX')[0] == 'OK'
+    imap.logout()
+
+
+def test_prefetch(imapd):
+    """Test prefetch."""
+    inbox = imapd.mailboxes['INBOX']
+    inbox.add(b"Subject: 1\r\nX-Spam-Status: No, score=1.0\r\n\r\nhello")
+    inbox.add(b"Subject: 2\r\n\r\nhello", ['\\Seen', '\\Deleted'])
+    imap = imaputils.IsbgImap4('127.0.0.1', imapd.port, nossl=True)
+    imap.login('user', 'pass')
+    imap.select('INBOX', True)
+    del imapd.commands[:]
+    info = imaputils.prefetch(imap, ['1', '2', '3'], ['X-Spam-Status'])
+    assert imapd.command_names() == ['UID FETCH']
+    assert sorted(info) == ['1', '2']
+    assert info['1']['size'] == len(inbox.mails[1][0])
+    assert info['1']['headers']['X-Spam-Status'] == 'No, score=1.0'
+    assert info['1']['headers']['Subject'] is None
+    assert sorted(info['2']['flags']) == ['\\Deleted', '\\Seen']
+    assert info['2']['headers']['X-Spam-Status'] is None
+    imap.logout()
+
+
+def test_imappool(imapd, caplog):
+    """Test ImapPool."""
+    for num in range(1, 11):
+        imapd.mailboxes['INBOX'].add(
+            "Subject: {}\r\n\r\nhello".format(num).encode())
+    imapsets = imaputils.ImapSettings()
+    imapsets.host, imapsets.port, imapsets.nossl = (
+        '127.0.0.1', imapd.port, True)
+    imapsets.user, imapsets.passwd = ('user', 'pass')
+    imapd.max_logins = 3
+
+    pool = imaputils.ImapPool(imapsets, 4, logger=logging.getLogger(__name__))
+    assert len(pool) == 3, "The refused connection should be dropped."
+    assert "Using 3 connections" in caplog.text
+    pool.select('INBOX')
+    assert imapd.command_names().count('EXAMINE') == 3
+    mails = dict(pool.get_messages(range(1, 11), batchsize=2, depth=2))
+    assert sorted(mails, key=int) == [str(u) for u in range(1, 11)]
+    assert mails['7']['Subject'] == '7'
+    fetches = [c[4] for c in imapd.commands if c[1:3] == ['UID', 'FETCH']]
+    assert len(fetches) == 6, "Every connection fetches its part."
+    pool.logout()
+    assert len(pool) == 0
+
+
 class TestImapSettings(object):
     """Test object ImapSettings."""
 
@@ -31,7 +31,9 @@ from __future__ import unicode_literals
 # With atexit._run_exitfuncs()  we free the lockfile, but we lost coverage
 # statistics.
 
+import imaplib
 import os
+import socket
 import sys
 try:
     import pytest
@@ -42,6 +44,10 @@ except ImportError:
 sys.path.insert(0, os.path.abspath(os.path.join(
     os.path.dirname(__file__), '..')))
 from isbg import isbg  # noqa: E402
+from isbg import imaputils  # noqa: E402
+from isbg import spamproc  # noqa: E402
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+import fakeimapd  # noqa: E402
 
 
 def test_ISBGError():
@@ -79,6 +85,279 @@ class TestISBG(object):
         assert os.path.exists(sbg.lockfilename) is False, \
             "File should not exist."
 
+    def test_trackstate(self, tmpdir):
+        """Test trackstate_read, pastuid_read and pastuid_write."""
+        sbg = isbg.ISBG()
+        sbg.trackfile = str(tmpdir.join("track"))
+        assert sbg.trackstate_read(7) == {}
+        sbg.pastuid_write(7, [1, 2], [3],
+                          state={'highestmodseq': 42, 'other': None})
+        state = sbg.trackstate_read(7)
+        assert state['highestmodseq'] == 42
+        assert 'other' not in state
+        assert sorted(sbg.pastuid_read(7)) == [1, 2, 3]
+        # A new uidvalidity invalidates the stored state:
+        assert sbg.trackstate_read(8) == {}
+        assert sbg.pastuid_read(8) == []
+
+    @pytest.mark.parametrize("caps, status", [
+        (['IMAP4rev1'], ['STATUS']),
+        (['IMAP4rev1', 'LIST-STATUS'], ['LIST'])])
+    def test_unchanged_folders(self, tmpdir, monkeypatch, caps, status):
+        """Test do_spamassassin without changes since the last run."""
+        monkeypatch.setattr(spamproc, 'test_mail',
+                            lambda mail, spamc=False, cmd=False, spamd=None,
+                            timeout=None:
+                            ("1.0/5.0\n", 0, mail.as_bytes()))
+        server = fakeimapd.FakeImapServer(caps).start()
+        try:
+            inbox = server.mailboxes['INBOX']
+            inbox.add(b"Subject: 1\r\n\r\nhello")
+            inbox.add(b"Subject: 2\r\n\r\nhello")
+            sbg = isbg.ISBG()
+            sbg.trackfile = str(tmpdir.join("track"))
+            sbg.imapsets.spaminbox = 'INBOX.Spam'
+            sbg.imap = imaputils.IsbgImap4('127.0.0.1', server.port,
+                                           nossl=True)
+            sbg.imap.login('user', 'pass')
+            assert not sbg.unchanged_folders()
+            assert sbg.do_spamassassin().nummsg == 2
+            assert sbg.unchanged_folders()
+
+            # Only the status of the folders is asked:
+            del server.commands[:]
+            assert sbg.do_spamassassin().nummsg == 0
+            assert server.command_names() == status
+
+            inbox.add(b"Subject: 3\r\n\r\nhello")
+            assert not sbg.unchanged_folders()
+            assert sbg.do_spamassassin().nummsg == 1
+            assert sbg.unchanged_folders()
+
+            # The flags of the learn folders only are known with CONDSTORE:
+            sbg.imapsets.learnspambox = 'INBOX.Spam'
+            sbg.do_spamassassin()
+            assert sbg.unchanged_folders()
+            sbg.learnflagged = True
+            assert not sbg.unchanged_folders()
+            sbg.imap.logout()
+        finally:
+            server.stop()
+
+    @pytest.mark.parametrize("caps", [
+        ['IMAP4rev1', 'MOVE', 'UIDPLUS'],
+        ['IMAP4rev1', 'MOVE', 'UIDPLUS', 'ENABLE', 'CONDSTORE']])
+    def test_unchanged_folders_moved(self, tmpdir, monkeypatch, caps):
+        """Test the run after moving spams is skipped."""
+        monkeypatch.setattr(spamproc, 'test_mail',
+                            lambda mail, spamc=False, cmd=False, spamd=None,
+                            timeout=None: (
+                                ("10.0/5.0\n", 1, mail.as_bytes())
+                                if b"viagra" in mail.as_bytes()
+                                else ("1.0/5.0\n", 0, mail.as_bytes())))
+        arriving = []
+        flush = imaputils.ImapActions.flush
+
+        def flush_and_receive(actions):
+            res = flush(actions)
+            while arriving:
+                inbox.add(arriving.pop())
+            return res
+        monkeypatch.setattr(imaputils.ImapActions, 'flush',
+                            flush_and_receive)
+        server = fakeimapd.FakeImapServer(caps).start()
+        try:
+            inbox = server.mailboxes['INBOX']
+            inbox.add(b"Subject: 1\r\n\r\nhello")
+            inbox.add(b"Subject: 2\r\n\r\nviagra")
+            sbg = isbg.ISBG()
+            sbg.trackfile = str(tmpdir.join("track"))
+            sbg.imapsets.spaminbox = 'INBOX.Spam'
+            sbg.noreport, sbg.expunge = (True, True)
+            sbg.spamflags = ["\\Deleted"]
+            sbg.imap = imaputils.IsbgImap4('127.0.0.1', server.port,
+                                           nossl=True)
+            sbg.imap.login('user', 'pass')
+            sbg.imap.enable_condstore()
+            assert sbg.do_spamassassin().numspam == 1
+            assert inbox.uids() == [1]
+            assert sbg.unchanged_folders()
+
+            # A mail arrived while the actions are sent is not hidden:
+            inbox.add(b"Subject: 3\r\n\r\nviagra")
+            arriving.append(b"Subject: 4\r\n\r\nhello")
+            assert sbg.do_spamassassin().numspam == 1
+            assert not sbg.unchanged_folders()
+            assert sbg.do_spamassassin().nummsg == 1
+            assert sbg.unchanged_folders()
+            sbg.imap.logout()
+        finally:
+            server.stop()
+
+    def test_retry(self, tmpdir, monkeypatch):
+        """Test the mails timed out are scanned again in the next run."""
+        slow = [True]
+
+        def test_mail(mail, spamc=False, cmd=False, spamd=None,
+                      timeout=None):
+            if slow[0] and b"slow" in mail.as_bytes():
+                return "-9998", None, None
+            return "1.0/5.0\n", 0, mail.as_bytes()
+        monkeypatch.setattr(spamproc, 'test_mail', test_mail)
+        server = fakeimapd.FakeImapServer().start()
+        try:
+            inbox = server.mailboxes['INBOX']
+            inbox.add(b"Subject: 1\r\n\r\nslow")
+            inbox.add(b"Subject: 2\r\n\r\nhello")
+            sbg = isbg.ISBG()
+            sbg.trackfile = str(tmpdir.join("track"))
+            sbg.imapsets.spaminbox = 'INBOX.Spam'
+            sbg.imap = imaputils.IsbgImap4('127.0.0.1', server.port,
+                                           nossl=True)
+            sbg.imap.login('user', 'pass')
+            assert sbg.do_spamassassin().nummsg == 1
+            assert sbg.trackstate_read(1)['retry'] == [1]
+            assert sbg.pastuid_read(1) == [2]
+            assert not sbg.unchanged_folders()
+
+            slow[0] = False
+            proc = sbg.do_spamassassin()
+            assert proc.uids == [1]
+            assert sbg.trackstate_read(1)['retry'] == []
+            assert sbg.unchanged_folders()
+            sbg.imap.logout()
+        finally:
+            server.stop()
+
+    def test_concurrentpasses(self, tmpdir, monkeypatch):
+        """Test do_spamassassin with the passes run at the same time."""
+        monkeypatch.setattr(spamproc, 'test_mail',
+                            lambda mail, spamc=False, cmd=False, spamd=None,
+                            timeout=None:
+                            ("1.0/5.0\n", 0, mail.as_bytes()))
+        monkeypatch.setattr(spamproc, 'learn_mail',
+                            lambda mail, learn_type, spamd=None, timeout=None:
+                            (5, 0))
+        server = fakeimapd.FakeImapServer().start()
+        try:
+            server.mailboxes['INBOX.Ham'] = fakeimapd.Mailbox()
+            for name, num in [('INBOX', 3), ('INBOX.Spam', 2),
+                              ('INBOX.Ham', 1)]:
+                for _ in range(num):
+                    server.mailboxes[name].add(b"Subject: hi\r\n\r\nhi")
+            sbg = isbg.ISBG()
+            sbg.trackfile = str(tmpdir.join("track"))
+            sbg.imapsets.host, sbg.imapsets.port = ('127.0.0.1', server.port)
+            sbg.imapsets.nossl = True
+            sbg.imapsets.user, sbg.imapsets.passwd = ('user', 'pass')
+            sbg.imapsets.spaminbox = 'INBOX.Spam'
+            sbg.imapsets.learnspambox = 'INBOX.Spam'
+            sbg.imapsets.learnhambox = 'INBOX.Ham'
+            sbg.concurrentpasses, sbg.scanworkers = (True, 2)
+            sbg.do_imap_login()
+            assert sbg.do_spamassassin().nummsg == 3
+            assert server.logins == 3
+            assert sbg.scanpool is None
+            assert len(sbg.pastuid_read(1, 'spam')) == 2
+            assert len(sbg.pastuid_read(1, 'ham')) == 1
+            assert len(sbg.pastuid_read(1)) == 3
+            # The extra connections are closed:
+            assert server.command_names().count('LOGOUT') == 2
+            sbg.imap.logout()
+        finally:
+            server.stop()
+
+    def test_do_daemon(self):
+        """Test do_daemon."""
+        sbg = isbg.ISBG()
+        sbg.ignorelockfile = True
+        passes = []
+
+        class Imap(object):
+            def select(self, mailbox, readonly=False):
+                passes.append('select')
+
+            def has_capability(self, name):
+                return len(passes) < 3
+
+            def idle(self, timeout):
+                passes.append('idle')
+                return ['* 1 EXISTS']
+
+        procs = []
+
+        def do_spamassassin():
+            passes.append('pass')
+            if len(passes) > 6:
+                raise KeyboardInterrupt()
+            procs.append(spamproc.Sa_Process())
+            return procs[-1]
+
+        sbg.imap = Imap()
+        sbg.pollinterval = 0
+        sbg.do_spamassassin = do_spamassassin
+        assert sbg.do_daemon() is procs[-1]
+        assert len(procs) == 3
+        # Without IDLE, it sleeps 'pollinterval' seconds:
+        assert passes == ['pass', 'select', 'idle', 'pass', 'select', 'pass',
+                          'select', 'pass']
+
+    def test_do_daemon_reconnect(self, monkeypatch):
+        """Test do_daemon when the IDLE command fails."""
+        sbg = isbg.ISBG()
+        sbg.ignorelockfile = True
+        passes = []
+
+        class Imap(object):
+            def select(self, mailbox, readonly=False):
+                passes.append('select')
+
+            def has_capability(self, name):
+                return True
+
+            def idle(self, timeout):
+                passes.append('idle')
+                raise imaplib.IMAP4.error("IDLE returned b'* 1 EXISTS'")
+
+        def do_spamassassin():
+            passes.append('pass')
+            if len(passes) > 3:
+                raise KeyboardInterrupt()
+
+        monkeypatch.setattr(isbg.time, 'sleep', lambda delay: None)
+        sbg.imap = Imap()
+        sbg.do_imap_login = lambda: passes.append('login')
+        sbg.do_spamassassin = do_spamassassin
+        assert sbg.do_daemon() is None
+        assert passes == ['pass', 'select', 'idle', 'login', 'pass']
+
+    def test_do_daemon_login_fails(self, monkeypatch):
+        """Test do_daemon when the server is down for a long time."""
+        sbg = isbg.ISBG()
+        sbg.ignorelockfile = True
+        passes, delays = ([], [])
+
+        def do_imap_login():
+            passes.append('login')
+            if len(passes) <= 12:
+                # As login_imap after its retries:
+                raise socket.error(111, 'Connection refused')
+
+        def do_spamassassin():
+            passes.append('pass')
+            if len(passes) == 1:
+                raise imaplib.IMAP4.abort("socket error: EOF")
+            raise KeyboardInterrupt()
+
+        monkeypatch.setattr(isbg.time, 'sleep', delays.append)
+        sbg.imap = None
+        sbg.do_imap_login = do_imap_login
+        sbg.do_spamassassin = do_spamassassin
+        assert sbg.do_daemon() is None
+        assert passes == ['pass'] + ['login'] * 12 + ['pass']
+        # The backoff grows until the limit:
+        assert delays == [min(2 ** n, 300) for n in range(1, 13)]
+
     def test_do_isbg(self):
         """Test do_isbg."""
         sbg = isbg.ISBG()
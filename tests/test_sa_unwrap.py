@@ -41,6 +41,7 @@ except ImportError:
 # We add the upper dir to the path
 sys.path.insert(0, os.path.abspath(os.path.join(
     os.path.dirname(__file__), '..')))
+from isbg import imaputils  # noqa: E402
 from isbg import sa_unwrap  # noqa: E402
 
 
@@ -109,6 +110,43 @@ def test_unwrap():
     assert sa_unwrap.unwrap(email.message.Message()) is None
 
 
+def test_sa_unwrap_from_bytes():
+    """Test function sa_unwrap_from_bytes."""
+    with open('examples/spam.from.spamassassin.eml', 'rb') as fmail:
+        ftext = fmail.read()
+    mails = sa_unwrap.sa_unwrap_from_bytes(ftext)
+    assert len(mails) == 1
+    expected = sa_unwrap.sa_unwrap_from_email(sa_unwrap.MESSAGE(ftext))[0]
+    assert mails[0]['Subject'] == expected['Subject']
+    assert mails[0].get_payload(0).get_payload().replace('\r\n', '\n') == \
+        expected.get_payload(0).get_payload()
+    assert mails[0].raw.startswith(b"Return-Path: <2587-84-")
+    assert mails[0].raw.endswith(b"--4b2c0d8c2be93cf60574bb430a69dcea--"
+                                 b"\r\n\r\n")
+    assert sa_unwrap.unwrap(ftext)[0].raw == mails[0].raw
+    # The big mails are spooled:
+    spooled = sa_unwrap.unwrap(ftext, spoolsize=1024)[0]
+    assert imaputils.mail_file(spooled).read() == mails[0].raw
+    assert imaputils.mail_file(sa_unwrap.unwrap(
+        ftext, spoolsize=len(ftext))[0]) is None
+
+    with open('examples/spam.eml', 'rb') as fmail:
+        assert sa_unwrap.sa_unwrap_from_bytes(fmail.read()) is None
+    # Not a report:
+    assert sa_unwrap.sa_unwrap_from_bytes(b'0000') is None
+    assert sa_unwrap.sa_unwrap_from_bytes(
+        ftext.replace(b'x-spam-type=original', b'name=original')) is None
+    assert sa_unwrap.sa_unwrap_from_bytes(
+        ftext.replace(b'multipart/mixed', b'text/plain')) is None
+    # Other line endings and parameters:
+    mails = sa_unwrap.sa_unwrap_from_bytes(
+        b'Subject: report\nContent-Type: multipart/mixed;\n\tboundary=b1\n'
+        b'\n--b1\nContent-Type: text/plain\n\nreport\n'
+        b'--b1\nContent-Type: message/rfc822; X-Spam-Type="original"\n\n'
+        b'Subject: spam\n\nspam body\n--b1--\n')
+    assert [m.raw for m in mails] == [b'Subject: spam\n\nspam body']
+
+
 def test_isbg_sa_unwrap(capsys):
     """Test no multipart spam mail."""
     # Remove pytest options:
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_spamd.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Tests for spamd.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import socket
+import sys
+import threading
+import time
+import zlib
+try:
+    import pytest
+except ImportError:
+    pass
+
+try:
+    import socketserver  # Python 3
+except ImportError:
+    import SocketServer as socketserver  # Python 2
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import spamd     # noqa: E402
+from isbg import spamproc  # noqa: E402
+from isbg.imaputils import RawMessage, mail_file, new_message  # noqa: E402
+
+
+class FakeSpamdHandler(socketserver.StreamRequestHandler):
+    """Answer as spamd: mails with 'viagra' are spam."""
+
+    learned = set()
+
+    def handle(self):
+        """Handle a request."""
+        verb = self.rfile.readline().decode().split()[0]
+        headers = {}
+        while True:
+            line = self.rfile.readline().decode().strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.lower()] = value.strip()
+        body = self.rfile.read(int(headers['content-length']))
+        if headers.get('compress') == 'zlib':
+            body = zlib.decompress(body)
+        self.server.requests.append((verb, headers, body))
+
+        out = [b"SPAMD/1.1 0 EX_OK"]
+        rbody = b""
+        if verb == "TELL":
+            if body in self.learned:
+                out.append(b"DidSet: ")
+            else:
+                self.learned.add(body)
+                out.append(b"DidSet: local")
+        else:
+            if b"viagra" in body:
+                out.append(b"Spam: True ; 15.0 / 5.0")
+            else:
+                out.append(b"Spam: False ; 1.5 / 5.0")
+            if verb == "PROCESS":
+                rbody = b"X-Spam-Checker-Version: fake\r\n" + body
+        if verb != "CHECK":
+            out.append(b"Content-length: " + str(len(rbody)).encode())
+        self.wfile.write(b"\r\n".join(out) + b"\r\n\r\n" + rbody)
+
+
+@pytest.fixture
+def server():
+    """Run a fake spamd server."""
+    srv = socketserver.ThreadingTCPServer(('127.0.0.1', 0), FakeSpamdHandler)
+    srv.requests = []
+    thread = threading.Thread(target=srv.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def test_from_address():
+    """Test from_address."""
+    client = spamd.SpamdClient.from_address('example.org:7830')
+    assert (client.host, client.port) == ('example.org', 7830)
+    client = spamd.SpamdClient.from_address('example.org')
+    assert (client.host, client.port) == ('example.org', 783)
+    client = spamd.SpamdClient.from_address('/run/spamd.sock')
+    assert client.socket_path == '/run/spamd.sock'
+
+
+def test_parse_response():
+    """Test parse_response."""
+    res = spamd.SpamdClient.parse_response(
+        b"SPAMD/1.1 0 EX_OK\r\nSpam: Yes ; 6.5 / 5.0\r\n\r\n")
+    assert res.code == 0
+    assert res.message == "EX_OK"
+    assert (res.spam, res.score, res.threshold) == (True, 6.5, 5.0)
+    res = spamd.SpamdClient.parse_response(b"SPAMD/1.0 76 Bad header line")
+    assert res.code == 76
+    with pytest.raises(spamd.SpamdError, match="Unexpected"):
+        spamd.SpamdClient.parse_response(b"HTTP/1.1 200 OK\r\n\r\n")
+
+
+def test_requests(server):
+    """Test check, process and tell requests."""
+    client = spamd.SpamdClient(*server.server_address, user='isbg')
+    res = client.check(b"Subject: buy\r\n\r\nviagra")
+    assert res.spam
+    assert res.score == 15.0
+    assert server.requests[-1][0] == "CHECK"
+    assert server.requests[-1][1]['user'] == 'isbg'
+
+    res = client.process(b"Subject: hi\r\n\r\nhello")
+    assert not res.spam
+    assert res.body.startswith(b"X-Spam-Checker-Version")
+
+    res = client.tell(b"Subject: hi\r\n\r\nlearn me", 'ham')
+    assert res.learned
+    assert server.requests[-1][1]['message-class'] == 'ham'
+    res = client.tell(b"Subject: hi\r\n\r\nlearn me", 'ham')
+    assert not res.learned
+    with pytest.raises(ValueError):
+        client.tell(b"", 'foo')
+
+    client.compress = True
+    res = client.check(b"Subject: buy\r\n\r\nviagra")
+    assert res.spam
+    assert server.requests[-1][2] == b"Subject: buy\r\n\r\nviagra"
+
+    # The spooled mails are sent from their files:
+    spool = RawMessage(b"Subject: buy\r\n\r\nviagra", spoolsize=1)
+    res = client.check(mail_file(spool))
+    assert res.spam
+    assert server.requests[-1][2] == b"Subject: buy\r\n\r\nviagra"
+    client.compress = False
+    res = client.process(mail_file(spool))
+    assert res.body.endswith(b"viagra")
+    assert server.requests[-1][1]['content-length'] == "22"
+    assert server.requests[-1][2] == b"Subject: buy\r\n\r\nviagra"
+
+
+def test_spamproc_backend(server):
+    """Test spamproc.test_mail and spamproc.learn_mail with spamd."""
+    client = spamd.SpamdClient(*server.server_address)
+    spam = new_message(b"Subject: buy\r\n\r\nviagra")
+    ham = new_message(b"Subject: hi\r\n\r\nhello")
+    score, code, result = spamproc.test_mail(spam, spamd=client)
+    assert (score, code) == ("15.0/5.0\n", 1)
+    assert result.endswith(b"viagra")
+    score, code, result = spamproc.test_mail(ham, spamd=client)
+    assert (score, code) == ("1.5/5.0\n", 0)
+    spool = RawMessage(b"Subject: buy\r\n\r\nviagra", spoolsize=1)
+    assert spamproc.test_mail(spool, spamd=client)[:2] == ("15.0/5.0\n", 1)
+
+    assert spamproc.learn_mail(spam, 'spam', client)[0] == 5
+    assert spamproc.learn_mail(spam, 'spam', client)[0] == 6
+
+    # A closed port:
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    client = spamd.SpamdClient('127.0.0.1', port)
+    assert spamproc.test_mail(ham, spamd=client)[0] == "-9999"
+    assert spamproc.learn_mail(ham, 'ham', client)[0] == -9999
+    assert spamproc.check_mail(ham, spamd=client)[0] == "-9999"
+
+
+def test_timeout():
+    """Test the requests to a spamd which doesn't answer are aborted."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    try:
+        client = spamd.SpamdClient(*sock.getsockname(), timeout=0.2)
+        ham = new_message(b"Subject: hi\r\n\r\nhello")
+        assert spamproc.test_mail(ham, spamd=client)[0] == "-9998"
+        assert spamproc.check_mail(ham, spamd=client)[0] == "-9998"
+        assert spamproc.learn_mail(ham, 'ham', client)[0] == -9998
+        sa = spamproc.SpamAssassin(spamd='{}:{}'.format(*sock.getsockname()),
+                                   scantimeout=3)
+        assert sa.spamd.timeout == 3
+    finally:
+        sock.close()
+
+
+def test_request_timeout():
+    """Test the timeout of the whole request, with a slow spamd."""
+    def slow(conn):
+        conn.recv(65536)
+        response = b"SPAMD/1.1 0 EX_OK\r\nSpam: False ; 1.5 / 5.0\r\n"
+        try:
+            for pos in range(len(response)):
+                conn.send(response[pos:pos + 1])
+                time.sleep(0.05)
+        except socket.error:
+            pass
+        conn.close()
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    try:
+        # Every recv is faster than the socket timeout:
+        client = spamd.SpamdClient(*sock.getsockname(), timeout=0.2)
+        ham = new_message(b"Subject: hi\r\n\r\nhello")
+        thread = threading.Thread(target=lambda: slow(sock.accept()[0]))
+        thread.start()
+        start = time.time()
+        assert spamproc.check_mail(ham, spamd=client, timeout=0.3)[0] == \
+            "-9998"
+        assert time.time() - start < 1
+        thread.join()
+    finally:
+        sock.close()
+
+
+@pytest.mark.parametrize("noreport, verbs", [
+    (False, ["CHECK", "CHECK", "PROCESS"]),
+    (True, ["CHECK", "CHECK"])])
+def test_checkfirst(server, noreport, verbs):
+    """Test the mails are processed only if the report is needed."""
+    client = spamd.SpamdClient(*server.server_address)
+    spam = new_message(b"Subject: buy\r\n\r\nviagra")
+    ham = new_message(b"Subject: hi\r\n\r\nhello")
+    assert spamproc.check_mail(spam, spamd=client) == (
+        "15.0/5.0\n", 1, None)
+    assert spamproc.check_mail(ham, spamd=client) == ("1.5/5.0\n", 0, None)
+    del server.requests[:]
+
+    sa = spamproc.SpamAssassin(spamd=client, checkfirst=True,
+                               noreport=noreport)
+    _, score, code, result = sa._scan_mail(('1', ham))
+    assert (score, code, result) == ("1.5/5.0\n", 0, None)
+    _, score, code, result = sa._scan_mail(('2', spam))
+    assert (score, code) == ("15.0/5.0\n", 1)
+    assert (result is not None) == (not noreport)
+    assert [r[0] for r in server.requests] == verbs
+
+    # The truncated spams, and the deleted ones, don't need the report:
+    del server.requests[:]
+    sa._scan_mail(('2', spam), truncated=True)
+    sa.deletehigherthan = 10
+    sa._scan_mail(('2', spam))
+    assert [r[0] for r in server.requests] == ["CHECK", "CHECK"]
@@ -30,6 +30,8 @@ from __future__ import unicode_literals
 
 import os
 import sys
+import threading
+import time
 try:
     import pytest
 except ImportError:
@@ -42,7 +44,84 @@ sys.path.insert(0, os.path.abspath(os.path.join(
     os.path.dirname(__file__), '..')))
 from isbg import spamproc   # noqa: E402
 from isbg import isbg       # noqa: E402
+from isbg import imaputils  # noqa: E402
 from isbg.imaputils import new_message  # noqa: E402
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakeimapd            # noqa: E402
+
+
+class FakeImap(object):
+    """A fake IsbgImap4 with a inbox and a spam folder."""
+
+    def __init__(self, mails):
+        """Store the inbox mails indexed by uid."""
+        self.mails = dict((str(k), v) for k, v in mails.items())
+        self.commands = []
+        self.appended = []
+        self.flags = {}
+
+    def select(self, mailbox='INBOX', readonly=False, cached=False):
+        """Select a mailbox."""
+        self.commands.append(('SELECT', mailbox))
+        return 'OK', [str(len(self.mails)).encode()]
+
+    def has_capability(self, name):
+        """It has not any extension."""
+        return False
+
+    def append(self, mailbox, flags, date_time, message):
+        """Append a message."""
+        self.commands.append(('APPEND', mailbox))
+        self.appended.append((mailbox, message))
+        return 'OK', [b'']
+
+    def expunge(self):
+        """Expunge the mailbox."""
+        self.commands.append(('EXPUNGE',))
+        return 'OK', [b'']
+
+    def seqset(self, seqset):
+        """Get the existing uids of a sequence-set."""
+        uids = []
+        for part in seqset.split(','):
+            first, _, last = part.partition(':')
+            uids.extend(str(u) for u in range(int(first), int(last or first)
+                                              + 1) if str(u) in self.mails)
+        return uids
+
+    def uid(self, command, *args):
+        """Reply as imaplib does."""
+        self.commands.append((command,) + args)
+        if command == 'SEARCH':
+            return 'OK', [' '.join(sorted(self.mails, key=int))]
+        if command == 'STORE':
+            for uid in self.seqset(args[0]):
+                self.flags.setdefault(uid, []).append(args[2])
+            return 'OK', []
+        if command == 'FETCH':
+            data = []
+            for uid in self.seqset(args[0]):
+                if 'RFC822.SIZE' in args[1]:
+                    data.append('1 (UID {} RFC822.SIZE {})'.format(
+                        uid, len(self.mails[uid])))
+                else:
+                    data.append(('1 (UID {} BODY[] {{{}}}'.format(
+                        uid, len(self.mails[uid])), self.mails[uid]))
+                    data.append(')')
+            return 'OK', data
+        return 'OK', []
+
+    uid_unchecked = uid
+
+
+def fake_test_mail(mail, spamc=False, cmd=False, spamd=None,
+                   timeout=None):
+    """Mails with 'viagra' are spam."""
+    content = mail.as_bytes()
+    if b'viagra' in content:
+        return "10.0/5.0\n", 1, b"X-Spam-Flag: YES\n" + content
+    return "1.0/5.0\n", 0, content
+
 
 # To check if a cmd exists:
 
@@ -79,6 +158,87 @@ def test_learn_mail():
             pytest.fail("Should rise OSError.")
 
 
+#: A fake ``sa-learn --mbox``: it learns the mails with "new" and it doesn't
+#: examine the mails with "big".
+FAKE_SA_LEARN = """
+import sys
+import threading
+import time
+mails = sys.stdin.buffer.read().split(b"From isbg@localhost ")[1:]
+examined = [m for m in mails if b"big" not in m]
+learned = [m for m in examined if b"new" in m]
+print("Learned tokens from {} message(s) ({} message(s) examined)".format(
+    len(learned), len(examined)))
+"""
+
+
+@pytest.fixture
+def fake_sa_learn(monkeypatch):
+    """Run FAKE_SA_LEARN instead of sa-learn, storing the commands."""
+    commands = []
+    popen = spamproc.utils.popen
+
+    def fake_popen(cmd, stdin=None):
+        commands.append(cmd)
+        if cmd[0] != 'sa-learn':
+            return popen(cmd, stdin)
+        return popen([sys.executable, '-c', FAKE_SA_LEARN], stdin)
+    monkeypatch.setattr(spamproc.utils, 'popen', fake_popen)
+    return commands
+
+
+def test_learn_mails(fake_sa_learn):
+    """Test learn_mails."""
+    mails = [new_message(b"Subject: new\r\n\r\nFrom me\r\n"),
+             imaputils.RawMessage(b"Subject: old\r\n\r\nhi"),
+             imaputils.RawMessage(b"Subject: new\r\n\r\nhi", spoolsize=1),
+             imaputils.RawMessage(b"Subject: big\r\n\r\nhi")]
+    assert spamproc.learn_mails(mails, 'ham') == (2, 3)
+    assert fake_sa_learn == [['sa-learn', '--ham', '--mbox', '-']]
+    assert spamproc._mbox_entry(mails[0]).endswith(
+        b"Subject: new\n\n>From me\n\n")
+    assert spamproc.learn_mails([], 'spam') == (0, 0)
+
+
+def test_learn_mails_missing(monkeypatch):
+    """Test learn_mails when sa-learn can't be run."""
+    popen = spamproc.utils.popen
+    monkeypatch.setattr(spamproc.utils, 'popen', lambda cmd, stdin=None:
+                        popen(['isbg-missing-sa-learn'] + cmd[1:], stdin))
+    with pytest.raises(OSError, match="No such file"):
+        spamproc.learn_mails([new_message(b"Subject: a\r\n\r\nhi")], 'ham')
+
+
+def test_check_mail(monkeypatch):
+    """Test check_mail with spamc."""
+    commands = []
+    popen = spamproc.utils.popen
+
+    def fake_popen(cmd, stdin=None):
+        commands.append(cmd)
+        return popen([sys.executable, '-c', (
+            "import sys; spam = b'viagra' in sys.stdin.buffer.read(); " +
+            "print('15.0/5.0' if spam else '1.0/5.0'); " +
+            "sys.exit(1 if spam else 0)")], stdin)
+    monkeypatch.setattr(spamproc.utils, 'popen', fake_popen)
+    spam = new_message(b"Subject: buy\r\n\r\nviagra")
+    assert spamproc.check_mail(spam) == ("15.0/5.0\n", 1, None)
+    ham = imaputils.RawMessage(b"Subject: hi\r\n\r\nhi", spoolsize=1)
+    assert spamproc.check_mail(ham) == ("1.0/5.0\n", 0, None)
+    assert commands[0] == ["spamc", "-c", "--max-size=268435450"]
+
+    monkeypatch.setattr(spamproc.utils, 'popen', lambda cmd, stdin=None:
+                        popen([sys.executable, '-c', 'exit(69)'], stdin))
+    assert spamproc.check_mail(spam) == ("-9999", 69, None)
+
+
+def test_timeouts():
+    """Test the scanners are killed when they time out."""
+    sleep = [sys.executable, '-c', 'import time; time.sleep(30)']
+    mail = new_message(b"Subject: hi\r\n\r\nhi")
+    assert spamproc.test_mail(mail, cmd=sleep, timeout=0.2)[0] == "-9998"
+
+
 def test_test_mail():
     """Tests for learn_mail."""
     fmail = open('examples/spam.eml', 'rb')
@@ -130,6 +290,11 @@ def test_test_mail():
         spamproc.test_mail(mail, cmd=["_____fooo___x_x"])
         pytest.fail("Should rise OSError.")
 
+    # The spooled mails are the stdin of the command:
+    spool = imaputils.RawMessage(ftext, spoolsize=100)
+    assert spool.file is not None
+    assert spamproc.test_mail(spool, cmd=["cat"])[2] == ftext
+
 
 class Test_Sa_Learn(object):
     """Tests for SA_Learn."""
@@ -162,7 +327,11 @@ class Test_SpamAssassin(object):
     _kwargs = ['imap', 'spamc', 'logger', 'partialrun', 'dryrun',
                'learnthendestroy', 'gmail', 'learnthenflag', 'learnunflagged',
                'learnflagged', 'deletehigherthan', 'imapsets', 'maxsize',
-               'noreport', 'spamflags', 'delete', 'expunge']
+               'noreport', 'spamflags', 'delete', 'expunge', 'fetchbatch',
+               'fetchbytes', 'spamd', 'spamdcompress', 'scanworkers',
+               'queuedepth', 'actionbatch', 'fetchpool', 'trustspamheaders',
+               'scantruncated', 'spoolsize', 'learnbatch', 'scanpool',
+               'checkfirst', 'scantimeout', 'runtimeout']
 
     def test__kwars(self):
         """Test _kwargs is up to date."""
@@ -219,6 +388,153 @@ class Test_SpamAssassin(object):
             sa.learn('Spam', 'ham', None, [])
             pytest.fail("Should rise error.")
 
+    def test_learn_actions(self, monkeypatch):
+        """Test learn moving the learned mails with one command."""
+        monkeypatch.setattr(spamproc, 'learn_mail',
+                            lambda mail, learn_type, spamd=None, timeout=None:
+                            (5, 0))
+        mails = dict((uid, b"Subject: ham\n\nhello") for uid in range(1, 6))
+        sbg = isbg.ISBG()
+        sbg.imap = FakeImap(mails)
+        sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+        learned = sa.learn('Ham', 'ham', 'INBOX', [])
+        assert learned.learned == 5
+        copies = [c for c in sbg.imap.commands if c[0] == 'COPY']
+        assert copies == [('COPY', '1:5', 'INBOX')]
+
+    def test_learn_workers(self, monkeypatch):
+        """Test learn with several mails learned at the same time."""
+        lock = threading.Lock()
+        running = []
+        concurrency = []
+
+        def fake_learn_mail(mail, learn_type, spamd=None, timeout=None):
+            with lock:
+                running.append(mail)
+                concurrency.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(mail)
+            return (6, 0) if b"old" in imaputils.mail_content(mail) else (5, 0)
+        monkeypatch.setattr(spamproc, 'learn_mail', fake_learn_mail)
+        mails = dict((uid, "Subject: ham\n\n{}".format(
+            "old" if uid % 3 else "new").encode()) for uid in range(1, 10))
+        sbg = isbg.ISBG()
+        sbg.imap = FakeImap(mails)
+        sbg.scanworkers, sbg.learnthenflag = (3, True)
+        sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+        res = sa.learn('Ham', 'ham', None, [])
+        assert res.learned == 3
+        assert res.uids == list(range(9, 0, -1))
+        assert max(concurrency) == 3
+        stores = [c for c in sbg.imap.commands if c[0] == 'STORE']
+        assert stores == [('STORE', '1:9', '+FLAGS.SILENT',
+                           '(\\Flagged)')]
+
+    def test_learn_dryrun(self, monkeypatch):
+        """Test learn with dryrun doesn't store the state of the folder."""
+        monkeypatch.setattr(spamproc, 'learn_mail', lambda *args, **kw:
+                            pytest.fail("It should not learn"))
+        mails = dict((uid, b"Subject: ham\n\nhello") for uid in range(1, 4))
+        sbg = isbg.ISBG()
+        sbg.imap = FakeImap(mails)
+        sbg.imap.mailbox_info = {'EXISTS': 3, 'UIDNEXT': 4,
+                                 'HIGHESTMODSEQ': 9}
+        sbg.dryrun = True
+        sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+        res = sa.learn('Ham', 'ham', None, [], {'highestmodseq': 5})
+        assert res.learned == 0
+        assert res.uids == []
+        assert res.state == {'highestmodseq': 5, 'lastuid': None,
+                             'retry': [], 'deleted': []}
+        proc = sa.process_inbox([], {'highestmodseq': 5})
+        assert proc.state == {'highestmodseq': 5, 'lastuid': None,
+                              'retry': [], 'deleted': []}
+
+    @pytest.mark.parametrize("bodies, learned, commands", [
+        (["new", "old", "new", "old", "old"], 2, 2),
+        (["new", "big", "new", "old"], 2, 2),
+        (["new", "new", "new", "big"], 3, 2),
+        (["old"], 0, 1)])
+    def test_learn_batch(self, fake_sa_learn, bodies, learned, commands):
+        """Test learn with --learnbatch."""
+        mails = dict((uid + 1, "Subject: ham\n\n{}".format(body).encode())
+                     for uid, body in enumerate(bodies))
+        sbg = isbg.ISBG()
+        sbg.imap = FakeImap(mails)
+        sbg.learnbatch = 3
+        sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+        res = sa.learn('Ham', 'ham', None, [])
+        assert res.learned == learned
+        assert sorted(res.uids) == sorted(mails)
+        assert len(fake_sa_learn) == commands
+
+    def test_learn_batch_result(self, fake_sa_learn):
+        """Test _learn_batch returning the codes and the mails learned."""
+        sbg = isbg.ISBG()
+        sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+        batch = [(str(uid), imaputils.RawMessage(
+            "Subject: {}\r\n\r\nhi".format(body).encode()))
+            for uid, body in enumerate(["new", "old", "new"])]
+        res = sa._learn_batch('ham', batch)
+        assert res.mails == batch
+        assert res.codes == [(None, None)] * 3, "The outcome is unknown."
+        assert res.learned == 2
+        res = sa._learn_batch('ham', batch[:1])
+        assert (res.codes, res.learned) == ([(5, 0)], 1)
+
+    def test_learn_batch_big(self, fake_sa_learn):
+        """Test the big mails are learned with --learnbatch."""
+        mails = {1: b"Subject: new\n\n" + b"x" * 600 * 1024,
+                 2: b"Subject: new\n\nhello"}
+        sbg = isbg.ISBG()
+        sbg.imap = FakeImap(mails)
+        sbg.learnbatch = 3
+        sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+        res = sa.learn('Ham', 'ham', None, [])
+        assert res.learned == 2, "sa-learn has no size limit."
+        assert len(fake_sa_learn) == 1
+
+    def test_scantimeout(self, monkeypatch):
+        """Test the mails timed out are retried."""
+        def test_mail(mail, spamc=False, cmd=False, spamd=None,
+                      timeout=None):
+            assert timeout == 5
+            if b"slow" in mail.as_bytes():
+                return "-9998", None, None
+            return fake_test_mail(mail, spamc, cmd, spamd)
+        monkeypatch.setattr(spamproc, 'test_mail', test_mail)
+        sbg = isbg.ISBG()
+        sbg.imap = FakeImap({1: b"Subject: hi\n\nhello",
+                             2: b"Subject: hi\n\nslow",
+                             3: b"Subject: hi\n\nviagra"})
+        sbg.scantimeout = 5
+        sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+        proc = sa.process_inbox([], {'retry': [1, 2, 7]})
+        assert sorted(proc.uids) == [1, 3]
+        assert proc.numspam == 1
+        assert proc.state['retry'] == [2]
+        assert proc.state['lastuid'] == 3
+
+    def test_runtimeout(self, monkeypatch):
+        """Test the mails left when the run times out."""
+        def test_mail(mail, spamc=False, cmd=False, spamd=None,
+                      timeout=None):
+            assert 0 < timeout <= 0.5
+            time.sleep(0.2)
+            return fake_test_mail(mail, spamc, cmd, spamd)
+        monkeypatch.setattr(spamproc, 'test_mail', test_mail)
+        sbg = isbg.ISBG()
+        sbg.imap = FakeImap(dict((uid, b"Subject: hi\n\nhello")
+                                 for uid in range(1, 10)))
+        sbg.runtimeout = 0.5
+        sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+        proc = sa.process_inbox([], {'lastuid': None, 'retry': [4, 5]})
+        assert sa.expired
+        assert 0 < len(proc.uids) < 9
+        assert proc.state['lastuid'] is None, "It continues in the next run."
+        assert proc.state['retry'] == [4, 5]
+
     def test_get_formated_uids(self):
         """Test get_formated_uids."""
         sbg = isbg.ISBG()
@@ -271,3 +587,380 @@ class Test_SpamAssassin(object):
         with pytest.raises(AttributeError, match="has no attribute"):
             sa.process_inbox([])
             pytest.fail("Should rise error, IMAP not created.")
+
+    @pytest.mark.parametrize("workers", [1, 3])
+    def test_process_inbox_pipeline(self, monkeypatch, workers):
+        """Test process_inbox fetching, scanning and acting on mails."""
+        monkeypatch.setattr(spamproc, 'test_mail', fake_test_mail)
+        mails = {}
+        for uid in range(1, 11):
+            body = b"viagra" if uid % 3 == 0 else b"hello"
+            mails[uid] = b"Subject: " + str(uid).encode() + b"\n\n" + body
+        sbg = isbg.ISBG()
+        sbg.imap = FakeImap(mails)
+        sbg.spamflags = ["\\Deleted"]
+        sbg.partialrun = 8
+        sbg.fetchbatch = 3
+        sbg.scanworkers = workers
+        sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+
+        proc = sa.process_inbox([10, 2])
+        assert proc.nummsg == 8
+        assert sorted(proc.uids) == [1, 3, 4, 5, 6, 7, 8, 9]
+        assert proc.numspam == 3
+        assert sorted(proc.newpastuids, key=int) == [2, '3', '6', '9', 10]
+        assert len(sbg.imap.appended) == 3
+        assert sorted(sbg.imap.flags) == ['3', '6', '9']
+        stores = [c for c in sbg.imap.commands if c[0] == 'STORE']
+        assert len(stores) == 1, "Spams should be flagged by one command."
+
+    def test_process_inbox_stop_fetching(self, monkeypatch):
+        """Test process_inbox stopping the fetch thread after the loop."""
+        class SlowImap(FakeImap):
+            def uid(self, command, *args):
+                if command == 'FETCH' and 'BODY.PEEK[]' in args[1]:
+                    time.sleep(0.01)
+                return FakeImap.uid(self, command, *args)
+
+        def fetches():
+            return len([c for c in sbg.imap.commands if c[0] == 'FETCH' and
+                        'BODY.PEEK[]' in c[2]])
+
+        counts = []
+        keep_state = spamproc.SpamAssassin._keep_state
+
+        def _keep_state(newstate, state):
+            # Called after the loop: any FETCH now races with the actions
+            counts.append(fetches())
+            time.sleep(0.1)
+            counts.append(fetches())
+            return keep_state(newstate, state)
+
+        monkeypatch.setattr(spamproc.SpamAssassin, '_keep_state',
+                            staticmethod(_keep_state))
+        sbg = isbg.ISBG()
+        sbg.imap = SlowImap(dict((uid, b"Subject: hi\n\nhello")
+                                 for uid in range(1, 41)))
+        sbg.dryrun = True
+        sbg.fetchbatch = 1
+        sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+        sa.process_inbox([])
+        assert counts[0] < 40, "The dryrun stops after a few mails."
+        assert counts[0] == counts[1], "No FETCH after the loop."
+
+    @pytest.mark.parametrize("caps, commands", [
+        (['MOVE', 'UIDPLUS'], ['UID MOVE']),
+        (['UIDPLUS'], ['UID COPY', 'UID STORE', 'UID EXPUNGE']),
+        ([], ['UID COPY', 'UID STORE', 'EXPUNGE'])])
+    def test_process_inbox_move(self, monkeypatch, caps, commands):
+        """Test process_inbox with MOVE and UIDPLUS."""
+        monkeypatch.setattr(spamproc, 'test_mail', fake_test_mail)
+        server = fakeimapd.FakeImapServer(['IMAP4rev1'] + caps).start()
+        try:
+            inbox = server.mailboxes['INBOX']
+            for body in [b"hello", b"viagra", b"hello", b"viagra"]:
+                inbox.add(b"Subject: test\r\n\r\n" + body)
+            # Deleted by other client:
+            inbox.add(b"Subject: test\r\n\r\nhello", ['\\Deleted'])
+            sbg = isbg.ISBG()
+            sbg.imap = imaputils.IsbgImap4('127.0.0.1', server.port,
+                                           nossl=True)
+            sbg.imap.login('user', 'pass')
+            sbg.imapsets.spaminbox = 'INBOX.Spam'
+            sbg.noreport, sbg.expunge = (True, True)
+            sbg.spamflags = ["\\Deleted"]
+            sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+            del server.commands[:]
+            proc = sa.process_inbox([])
+            assert proc.numspam == 2
+            names = [n for n in server.command_names() if n not in [
+                'SELECT', 'EXAMINE', 'UID SEARCH', 'UID FETCH']]
+            assert names == commands
+            assert len(server.mailboxes['INBOX.Spam'].mails) == 2
+            if 'UIDPLUS' in caps:
+                assert inbox.uids() == [1, 3, 5]
+            else:
+                assert inbox.uids() == [1, 3]
+            sbg.imap.logout()
+        finally:
+            server.stop()
+
+    def test_process_inbox_move_refused(self, monkeypatch):
+        """Test process_inbox when the server refuses the UID MOVE."""
+        monkeypatch.setattr(spamproc, 'test_mail', fake_test_mail)
+        server = fakeimapd.FakeImapServer(['IMAP4rev1', 'MOVE',
+                                           'UIDPLUS']).start()
+        try:
+            inbox = server.mailboxes['INBOX']
+            for body in [b"hello", b"viagra", b"viagra"]:
+                inbox.add(b"Subject: test\r\n\r\n" + body)
+            sbg = isbg.ISBG()
+            sbg.imap = imaputils.IsbgImap4('127.0.0.1', server.port,
+                                           nossl=True, assertok=sbg.assertok)
+            sbg.imap.login('user', 'pass')
+            sbg.imapsets.spaminbox = 'INBOX.Missing'  # NO [TRYCREATE]
+            sbg.noreport, sbg.expunge = (True, True)
+            sbg.spamflags = ["\\Deleted"]
+            sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+            del server.commands[:]
+            proc = sa.process_inbox([])
+            assert proc.numspam == 2
+            assert 'UID MOVE' in server.command_names()
+            # The spams are left alone:
+            assert inbox.uids() == [1, 2, 3]
+            assert not any(flags for _, flags, _ in inbox.mails.values())
+            sbg.imap.logout()
+        finally:
+            server.stop()
+
+    def test_process_inbox_copy_refused(self, monkeypatch):
+        """Test process_inbox when the server refuses the UID COPY."""
+        monkeypatch.setattr(spamproc, 'test_mail', fake_test_mail)
+        server = fakeimapd.FakeImapServer(['IMAP4rev1', 'UIDPLUS']).start()
+        try:
+            inbox = server.mailboxes['INBOX']
+            for body in [b"hello", b"viagra", b"viagra"]:
+                inbox.add(b"Subject: test\r\n\r\n" + body)
+            sbg = isbg.ISBG()
+            sbg.imap = imaputils.IsbgImap4('127.0.0.1', server.port,
+                                           nossl=True, assertok=sbg.assertok)
+            sbg.imap.login('user', 'pass')
+            sbg.imapsets.spaminbox = 'INBOX.Missing'  # NO [TRYCREATE]
+            sbg.noreport, sbg.expunge = (True, True)
+            sbg.spamflags = ["\\Deleted"]
+            sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+            del server.commands[:]
+            proc = sa.process_inbox([])
+            assert proc.numspam == 0
+            names = server.command_names()
+            assert 'UID COPY' in names
+            assert 'UID STORE' not in names
+            assert 'UID EXPUNGE' not in names
+            assert inbox.uids() == [1, 2, 3]
+            sbg.imap.logout()
+        finally:
+            server.stop()
+
+    @pytest.mark.parametrize("trust, noreport, scanned", [
+        (False, False, ['1', '3', '4']),
+        (True, False, ['1', '4']),
+        (True, True, ['1'])])
+    def test_prefilter(self, monkeypatch, trust, noreport, scanned):
+        """Test process_inbox and learn only fetching the needed mails."""
+        monkeypatch.setattr(spamproc, 'test_mail', fake_test_mail)
+        monkeypatch.setattr(spamproc, 'learn_mail',
+                            lambda mail, learn_type, spamd=None, timeout=None:
+                            (5, 0))
+        server = fakeimapd.FakeImapServer().start()
+        try:
+            inbox = server.mailboxes['INBOX']
+            inbox.add(b"Subject: 1\r\n\r\nviagra")
+            inbox.add(b"Subject: 2\r\n\r\nhello", ['\\Deleted'])
+            inbox.add(b"Subject: 3\r\nX-Spam-Status: No, score=-0.1 "
+                      b"required=5.0\r\n\r\nviagra")
+            inbox.add(b"Subject: 4\r\nX-Spam-Status: Yes, score=9.0\r\n"
+                      b"\trequired=5.0 tests=FOO\r\n\r\nhello")
+            sbg = isbg.ISBG()
+            sbg.imap = imaputils.IsbgImap4('127.0.0.1', server.port,
+                                           nossl=True)
+            sbg.imap.login('user', 'pass')
+            sbg.imapsets.spaminbox = 'INBOX.Spam'
+            sbg.trustspamheaders, sbg.noreport = (trust, noreport)
+            sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+
+            del server.commands[:]
+            proc = sa.process_inbox([])
+            fetched = [c[3] for c in server.commands
+                       if c[1:3] == ['UID', 'FETCH'] and
+                       c[4] == '(BODY.PEEK[])']
+            assert sorted(','.join(fetched).split(',')) == scanned
+            # The headers are only fetched to trust them:
+            assert ('HEADER.FIELDS' in str(server.commands)) == trust
+            # The deleted mail is not a past uid:
+            assert sorted(proc.uids) == [1, 3, 4]
+            assert proc.state['deleted'] == [2]
+            assert proc.nummsg == 3
+            assert proc.numspam == (1 if trust and not noreport else 2)
+            assert len(server.mailboxes['INBOX.Spam'].mails) == proc.numspam
+
+            # Once undeleted, it's scanned in the next run:
+            inbox.mails[2][1].clear()
+            proc = sa.process_inbox(proc.uids, proc.state)
+            assert proc.uids == [2]
+            assert proc.state['deleted'] == []
+
+            # Learning with spamc, the too big mails are not fetched:
+            inbox.add(b"Subject: 5\r\n\r\n" + b"x" * 600 * 1024)
+            del server.commands[:]
+            inbox.mails[2][1].add('\\Deleted')
+            learned = sa.learn('INBOX', 'ham', None, [1, 3, 4])
+            assert learned.tolearn == 1
+            assert learned.learned == 0
+            assert learned.uids == [5]
+            assert learned.state['deleted'] == [2]
+            assert 'BODY.PEEK[]' not in str(server.commands)
+            sbg.imap.logout()
+        finally:
+            server.stop()
+
+    def test_scantruncated(self, monkeypatch):
+        """Test process_inbox scanning the start of the big mails."""
+        scanned = []
+
+        def test_mail(mail, spamc=False, cmd=False, spamd=None,
+                      timeout=None):
+            scanned.append(mail.as_bytes())
+            return fake_test_mail(mail, spamc, cmd, spamd)
+        monkeypatch.setattr(spamproc, 'test_mail', test_mail)
+        server = fakeimapd.FakeImapServer().start()
+        try:
+            inbox = server.mailboxes['INBOX']
+            big = b"Subject: big\r\n\r\nviagra" + b"x" * 2000
+            inbox.add(b"Subject: small\r\n\r\nhello")
+            inbox.add(big)
+            sbg = isbg.ISBG()
+            sbg.imap = imaputils.IsbgImap4('127.0.0.1', server.port,
+                                           nossl=True)
+            sbg.imap.login('user', 'pass')
+            sbg.imapsets.spaminbox = 'INBOX.Spam'
+            sbg.maxsize = 1000
+            sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+            proc = sa.process_inbox([])
+            assert proc.nummsg == 1, "The big mail is ignored."
+
+            sa.scantruncated = True
+            proc = sa.process_inbox([1])
+            assert proc.nummsg == 1
+            assert proc.numspam == 1
+            assert len(scanned[-1]) <= 1000
+            # The whole mail is copied, without report:
+            spams = server.mailboxes['INBOX.Spam'].mails
+            assert [m[0] for m in spams.values()] == [big]
+            sbg.imap.logout()
+        finally:
+            server.stop()
+
+    def test_search_uids_condstore(self):
+        """Test search_uids with a CONDSTORE server."""
+        server = fakeimapd.FakeImapServer(
+            ['IMAP4rev1', 'ENABLE', 'CONDSTORE']).start()
+        try:
+            inbox = server.mailboxes['INBOX']
+            for i in range(3):
+                inbox.add(b"Subject: " + str(i).encode() + b"\r\n\r\nhi")
+            imap = imaputils.IsbgImap4('127.0.0.1', server.port, nossl=True)
+            imap.login('user', 'pass')
+            assert imap.enable_condstore()
+            sbg = isbg.ISBG()
+            sbg.imap = imap
+            sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+
+            # Without state all the folder is searched:
+            imap.select('INBOX', True)
+            uids, past, state = sa.search_uids(["ALL"], [], None)
+            assert uids == ['3', '2', '1']
+            assert state == {'highestmodseq': inbox.modseq}
+
+            # Without changes nothing is searched:
+            del server.commands[:]
+            imap.select('INBOX', True)
+            uids, past, newstate = sa.search_uids(["ALL"], [1, 2, 3], state)
+            assert uids == []
+            assert past == [1, 2, 3]
+            assert newstate == state
+            assert 'UID SEARCH' not in server.command_names()
+
+            # Only the new mails are searched, the past uids are kept:
+            inbox.add(b"Subject: 4\r\n\r\nhi")
+            inbox.add(b"Subject: 5\r\n\r\nhi")
+            imap.select('INBOX', True)
+            uids, past, newstate = sa.search_uids(["ALL"], [1, 2, 3], state)
+            assert uids == ['5', '4']
+            assert past == [1, 2, 3]
+            assert newstate == {'highestmodseq': inbox.modseq}
+            assert 'MODSEQ' in server.commands[-1]
+
+            # A backlog keeps the old modseq:
+            sa.partialrun = 1
+            uids, past, newstate = sa.search_uids(["ALL"], [1, 2, 3], state)
+            assert uids == ['5']
+            assert newstate == state
+
+            # The uids of the expunged mails are pruned:
+            sa.partialrun = None
+            state = {'highestmodseq': inbox.modseq, 'messages': 5,
+                     'uidnext': 6}
+            inbox.mails[1][1].add('\\Deleted')
+            inbox.expunge()
+            inbox.add(b"Subject: 6\r\n\r\nhi")
+            del server.commands[:]
+            imap.select('INBOX', True)
+            uids, past, newstate = sa.search_uids(
+                ["ALL"], [1, 2, 3, 4, 5], state)
+            assert uids == ['6']
+            assert past == [2, 3, 4, 5]
+            assert ['UID', 'SEARCH', 'ALL'] in [
+                c[1:] for c in server.commands]
+
+            # Without expunges they are kept:
+            state = {'highestmodseq': inbox.modseq, 'messages': 5,
+                     'uidnext': 7}
+            inbox.add(b"Subject: 7\r\n\r\nhi")
+            del server.commands[:]
+            imap.select('INBOX', True)
+            uids, past, newstate = sa.search_uids(
+                ["ALL"], [2, 3, 4, 5, 6], state)
+            assert uids == ['7']
+            assert past == [2, 3, 4, 5, 6]
+            assert ['UID', 'SEARCH', 'ALL'] not in [
+                c[1:] for c in server.commands]
+            imap.logout()
+        finally:
+            server.stop()
+
+    def test_search_uids_uidrange(self):
+        """Test search_uids with the last uid of the previous run."""
+        server = fakeimapd.FakeImapServer().start()
+        try:
+            inbox = server.mailboxes['INBOX']
+            for i in range(4):
+                inbox.add(b"Subject: " + str(i).encode() + b"\r\n\r\nhi")
+            imap = imaputils.IsbgImap4('127.0.0.1', server.port, nossl=True)
+            imap.login('user', 'pass')
+            sbg = isbg.ISBG()
+            sbg.imap = imap
+            sbg.partialrun = 3
+            sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+            imap.select('INBOX', True)
+
+            # The backlog isn't drained: it's searched again from the start
+            uids, past, state = sa.search_uids(["ALL"], [], {}, True)
+            assert uids == ['4', '3', '2']
+            assert state == {'highestmodseq': None, 'lastuid': None}
+            uids, past, state = sa.search_uids(["ALL"], [4, 3, 2], {}, True)
+            assert uids == ['1']
+            assert state['lastuid'] == 4
+
+            # Only the new mails are searched
+            inbox.add(b"Subject: 5\r\n\r\nhi")
+            uids, past, state = sa.search_uids(["ALL"], [4, 3, 2, 1], state,
+                                               True)
+            assert server.commands[-1][-2:] == ['UID', '5:*']
+            assert uids == ['5']
+            assert past == []
+            assert state['lastuid'] == 5
+
+            # Without new mails '5:*' matches the last one
+            uids, past, state = sa.search_uids(["ALL"], [5], state, True)
+            assert uids == []
+            assert past == []
+            assert state['lastuid'] == 5
+
+            # The mails with lower uids are searched without uidrange
+            sa.partialrun = None
+            uids, past, state = sa.search_uids(["ALL"], [5], state)
+            assert uids == ['4', '3', '2', '1']
+            assert 'lastuid' not in state
+            imap.logout()
+        finally:
+            server.stop()
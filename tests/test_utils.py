@@ -78,6 +78,106 @@ def test_get_ascii_or_value():
     assert ret == {u'isbg': (u'IMAP', [u'Spam', u'Begone'])}, 'error'
 
 
+def test_threaded_iter():
+    """Test the threaded_iter function."""
+    import threading
+    import time
+
+    assert list(utils.threaded_iter(range(10), depth=2)) == list(range(10))
+    assert list(utils.threaded_iter(range(3), depth=None)) == [0, 1, 2]
+
+    def failing():
+        yield 1
+        raise ValueError("producer error")
+
+    with pytest.raises(ValueError, match="producer error"):
+        list(utils.threaded_iter(failing(), depth=2))
+
+    # The generator can be left before the end:
+    for item in utils.threaded_iter(range(100), depth=1):
+        if item == 1:
+            break
+
+    # Once closed, the producer is stopped:
+    produced, closed = ([], [])
+
+    def producer():
+        try:
+            for item in range(100):
+                produced.append(item)
+                yield item
+        finally:
+            closed.append(True)
+
+    items = utils.threaded_iter(producer(), depth=2)
+    assert next(items) == 0
+    items.close()
+    count = len(produced)
+    assert count < 100
+    assert closed == [True]
+    assert not [t for t in threading.enumerate()
+                if t.name == "isbg-producer"]
+    time.sleep(0.05)
+    assert len(produced) == count
+
+
+def test_ordered_map():
+    """Test the ordered_map function."""
+    import threading
+    import time
+
+    lock = threading.Lock()
+    running = [0, 0]  # current, max
+
+    def slow(item):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.01 * (5 - item))
+        with lock:
+            running[0] -= 1
+        return item * 2
+
+    res = list(utils.ordered_map(slow, range(5), workers=3))
+    assert res == [(0, 0), (1, 2), (2, 4), (3, 6), (4, 8)]
+    assert running[1] == 3, "It should run 3 calls at the same time."
+
+    running[1] = 0
+    res = list(utils.ordered_map(slow, range(3), workers=1))
+    assert res == [(0, 0), (1, 2), (2, 4)]
+    assert running[1] == 1
+
+    # The generator can be left before the end:
+    for item, _ in utils.ordered_map(slow, range(5), workers=2):
+        if item == 1:
+            break
+
+    # A shared executor bounds the calls of several maps:
+    from concurrent.futures import ThreadPoolExecutor
+    executor = ThreadPoolExecutor(max_workers=2)
+    running[1] = 0
+    maps = [utils.ordered_map(slow, range(5), 3, executor) for _ in (1, 2)]
+    threads = [threading.Thread(target=list, args=(m,)) for m in maps]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert running[1] == 2
+    assert list(utils.ordered_map(slow, range(2), 2, executor)) == [
+        (0, 0), (1, 2)]
+    executor.shutdown()
+
+
+def test_communicate():
+    """Test communicate."""
+    proc = utils.popen([sys.executable, '-c', 'print(input())'])
+    assert utils.communicate(proc, b"hi\n", 10)[0].strip() == b"hi"
+    proc = utils.popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+    with pytest.raises(utils.TimeoutExpired):
+        utils.communicate(proc, timeout=0.2)
+    assert proc.returncode is not None, "It should be killed."
+
+
 def test_score_from_mail():
     """Test score_from_mail."""
     # Without score: